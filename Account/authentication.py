@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from Account.models import User
+from Utilities.metrics import count_lookups
+
+AUTH_CACHE_TTL = getattr(settings, 'AUTH_CACHE_TTL', 300)
+AUTH_LOCAL_TTL = getattr(settings, 'AUTH_LOCAL_TTL', 5)
+AUTH_LOCAL_SIZE = 10000
+# The only columns a cached principal carries, the rest are deferred and loaded from the database on access.
+# They are in model field order, which User.from_db() expects
+PRINCIPAL_FIELDS = tuple(field.attname for field in User._meta.concrete_fields
+						 if field.attname in ('id', 'username', 'is_active', 'is_staff', 'is_superuser'))
+
+
+def auth_version_key(user_id):
+	return f'auth_version_{user_id}'
+
+
+def principal_key(user_id):
+	return f'auth_user_{user_id}'
+
+
+def bump_auth_version(user_id):
+	'''
+		Invalidates the cached principal of a user everywhere. Other processes may still use their local copy
+		for up to AUTH_LOCAL_TTL seconds
+	:return:
+	'''
+	try:
+		cache.incr(auth_version_key(user_id))
+	except ValueError:
+		cache.set(auth_version_key(user_id), 1, timeout=None)
+	with _local_lock:
+		_local.pop(user_id, None)
+
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+	'''
+		This authentication class resolves the user of a JWT from a short-lived per-process copy, then from a
+		redis entry tagged with the user's auth version, and only then from the database.
+		The user it returns only has PRINCIPAL_FIELDS loaded, views that render the full user should load it
+	'''
+
+	def get_user(self, validated_token):
+		try:
+			user_id = int(validated_token[api_settings.USER_ID_CLAIM])
+		except KeyError:
+			raise InvalidToken('Token contained no recognizable user identification')
+		now = time.monotonic()
+		with _local_lock:
+			local = _local.get(user_id)
+		if local is not None and local[0] > now:
+			values = local[1]
+		else:
+			entries = cache.get_many([auth_version_key(user_id), principal_key(user_id)])
+			count_lookups([principal_key(user_id)], entries)
+			version = entries.get(auth_version_key(user_id), 0)
+			entry = entries.get(principal_key(user_id))
+			if entry is not None and entry['version'] == version:
+				values = entry['values']
+			else:
+				values = User.objects.filter(id=user_id).values_list(*PRINCIPAL_FIELDS).first()
+				if values is None:
+					raise AuthenticationFailed('User not found', code='user_not_found')
+				cache.set(principal_key(user_id), {'version': version, 'values': values}, timeout=AUTH_CACHE_TTL)
+			with _local_lock:
+				_local[user_id] = (now + AUTH_LOCAL_TTL, values)
+				_local.move_to_end(user_id)
+				while len(_local) > AUTH_LOCAL_SIZE:
+					_local.popitem(last=False)
+		user = User.from_db('default', PRINCIPAL_FIELDS, values)
+		if not user.is_active:
+			raise AuthenticationFailed('User is inactive', code='user_inactive')
+		return user
@@ -0,0 +1,58 @@
+from django.core.cache import cache
+
+from Account.models import User
+from Account.serializer import BasicUserSerializer
+from Utilities.api_response import CACHE_TTL
+from Utilities.cache import store_many
+from Utilities.fast_serializer import get_fast_serializer
+from Utilities.metrics import count_lookups
+
+
+def user_cache_key(user_id):
+	return f'basic_user_{user_id}'
+
+
+def profile_scope(user_id):
+	return f'profile_{user_id}'
+
+
+def listed_users_scope(user_id):
+	return f'listed_users_{user_id}'
+
+
+# Bumped instead of the listed_users scope of every profile listing a user who has too many followers and followings
+# to bump them one by one
+ALL_LISTED_USERS = 'listed_users'
+
+
+def profile_version_scopes(user_id, expanded=False):
+	'''
+		The version scopes a user's profile depends on. An expanded profile also lists the users it follows and is
+		followed by, whose edits bump its listed_users scope, or ALL_LISTED_USERS for widely followed users
+	:return:
+	'''
+	scopes = [profile_scope(user_id)]
+	if expanded:
+		scopes += [listed_users_scope(user_id), ALL_LISTED_USERS]
+	return scopes
+
+
+def render_users(user_ids, known=None):
+	'''
+		Returns the BasicUserSerializer payloads of these users by ID, from the shared per-user cache entries.
+		Payloads already at hand can be passed in `known` by cache key, they are used but not cached
+	:return:
+	'''
+	entries = dict(known or {})
+	keys = [user_cache_key(user_id) for user_id in user_ids if user_cache_key(user_id) not in entries]
+	found = cache.get_many(keys)
+	count_lookups(keys, found)
+	entries.update(found)
+	missing = [user_id for user_id in user_ids if user_cache_key(user_id) not in entries]
+	if missing:
+		# A user edited while they are read is not cached, see store_many
+		entries.update(store_many([user_cache_key(user_id) for user_id in missing], lambda: {
+			user_cache_key(user['id']): user
+			for user in get_fast_serializer(BasicUserSerializer).queryset(User.objects.filter(id__in=missing))},
+			timeout=CACHE_TTL))
+	return {user_id: entries[user_cache_key(user_id)] for user_id in user_ids if user_cache_key(user_id) in entries}
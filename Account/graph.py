@@ -0,0 +1,220 @@
+import threading
+
+from django.conf import settings
+
+from Account.models import User
+from Utilities.replicas import primary_reads
+
+FOLLOW_GRAPH_TTL = getattr(settings, 'FOLLOW_GRAPH_TTL', 24 * 60 * 60)
+# Kept in every loaded redis set so that a loaded empty set still exists, user IDs start at 1
+SENTINEL = 0
+# Adds members only to a set that is already loaded, a partial set must not look loaded
+ADD_IF_LOADED = "if redis.call('exists', KEYS[1]) == 1 then return redis.call('sadd', KEYS[1], unpack(ARGV)) end return 0"
+
+
+def load_ids(kind, user_id):
+	'''
+		Reads a user's `followers` or `following` IDs from the database
+	:return:
+	'''
+	with primary_reads():
+		if kind == 'followers':
+			return set(User.follower_ids(user_id).values_list('to_user_id', flat=True))
+		return set(User.following_ids(user_id).values_list('from_user_id', flat=True))
+
+
+class RedisFollowGraph:
+	'''
+		This graph keeps the follower and following IDs of each user as redis sets, loaded from the database on first
+		use and kept up to date by the follow endpoints. Every update bumps a version of the sets it touches, and a
+		load is only stored if that version did not change while it read the database, so a follow or unfollow
+		committed meanwhile cannot be lost from the stored set. Sets expire after FOLLOW_GRAPH_TTL seconds
+	'''
+	key_prefix = 'graph'
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def key(self, kind, user_id):
+		return f'{self.key_prefix}:{user_id}:{kind}'
+
+	def version_key(self, kind, user_id):
+		return f'{self.key(kind, user_id)}:version'
+
+	def ensure(self, sets):
+		'''
+			Loads the (kind, user_id) sets that are not in redis yet. Returns the IDs of the sets that were read from
+			the database but not stored because an update raced the read, for the caller to use this time
+		:return:
+		'''
+		pipe = self.client.pipeline(transaction=False)
+		for kind, user_id in sets:
+			pipe.sismember(self.key(kind, user_id), SENTINEL)
+			pipe.get(self.version_key(kind, user_id))
+		results = pipe.execute()
+		unstored = {}
+		for (kind, user_id), loaded, version in zip(sets, results[::2], results[1::2]):
+			if not loaded:
+				ids = load_ids(kind, user_id)
+				if not self.store(kind, user_id, ids, version):
+					unstored[(kind, user_id)] = ids
+		return unstored
+
+	def store(self, kind, user_id, ids, version):
+		'''
+			Stores a loaded set unless its version is no longer `version`, the one read before loading it
+		:return:
+		'''
+		from redis.exceptions import WatchError
+		key, version_key = self.key(kind, user_id), self.version_key(kind, user_id)
+		with self.client.pipeline() as pipe:
+			try:
+				pipe.watch(version_key)
+				if pipe.get(version_key) != version:
+					return False
+				pipe.multi()
+				pipe.delete(key)
+				pipe.sadd(key, SENTINEL, *ids)
+				pipe.expire(key, FOLLOW_GRAPH_TTL)
+				pipe.execute()
+				return True
+			except WatchError:
+				return False
+
+	def intersect(self, *sets):
+		unstored = self.ensure(sets)
+		keys = [self.key(kind, user_id) for kind, user_id in sets if (kind, user_id) not in unstored]
+		members = {int(member) for member in self.client.sinter(keys)} - {SENTINEL} if keys else None
+		for ids in unstored.values():
+			members = set(ids) if members is None else members & ids
+		return members
+
+	def followers(self, user_id):
+		return self.intersect(('followers', user_id))
+
+	def following(self, user_id):
+		return self.intersect(('following', user_id))
+
+	def follows(self, follower_id, followee_id):
+		unstored = self.ensure([('following', follower_id)])
+		if unstored:
+			return followee_id in unstored[('following', follower_id)]
+		return bool(self.client.sismember(self.key('following', follower_id), followee_id))
+
+	def mutual(self, user_id):
+		'''
+			The users that this user follows and that follow them back
+		:return:
+		'''
+		return self.intersect(('followers', user_id), ('following', user_id))
+
+	def common_followers(self, *user_ids):
+		'''
+			The users that follow all of the given users
+		:return:
+		'''
+		return self.intersect(*[('followers', user_id) for user_id in user_ids])
+
+	def followed_by(self, viewer_id, user_id):
+		'''
+			The users that the viewer follows and that follow this user
+		:return:
+		'''
+		return self.intersect(('following', viewer_id), ('followers', user_id))
+
+	def update(self, follower_id, followee_ids, action):
+		'''
+			Applies follows or unfollows of one follower to the loaded sets, unloaded sets are left to load on first use
+		:return:
+		'''
+		if not followee_ids:
+			return
+		pipe = self.client.pipeline(transaction=False)
+		for (kind, user_id), members in [(('following', follower_id), followee_ids)] + \
+										[(('followers', followee_id), [follower_id]) for followee_id in followee_ids]:
+			key, version_key = self.key(kind, user_id), self.version_key(kind, user_id)
+			# Bumped first, a load that read the database before this change must not be stored
+			pipe.incr(version_key)
+			pipe.expire(version_key, FOLLOW_GRAPH_TTL)
+			if action == 'follow':
+				pipe.eval(ADD_IF_LOADED, 1, key, *members)
+			else:
+				pipe.srem(key, *members)
+		pipe.execute()
+
+
+class LocalFollowGraph:
+	'''
+		This is an in-process stand-in for the redis follow graph, used by tests and single process runs
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		self.sets = {}
+		self.versions = {}
+
+	def get(self, kind, user_id):
+		with self.lock:
+			members = self.sets.get((kind, user_id))
+			version = self.versions.get((kind, user_id), 0)
+		if members is None:
+			members = load_ids(kind, user_id)
+			with self.lock:
+				# Like the redis graph, a load raced by an update is used once but not kept
+				if self.versions.get((kind, user_id), 0) == version:
+					self.sets[(kind, user_id)] = members
+		return members
+
+	def intersect(self, *sets):
+		return set.intersection(*[self.get(kind, user_id) for kind, user_id in sets])
+
+	def followers(self, user_id):
+		return set(self.get('followers', user_id))
+
+	def following(self, user_id):
+		return set(self.get('following', user_id))
+
+	def follows(self, follower_id, followee_id):
+		return followee_id in self.get('following', follower_id)
+
+	def mutual(self, user_id):
+		return self.intersect(('followers', user_id), ('following', user_id))
+
+	def common_followers(self, *user_ids):
+		return self.intersect(*[('followers', user_id) for user_id in user_ids])
+
+	def followed_by(self, viewer_id, user_id):
+		return self.intersect(('following', viewer_id), ('followers', user_id))
+
+	def update(self, follower_id, followee_ids, action):
+		with self.lock:
+			for (kind, user_id), members in [(('following', follower_id), followee_ids)] + \
+											[(('followers', followee_id), [follower_id]) for followee_id in followee_ids]:
+				self.versions[(kind, user_id)] = self.versions.get((kind, user_id), 0) + 1
+				if (kind, user_id) in self.sets:
+					if action == 'follow':
+						self.sets[(kind, user_id)].update(members)
+					else:
+						self.sets[(kind, user_id)].difference_update(members)
+
+
+_graphs = {}
+
+
+def get_follow_graph():
+	'''
+		Returns the follow graph selected by settings.FOLLOW_GRAPH_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'FOLLOW_GRAPH_BACKEND', 'redis')
+	if backend not in _graphs:
+		_graphs[backend] = LocalFollowGraph() if backend == 'local' else RedisFollowGraph()
+	return _graphs[backend]
@@ -0,0 +1,49 @@
+import resource
+import time
+
+from django.core.management.base import BaseCommand
+
+from Account.suggestions import adjacency, top_suggestions, SUGGESTION_LIMIT
+
+
+def synthetic_graph(users, edges, seed):
+	'''
+		A follow graph where followers are picked uniformly and followees by a power law, like real follow graphs
+		where a few accounts have most of the followers. Self follows and duplicate edges are dropped
+	:return:
+	'''
+	import numpy as np
+	rng = np.random.default_rng(seed)
+	popularity = 1 / np.arange(1, users + 1) ** 0.8
+	followers = rng.integers(1, users + 1, edges)
+	followees = rng.choice(np.arange(1, users + 1), edges, p=popularity / popularity.sum())
+	pairs = np.unique(np.stack([followers, followees], axis=1)[followers != followees], axis=0)
+	return pairs[:, 0], pairs[:, 1]
+
+
+class Command(BaseCommand):
+	'''
+		This command measures how long scoring who to follow suggestions takes on a synthetic follow graph, and the
+		peak memory of the process. It leaves the database alone, writing the rows is measured by build_suggestions
+	'''
+	help = 'Benchmarks who to follow scoring on a synthetic follow graph'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--users', type=int, default=100000)
+		parser.add_argument('--edges', type=int, default=1000000)
+		parser.add_argument('--limit', type=int, default=SUGGESTION_LIMIT)
+		parser.add_argument('--block-size', type=int, default=2000)
+		parser.add_argument('--seed', type=int, default=0)
+
+	def handle(self, *args, **options):
+		followers, followees = synthetic_graph(options['users'], options['edges'], options['seed'])
+		started = time.perf_counter()
+		ids, matrix = adjacency(followers, followees)
+		built = time.perf_counter()
+		suggestions = sum(len(rows) for rows, _, _, _ in top_suggestions(matrix, options['limit'], options['block_size']))
+		scored = time.perf_counter()
+		self.stdout.write(f'{len(followers)} edges between {len(ids)} users')
+		self.stdout.write(f'matrix built in {(built - started) * 1000:.0f} ms')
+		self.stdout.write(f'{suggestions} suggestions scored in {(scored - built) * 1000:.0f} ms '
+						  f'({(scored - built) / len(ids) * 1000000:.1f} us per user)')
+		self.stdout.write(f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Account.models import Suggestion
+from Account.suggestions import read_edges, adjacency, top_suggestions, SUGGESTION_LIMIT
+
+
+class Command(BaseCommand):
+	'''
+		This command rebuilds the who to follow suggestions of every user from the follow graph. The graph is loaded
+		into a sparse matrix and scored in blocks of users, each block's suggestions replace the old ones in one
+		transaction, so users always see either their old or their new suggestions
+	'''
+	help = 'Rebuilds the who to follow suggestions of every user'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--limit', type=int, default=SUGGESTION_LIMIT, help='The number of suggestions kept per user')
+		parser.add_argument('--block-size', type=int, default=2000, help='The number of users scored at a time')
+		parser.add_argument('--chunk-size', type=int, default=100000, help='The number of edges read per query')
+
+	def handle(self, *args, **options):
+		started = time.perf_counter()
+		followers, followees = read_edges(options['chunk_size'])
+		ids, matrix = adjacency(followers, followees)
+		loaded = time.perf_counter()
+		block_size, written, previous = options['block_size'], 0, 0
+		blocks = top_suggestions(matrix, options['limit'], block_size)
+		for start, (rows, cols, scores, mutual) in zip(range(0, len(ids), block_size), blocks):
+			# Each block owns the user ID range up to its last user, which also clears users that lost all their edges
+			last = int(ids[min(start + block_size, len(ids)) - 1])
+			with transaction.atomic():
+				Suggestion.objects.filter(user_id__gt=previous, user_id__lte=last).delete()
+				Suggestion.objects.bulk_create([
+					Suggestion(user_id=user_id, suggested_id=suggested_id, score=score, mutual=count)
+					for user_id, suggested_id, score, count in zip(
+						ids[rows].tolist(), ids[cols].tolist(), scores.tolist(), mutual.tolist())
+				], batch_size=1000)
+			written += len(rows)
+			previous = last
+		Suggestion.objects.filter(user_id__gt=previous).delete()
+		self.stdout.write(f'Read {len(followers)} edges between {len(ids)} users in {loaded - started:.1f}s, '
+						  f'wrote {written} suggestions in {time.perf_counter() - loaded:.1f}s')
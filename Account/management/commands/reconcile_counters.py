@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from Account.cache import profile_scope
+from Account.models import User
+from Post.models import Post
+from Utilities.conditional import bump_versions
+
+Follow = User.followers.through
+
+
+class Command(BaseCommand):
+	'''
+		This command recomputes the denormalized follower, following and post counters of every user and fixes
+		the ones that drifted. It walks the users in primary key chunks and only updates the rows that differ,
+		each with its own short statement, so no table is locked while it runs
+	'''
+	help = 'Reconciles the no_of_followers, no_of_following and no_of_posts counters of users'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--chunk-size', type=int, default=1000, help='The number of users checked per batch')
+		parser.add_argument('--dry-run', action='store_true', help='Report drifted counters without fixing them')
+
+	def handle(self, *args, **options):
+		checked = fixed = 0
+		last_id = 0
+		while True:
+			users = list(User.objects.filter(id__gt=last_id).order_by('id').values(
+				'id', 'no_of_followers', 'no_of_following', 'no_of_posts')[:options['chunk_size']])
+			if not users:
+				break
+			last_id = users[-1]['id']
+			actual = self.count_chunk([user['id'] for user in users])
+			for user in users:
+				counters = {field: actual[field].get(user['id'], 0) for field in actual}
+				drifted = {field: value for field, value in counters.items() if user[field] != value}
+				if drifted and not options['dry_run']:
+					# Only overwrite the values we read, a concurrent update wins and is checked on the next run
+					if User.objects.filter(id=user['id'], **{field: user[field] for field in drifted}).update(**drifted):
+						bump_versions([profile_scope(user['id'])])
+				fixed += bool(drifted)
+			checked += len(users)
+		self.stdout.write(f'Checked {checked} users, {fixed} had drifted counters'
+						  f'{" (dry run, nothing was changed)" if options["dry_run"] else ""}')
+
+	def count_chunk(self, user_ids):
+		'''
+			Counts the followers, followings and posts of a chunk of users with one grouped query each
+		:return:
+		'''
+		def grouped(queryset, field):
+			rows = queryset.filter(**{f'{field}__in': user_ids}).values(field).annotate(total=Count('*'))
+			return {row[field]: row['total'] for row in rows}
+
+		return {
+			'no_of_followers': grouped(Follow.objects.all(), 'from_user_id'),
+			'no_of_following': grouped(Follow.objects.all(), 'to_user_id'),
+			'no_of_posts': grouped(Post.objects.all(), 'poster_id'),
+		}
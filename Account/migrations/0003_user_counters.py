@@ -0,0 +1,69 @@
+# Generated by Django 3.2.8 on 2026-10-18 12:31
+
+from django.db import migrations, models
+from django.db.models import Count
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_counters(apps, schema_editor):
+    '''
+        Sets the new counters from the follow and post rows, walking the users in primary key chunks with one
+        grouped query per counter and chunk, so existing users do not start at 0
+    :return:
+    '''
+    User = apps.get_model('Account', 'User')
+    Post = apps.get_model('Post', 'Post')
+    Follow = User.followers.through
+    db = schema_editor.connection.alias
+
+    def grouped(model, field, user_ids):
+        rows = model.objects.using(db).filter(**{f'{field}__in': user_ids}).values(field).annotate(total=Count('*'))
+        return {row[field]: row['total'] for row in rows}
+
+    last_id = 0
+    while True:
+        users = list(User.objects.using(db).filter(id__gt=last_id).order_by('id').only('id')[:BACKFILL_CHUNK_SIZE])
+        if not users:
+            break
+        last_id = users[-1].id
+        user_ids = [user.id for user in users]
+        followers = grouped(Follow, 'from_user_id', user_ids)
+        following = grouped(Follow, 'to_user_id', user_ids)
+        posts = grouped(Post, 'poster_id', user_ids)
+        changed = []
+        for user in users:
+            user.no_of_followers = followers.get(user.id, 0)
+            user.no_of_following = following.get(user.id, 0)
+            user.no_of_posts = posts.get(user.id, 0)
+            if user.no_of_followers or user.no_of_following or user.no_of_posts:
+                changed.append(user)
+        User.objects.using(db).bulk_update(changed, ['no_of_followers', 'no_of_following', 'no_of_posts'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Account', '0002_alter_user_id'),
+        ('Post', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='no_of_followers',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='no_of_following',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='no_of_posts',
+            field=models.IntegerField(default=0),
+        ),
+        # The columns are dropped on the way back, there is nothing to undo
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
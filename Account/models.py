@@ -1,33 +1,83 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 
 # Create your models here.
 from rest_framework_simplejwt.tokens import RefreshToken
 
+# The fields that decide whether and as whom a token authenticates, CachedJWTAuthentication caches some of them
+AUTH_FIELDS = ('username', 'password', 'is_active', 'is_staff', 'is_superuser')
+
 
 class User(AbstractUser):
 	followers = models.ManyToManyField('User', related_name='userfollowers')
+	no_of_followers = models.IntegerField(default=0)
+	no_of_following = models.IntegerField(default=0)
+	no_of_posts = models.IntegerField(default=0)
+
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		user = super().from_db(db, field_names, values)
+		user._auth_state = user.auth_state()
+		return user
+
+	def auth_state(self):
+		# Deferred fields were not loaded, so they cannot have been changed
+		deferred = self.get_deferred_fields()
+		return {field: getattr(self, field) for field in AUTH_FIELDS if field not in deferred}
+
+	def save(self, *args, **kwargs):
+		'''
+			Saves the user, and drops their cached principal once the save is committed when an AUTH_FIELDS value
+			changed. Queryset updates of these fields must call bump_auth_version themselves
+		:return:
+		'''
+		adding = self._state.adding
+		super().save(*args, **kwargs)
+		state = self.auth_state()
+		if not adding and state != getattr(self, '_auth_state', None):
+			from Account.authentication import bump_auth_version
+			user_id = self.pk
+			transaction.on_commit(lambda: bump_auth_version(user_id))
+		self._auth_state = state
 
 	def following(self):
 		'''
 			The queryset for users that this user is following
 		:return:
 		'''
-		return User.objects.filter(followers__username=self.username)
+		return User.objects.filter(id__in=User.following_ids(self.id))
+
+	@staticmethod
+	def follower_ids(user_id):
+		'''
+			The IDs of the users following this user as a queryset, filters use it as a subquery instead of sending
+			every ID to the database. Membership checks use the follow graph
+		:return:
+		'''
+		return User.followers.through.objects.filter(from_user_id=user_id).values('to_user_id')
+
+	@staticmethod
+	def following_ids(user_id):
+		'''
+			The IDs of the users this user is following as a queryset, see follower_ids
+		:return:
+		'''
+		return User.followers.through.objects.filter(to_user_id=user_id).values('from_user_id')
 
 	def followers_count(self):
 		'''
 			The number of users following this user
 		:return:
 		'''
-		return self.followers.count()
+		return self.no_of_followers
 
 	def following_count(self):
 		'''
 			The number of users this user is following
 		:return:
 		'''
-		return self.following().count()
+		return self.no_of_following
 
 	def tokens(self):
 		'''
@@ -45,7 +95,28 @@ class User(AbstractUser):
 			This is the number of posts this user has
 		:return:
 		'''
-		from Post.models import Post
-		return Post.objects.filter(poster=self).count()
+		return self.no_of_posts
+
+	@staticmethod
+	def adjust_counters(user_id, **deltas):
+		'''
+			Atomically adds the given deltas to this user's counter columns, e.g adjust_counters(1, no_of_posts=-1).
+			It should run in the same transaction as the change it counts
+		:return:
+		'''
+		User.objects.filter(pk=user_id).update(**{field: F(field) + delta for field, delta in deltas.items()})
+
 
+class Suggestion(models.Model):
+	'''
+		A user that `user` may want to follow, these rows are rewritten by `manage.py build_suggestions`
+	'''
+	user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='suggestions')
+	suggested = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+	score = models.FloatField()
+	mutual = models.IntegerField(default=0)
 
+	class Meta:
+		indexes = [
+			models.Index(fields=['user', '-score'], name='suggestion_user_score_idx'),
+		]
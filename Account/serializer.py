@@ -1,8 +1,11 @@
 from django.contrib.auth import authenticate, login
+from django.db import transaction
+from django.db.models import Exists, OuterRef, F
 from rest_framework.serializers import ModelSerializer, Serializer
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from Account.graph import get_follow_graph
 from Account.models import User
 
 
@@ -17,31 +20,30 @@ class BasicUserSerializer(ModelSerializer):
 
 class UserSerializer(ModelSerializer):
 	'''
-		This serializer is used to return a user's full details
+		This serializer is used to return a user's full details.
+		The followers and following lists are only included when named in context['expand'],
+		otherwise they can be paged through /user/<id>/followers/ and /user/<id>/following/
 	'''
 	followers = serializers.ListSerializer(child=BasicUserSerializer(), read_only=True)
 	following = serializers.SerializerMethodField('following_', read_only=True)
-	no_of_followers = serializers.SerializerMethodField('followers_count', read_only=True)
-	no_of_following = serializers.SerializerMethodField('following_count', read_only=True)
-	no_of_posts = serializers.SerializerMethodField('posts_count', read_only=True)
+	expandable_fields = ('followers', 'following')
 
 	class Meta:
 		model = User
 		fields = ('id', 'first_name', 'last_name', 'username', 'is_active', 'no_of_posts', 'no_of_followers', 'no_of_following',
 				  'followers', 'following')
+		read_only_fields = ('no_of_posts', 'no_of_followers', 'no_of_following')
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		expand = self.context.get('expand', ())
+		for field in self.expandable_fields:
+			if field not in expand:
+				self.fields.pop(field)
 
 	def following_(self, obj):
 		return BasicUserSerializer(obj.following(), many=True).data
 
-	def followers_count(self, obj):
-		return obj.followers_count()
-
-	def following_count(self, obj):
-		return obj.following_count()
-
-	def posts_count(self, obj):
-		return obj.posts_count()
-
 
 class SignupSerializer(ModelSerializer):
 	'''
@@ -98,7 +100,7 @@ class LoginSerializer(ModelSerializer):
 		del self.validated_data['user']
 		token = obj.validate(dict(**self.validated_data))
 		login(request, user)
-		user_data = UserSerializer(user).data
+		user_data = UserSerializer(user, context=self.context).data
 		user_data['token'] = token
 		return user_data
 
@@ -131,7 +133,10 @@ class UpdateUserDetailsSerializer(ModelSerializer):
 		return instance
 
 	def execute(self):
-		return UserSerializer(self.update(self.instance, self.validated_data)).data
+		from Post.events import user_edited
+		user = self.update(self.instance, self.validated_data)
+		user_edited(user)
+		return UserSerializer(user, context=self.context).data
 
 
 class UserActionSerializer(Serializer):
@@ -152,21 +157,129 @@ class UserActionSerializer(Serializer):
 		self.context['followee'] = User.objects.get(id=self.context['followee'])
 		if self.context['followee'] == self.instance:
 			raise Exception('You cannot follow or unfollow yourself')
-		if initial_data['action'] == 'follow' and self.context['followee'].followers.filter(
-				id=self.instance.id).exists():
+		following = get_follow_graph().follows(self.instance.id, self.context['followee'].id)
+		if initial_data['action'] == 'follow' and following:
 			raise Exception('You are already following this user')
-		elif initial_data['action'] == 'unfollow' and not self.context['followee'].followers.filter(
-				id=self.instance.id).exists():
+		elif initial_data['action'] == 'unfollow' and not following:
 			raise Exception('You are not following this user')
 		elif initial_data['action'] not in ('follow', 'unfollow'):
 			raise Exception('Wrong action')
 		return initial_data
 
-	def execute(self):
+	def apply(self):
+		'''
+			Writes the follow or unfollow with its counters and updates the follow graph
+		:return:
+		'''
 		followee = self.context['followee']
-		followee.followers.add(self.instance) if self.validated_data[
-															'action'] == 'follow' else followee.followers.remove(
-			self.instance)
-		followee.save()
+		edge = dict(from_user_id=followee.id, to_user_id=self.instance.id)
+		with transaction.atomic():
+			# Follows and unfollows of the same user run one at a time, see BulkUserActionSerializer.execute
+			User.objects.select_for_update().filter(id=self.instance.id).first()
+			if self.validated_data['action'] == 'follow':
+				changed = int(User.followers.through.objects.get_or_create(**edge)[1])
+			else:
+				changed = -User.followers.through.objects.filter(**edge).delete()[0]
+			if changed:
+				User.adjust_counters(followee.id, no_of_followers=changed)
+				User.adjust_counters(self.instance.id, no_of_following=changed)
+		get_follow_graph().update(self.instance.id, [followee.id], self.validated_data['action'])
+
+	def announce(self):
+		from Post.events import follow_changed
+		follow_changed(self.instance, [self.context['followee'].id], self.validated_data['action'])
+
+	def result(self):
+		self.instance.refresh_from_db(fields=('no_of_followers', 'no_of_following', 'no_of_posts'))
 		message = f'You just {self.validated_data["action"]}ed {self.context["followee"].username} successfully'
-		return {"message": message, "data": UserSerializer(self.instance).data}
+		return {"message": message, "data": UserSerializer(self.instance, context=self.context).data}
+
+	def execute(self):
+		self.apply()
+		self.announce()
+		return self.result()
+
+
+class FollowActionSerializer(Serializer):
+	'''
+		This serializer validates one entry of a bulk follow and unfollow request
+	'''
+	id = serializers.IntegerField(required=True)
+	action = serializers.ChoiceField(choices=['follow', 'unfollow'], required=True)
+
+
+class BulkUserActionSerializer(Serializer):
+	'''
+		This serializer validates and executes many follows and unfollows at once.
+		Every entry gets a status of its own instead of failing the whole request:
+			followed, unfollowed, not_found, self, already_following, not_following or duplicate
+	'''
+	actions = serializers.ListField(child=FollowActionSerializer(), min_length=1, max_length=100)
+
+	def update(self, instance, validated_data):
+		pass
+
+	def create(self, validated_data):
+		pass
+
+	def validate(self, initial_data):
+		ids = {entry['id'] for entry in initial_data['actions']}
+		following = User.followers.through.objects.filter(from_user_id=OuterRef('id'), to_user_id=self.instance.id)
+		states = dict(User.objects.filter(id__in=ids).annotate(is_following=Exists(following)).values_list(
+			'id', 'is_following'))
+		seen = set()
+		for entry in initial_data['actions']:
+			if entry['id'] in seen:
+				entry['status'] = 'duplicate'
+			elif entry['id'] == self.instance.id:
+				entry['status'] = 'self'
+			elif entry['id'] not in states:
+				entry['status'] = 'not_found'
+			elif entry['action'] == 'follow':
+				entry['status'] = 'already_following' if states[entry['id']] else 'followed'
+			else:
+				entry['status'] = 'unfollowed' if states[entry['id']] else 'not_following'
+			seen.add(entry['id'])
+		return initial_data
+
+	def execute(self):
+		Follow = User.followers.through
+		followed = [entry['id'] for entry in self.validated_data['actions'] if entry['status'] == 'followed']
+		unfollowed = [entry['id'] for entry in self.validated_data['actions'] if entry['status'] == 'unfollowed']
+		with transaction.atomic():
+			# Locking the user's row makes their concurrent follows and unfollows wait for this one, so the edges
+			# read below are the ones changed and the counters only count those
+			User.objects.select_for_update().filter(id=self.instance.id).first()
+			edges = Follow.objects.filter(to_user_id=self.instance.id)
+			existing = set(edges.filter(from_user_id__in=followed + unfollowed).values_list('from_user_id', flat=True))
+			followed = [followee_id for followee_id in followed if followee_id not in existing]
+			unfollowed = [followee_id for followee_id in unfollowed if followee_id in existing]
+			if followed:
+				Follow.objects.bulk_create([Follow(from_user_id=followee_id, to_user_id=self.instance.id)
+											for followee_id in followed])
+				User.objects.filter(id__in=followed).update(no_of_followers=F('no_of_followers') + 1)
+			if unfollowed:
+				deleted = edges.filter(from_user_id__in=unfollowed).delete()[0]
+				if deleted != len(unfollowed):
+					raise Exception('The follows changed while they were being updated, please try again')
+				User.objects.filter(id__in=unfollowed).update(no_of_followers=F('no_of_followers') - 1)
+			if followed or unfollowed:
+				User.adjust_counters(self.instance.id, no_of_following=len(followed) - len(unfollowed))
+		# Entries another request applied since validation did not change anything here
+		for entry in self.validated_data['actions']:
+			if entry['status'] == 'followed' and entry['id'] not in followed:
+				entry['status'] = 'already_following'
+			elif entry['status'] == 'unfollowed' and entry['id'] not in unfollowed:
+				entry['status'] = 'not_following'
+		get_follow_graph().update(self.instance.id, followed, 'follow')
+		get_follow_graph().update(self.instance.id, unfollowed, 'unfollow')
+		from Post.events import follow_changed
+		if followed:
+			follow_changed(self.instance, followed, 'follow')
+		if unfollowed:
+			follow_changed(self.instance, unfollowed, 'unfollow')
+		return {
+			'message': f'You just followed {len(followed)} and unfollowed {len(unfollowed)} users',
+			'data': {'results': [dict(id=entry['id'], action=entry['action'], status=entry['status'])
+								 for entry in self.validated_data['actions']]}
+		}
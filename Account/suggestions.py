@@ -0,0 +1,91 @@
+from django.conf import settings
+
+from Account.models import User
+
+SUGGESTION_LIMIT = getattr(settings, 'SUGGESTION_LIMIT', 20)
+# How much a shared follower counts next to a followee that follows the candidate
+FOLLOWER_WEIGHT = 0.5
+
+
+def read_edges(chunk_size=100000):
+	'''
+		Streams the follow through table into two arrays, the follower and the followee of each edge
+	:return:
+	'''
+	import numpy as np
+	Follow = User.followers.through
+	chunks, chunk = [], []
+	for edge in Follow.objects.order_by().values_list('to_user_id', 'from_user_id').iterator(chunk_size=chunk_size):
+		chunk.append(edge)
+		if len(chunk) == chunk_size:
+			chunks.append(np.array(chunk, dtype=np.int64))
+			chunk = []
+	if chunk:
+		chunks.append(np.array(chunk, dtype=np.int64))
+	edges = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+	return edges[:, 0], edges[:, 1]
+
+
+def adjacency(followers, followees):
+	'''
+		Builds the sparse follow matrix, row i has a 1 in column j when user ids[i] follows user ids[j].
+		Returns the sorted user IDs and the matrix
+	:return:
+	'''
+	import numpy as np
+	from scipy import sparse
+	ids = np.unique(np.concatenate([followers, followees]))
+	matrix = sparse.csr_matrix((np.ones(len(followers), dtype=np.float32),
+								(np.searchsorted(ids, followers), np.searchsorted(ids, followees))),
+							   shape=(len(ids), len(ids)))
+	matrix.data[:] = 1
+	return ids, matrix
+
+
+def pair_keys(coo, offset, width):
+	'''
+		Encodes the (row, column) cells of a block of the matrix as single integers, rows are offset to the whole matrix
+	:return:
+	'''
+	return (coo.row.astype('int64') + offset) * width + coo.col
+
+
+def lookup(keys, table_keys, table_values):
+	'''
+		The values of the given keys in a (keys, values) table, 0 for keys that are not in it
+	:return:
+	'''
+	import numpy as np
+	if not len(table_keys):
+		return np.zeros(len(keys), dtype=table_values.dtype)
+	order = np.argsort(table_keys)
+	table_keys, table_values = table_keys[order], table_values[order]
+	found = np.searchsorted(table_keys, keys).clip(max=len(table_keys) - 1)
+	return np.where(table_keys[found] == keys, table_values[found], 0)
+
+
+def top_suggestions(matrix, limit=SUGGESTION_LIMIT, block_size=2000):
+	'''
+		Scores every user the follower could follow and yields the best `limit` per follower, a block of followers
+		at a time, as arrays of (follower index, candidate index, score, mutual).
+		A candidate scores one per followee of the follower that follows them (mutual, friends of friends) and
+		FOLLOWER_WEIGHT per user that follows both of them (common neighbours). Users the follower already follows
+		and the follower themself are left out
+	:return:
+	'''
+	import numpy as np
+	size = matrix.shape[0]
+	followed_by = matrix.T.tocsr()
+	for start in range(0, size, block_size):
+		block = matrix[start:start + block_size]
+		friends = (block @ matrix).tocoo()
+		scores = (friends + FOLLOWER_WEIGHT * (followed_by[start:start + block_size] @ matrix)).tocoo()
+		keys = pair_keys(scores, start, size)
+		keep = (scores.row + start != scores.col) & ~np.isin(keys, pair_keys(block.tocoo(), start, size))
+		rows, cols, values, keys = scores.row[keep] + start, scores.col[keep], scores.data[keep], keys[keep]
+		# Sort each follower's candidates by score and keep the first `limit`
+		order = np.lexsort((cols, -values, rows))
+		rows, cols, values, keys = rows[order], cols[order], values[order], keys[order]
+		top = np.arange(len(rows)) - np.searchsorted(rows, rows) < limit
+		mutual = lookup(keys[top], pair_keys(friends, start, size), friends.data)
+		yield rows[top], cols[top], values[top], mutual.astype(np.int64)
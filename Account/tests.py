@@ -1,3 +1,353 @@
-from django.test import TestCase
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from Account.graph import get_follow_graph
+from Account.models import User
+from Post.models import Post
 
 # Create your tests here.
+
+TEST_SETTINGS = dict(
+	CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+	TIMELINE_BACKEND='local',
+	FOLLOW_GRAPH_BACKEND='local',
+	STREAM_BACKEND='local',
+	METRICS_BACKEND='local',
+)
+
+
+@override_settings(**TEST_SETTINGS)
+class AccountTestCase(TestCase):
+	'''
+		The base test case for account tests, it runs against the local cache and timeline stand-ins
+	'''
+
+	def setUp(self):
+		from Post.timeline import get_timeline_store
+		cache.clear()
+		get_timeline_store().clear()
+		get_follow_graph().clear()
+		self.user = User.objects.create_user(username='user', password='password')
+		self.other = User.objects.create_user(username='other', password='password')
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+
+	def action(self, followee, action):
+		return self.client.post(f'/user/{followee.id}/action/', {'action': action}, format='multipart')
+
+
+class CounterTest(AccountTestCase):
+
+	def counters(self, user):
+		user.refresh_from_db()
+		return user.no_of_followers, user.no_of_following, user.no_of_posts
+
+	def test_follow_and_unfollow_update_counters(self):
+		response = self.action(self.other, 'follow')
+		self.assertEqual(response.data['data']['no_of_following'], 1)
+		self.assertEqual(self.counters(self.user), (0, 1, 0))
+		self.assertEqual(self.counters(self.other), (1, 0, 0))
+		self.action(self.other, 'unfollow')
+		self.assertEqual(self.counters(self.user), (0, 0, 0))
+		self.assertEqual(self.counters(self.other), (0, 0, 0))
+
+	def test_post_create_and_delete_update_counters(self):
+		from Post.serializer import AddPostSerializer
+		serializer = AddPostSerializer(data={'text': 'hello'}, context={'user': self.user})
+		serializer.is_valid(raise_exception=True)
+		post = serializer.save()
+		self.assertEqual(self.counters(self.user), (0, 0, 1))
+		self.client.delete(f'/post/{post.id}/')
+		self.assertEqual(self.counters(self.user), (0, 0, 0))
+
+	def test_reconcile_counters_fixes_drift(self):
+		self.other.followers.add(self.user)
+		Post.objects.create(poster=self.user, text='hello')
+		User.objects.filter(id=self.other.id).update(no_of_followers=7)
+		output = StringIO()
+		call_command('reconcile_counters', chunk_size=1, stdout=output)
+		self.assertIn('2 had drifted counters', output.getvalue())
+		self.assertEqual(self.counters(self.user), (0, 1, 1))
+		self.assertEqual(self.counters(self.other), (1, 0, 0))
+
+	def test_counters_migration_backfills_existing_rows(self):
+		from importlib import import_module
+		from types import SimpleNamespace
+		from django.apps import apps
+		from django.db import connection
+		migration = import_module('Account.migrations.0003_user_counters')
+		self.other.followers.add(self.user)
+		Post.objects.create(poster=self.user, text='hello')
+		User.objects.update(no_of_followers=0, no_of_following=0, no_of_posts=0)
+		with mock.patch.object(migration, 'BACKFILL_CHUNK_SIZE', 1):
+			migration.backfill_counters(apps, SimpleNamespace(connection=connection))
+		self.assertEqual(self.counters(self.user), (0, 1, 1))
+		self.assertEqual(self.counters(self.other), (1, 0, 0))
+
+
+class BulkActionTest(AccountTestCase):
+
+	def bulk(self, *actions):
+		return self.client.post('/user/actions/', {'actions': [dict(id=user_id, action=action)
+															   for user_id, action in actions]}, format='json')
+
+	def test_bulk_follow_and_unfollow(self):
+		users = [User.objects.create_user(username=f'suggested{index}', password='password') for index in range(3)]
+		Post.objects.create(poster=users[0], text='hello')
+		self.action(self.other, 'follow')
+		response = self.bulk(*[(user.id, 'follow') for user in users], (self.other.id, 'unfollow'))
+		self.assertEqual([result['status'] for result in response.data['data']['results']],
+						 ['followed', 'followed', 'followed', 'unfollowed'])
+		self.assertEqual(sorted(self.user.following().values_list('id', flat=True)), [user.id for user in users])
+		self.user.refresh_from_db()
+		self.assertEqual(self.user.no_of_following, 3)
+		self.assertEqual([User.objects.get(id=user.id).no_of_followers for user in users + [self.other]], [1, 1, 1, 0])
+		following = self.client.get('/post/?choice=following').data['results']
+		self.assertEqual([post['text'] for post in following], ['hello'])
+
+	def test_bulk_counts_only_the_edges_it_changed(self):
+		from Account.serializer import BulkUserActionSerializer
+		serializer = BulkUserActionSerializer(data={'actions': [dict(id=self.other.id, action='follow')]},
+											  instance=self.user)
+		serializer.is_valid(raise_exception=True)
+		# Another request follows between validation and execution
+		self.action(self.other, 'follow')
+		result = serializer.execute()
+		self.assertEqual([entry['status'] for entry in result['data']['results']], ['already_following'])
+		self.user.refresh_from_db()
+		self.other.refresh_from_db()
+		self.assertEqual((self.user.no_of_following, self.other.no_of_followers), (1, 1))
+
+	def test_bulk_reports_invalid_entries(self):
+		self.action(self.other, 'follow')
+		response = self.bulk((self.other.id, 'follow'), (self.user.id, 'follow'), (999, 'follow'),
+							 (self.other.id, 'unfollow'))
+		self.assertEqual([result['status'] for result in response.data['data']['results']],
+						 ['already_following', 'self', 'not_found', 'duplicate'])
+		self.user.refresh_from_db()
+		self.assertEqual(self.user.no_of_following, 1)
+
+	def test_bulk_validates_in_one_query(self):
+		users = [User.objects.create_user(username=f'suggested{index}', password='password') for index in range(50)]
+		with self.assertNumQueries(1):
+			from Account.serializer import BulkUserActionSerializer
+			serializer = BulkUserActionSerializer(data={'actions': [dict(id=user.id, action='follow') for user in users]},
+												  instance=self.user)
+			serializer.is_valid(raise_exception=True)
+
+
+class FollowGraphTest(AccountTestCase):
+
+	def test_graph_answers_relationship_queries(self):
+		third = User.objects.create_user(username='third', password='password')
+		self.action(self.other, 'follow')
+		self.action(third, 'follow')
+		self.client.force_authenticate(self.other)
+		self.action(self.user, 'follow')
+		self.action(third, 'follow')
+		graph = get_follow_graph()
+		for user in (self.user, self.other, third):
+			graph.mutual(user.id)
+		with self.assertNumQueries(0):
+			self.assertTrue(graph.follows(self.user.id, self.other.id))
+			self.assertFalse(graph.follows(third.id, self.user.id))
+			self.assertEqual(graph.mutual(self.user.id), {self.other.id})
+			self.assertEqual(graph.common_followers(third.id, self.other.id), {self.user.id})
+			self.assertEqual(graph.followed_by(self.user.id, third.id), {self.other.id})
+
+	def test_graph_follows_edge_changes(self):
+		graph = get_follow_graph()
+		self.assertEqual(graph.followers(self.other.id), set())
+		self.action(self.other, 'follow')
+		self.assertEqual(graph.followers(self.other.id), {self.user.id})
+		self.assertEqual(list(self.user.following()), [self.other])
+		self.action(self.other, 'unfollow')
+		self.assertEqual(graph.followers(self.other.id), set())
+		self.assertEqual(graph.following(self.user.id), set())
+
+	def test_a_load_raced_by_a_follow_is_not_kept(self):
+		from Account import graph as graph_module
+		graph = get_follow_graph()
+		load_ids = graph_module.load_ids
+
+		def racing_load(kind, user_id):
+			ids = load_ids(kind, user_id)
+			self.other.followers.add(self.user)
+			graph.update(self.user.id, [self.other.id], 'follow')
+			return ids
+
+		with mock.patch.object(graph_module, 'load_ids', racing_load):
+			self.assertEqual(graph.followers(self.other.id), set())
+		self.assertEqual(graph.followers(self.other.id), {self.user.id})
+
+	def test_following_filters_with_a_subquery(self):
+		self.action(self.other, 'follow')
+		self.assertIn('SELECT', str(self.user.following().query).split(' IN ', 1)[1])
+		self.assertEqual(list(self.user.following()), [self.other])
+
+
+class FastSerializerTest(AccountTestCase):
+
+	def test_output_is_byte_identical(self):
+		from rest_framework.renderers import JSONRenderer
+		from Account.serializer import BasicUserSerializer, UserSerializer
+		from Utilities.fast_serializer import get_fast_serializer
+		self.action(self.other, 'follow')
+		User.objects.filter(id=self.other.id).update(first_name='\u00c9mile', is_active=False)
+		users = User.objects.order_by('id')
+		for serializer_class in (BasicUserSerializer, UserSerializer):
+			self.assertEqual(JSONRenderer().render(get_fast_serializer(serializer_class).queryset(users)),
+							 JSONRenderer().render(serializer_class(users, many=True).data))
+		with self.assertRaises(TypeError):
+			get_fast_serializer(type('Expanded', (UserSerializer,), {'expandable_fields': ()}))
+
+
+class SuggestionTest(AccountTestCase):
+
+	def test_suggestions_rank_friends_of_friends(self):
+		users = {name: User.objects.create_user(username=name, password='password') for name in ('a', 'b', 'c', 'd')}
+		edges = [(self.user, self.other), (self.user, users['a']), (self.other, users['b']), (users['a'], users['b']),
+				 (users['a'], users['c']), (users['d'], self.user), (users['d'], users['c'])]
+		for follower, followee in edges:
+			followee.followers.add(follower)
+		output = StringIO()
+		call_command('build_suggestions', block_size=2, stdout=output)
+		self.assertIn(f'Read {len(edges)} edges', output.getvalue())
+		with self.assertNumQueries(2):
+			data = self.client.get('/user/suggestions/').data['data']
+		# b is followed by two of the user's followees, c by one of them and by d, who follows the user
+		self.assertEqual([(user['username'], user['score'], user['mutual']) for user in data],
+						 [('b', 2.0, 2), ('c', 1.5, 1)])
+		self.action(users['b'], 'follow')
+		self.assertEqual([user['username'] for user in self.client.get('/user/suggestions/').data['data']], ['c'])
+
+	def test_rebuild_replaces_old_suggestions(self):
+		self.other.followers.add(self.user)
+		third = User.objects.create_user(username='third', password='password')
+		third.followers.add(self.other)
+		call_command('build_suggestions', stdout=StringIO())
+		self.assertEqual([user['id'] for user in self.client.get('/user/suggestions/').data['data']], [third.id])
+		User.followers.through.objects.all().delete()
+		call_command('build_suggestions', stdout=StringIO())
+		self.assertEqual(self.client.get('/user/suggestions/').data['data'], [])
+
+
+class ProfileTest(AccountTestCase):
+
+	def test_profile_is_lean_unless_expanded(self):
+		self.action(self.other, 'follow')
+		data = self.client.get('/user/').data['data']
+		self.assertNotIn('followers', data)
+		self.assertNotIn('following', data)
+		data = self.client.get('/user/?expand=following').data['data']
+		self.assertEqual(data['following'], [{'id': self.other.id, 'username': 'other'}])
+		self.assertNotIn('followers', data)
+
+	def test_follow_lists_are_paginated(self):
+		followers = [User.objects.create_user(username=f'follower{index}', password='password') for index in range(5)]
+		for follower in followers:
+			self.client.force_authenticate(follower)
+			self.action(self.other, 'follow')
+		pages, url = [], f'/user/{self.other.id}/followers/?page_size=2'
+		while url:
+			response = self.client.get(url)
+			pages.append([user['id'] for user in response.data['results']])
+			url = response.data['next']
+		ids = [follower.id for follower in reversed(followers)]
+		self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:]])
+		response = self.client.get(f'/user/{followers[0].id}/following/')
+		self.assertEqual(response.data['results'], [{'id': self.other.id, 'username': 'other'}])
+
+
+class CachedAuthenticationTest(AccountTestCase):
+
+	def setUp(self):
+		super().setUp()
+		from Account import authentication
+		authentication._local.clear()
+		self.client = APIClient()
+		self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.user.tokens()["access"]}')
+
+	def test_principal_is_served_from_cache(self):
+		self.client.get('/post/?choice=mine')
+		with self.assertNumQueries(0):
+			response = self.client.get('/post/?choice=mine')
+		self.assertEqual(response.status_code, 200)
+
+	def test_edit_invalidates_principal(self):
+		self.client.get('/post/?choice=mine')
+		self.client.patch('/user/edit/', {'username': 'renamed'}, format='multipart')
+		with self.assertNumQueries(1):
+			self.client.get('/post/?choice=mine')
+		self.assertEqual(self.client.get('/user/').data['data']['username'], 'renamed')
+
+	def test_saving_auth_fields_invalidates_principal(self):
+		from Account.authentication import auth_version_key
+		self.client.get('/user/')
+		user = User.objects.get(id=self.user.id)
+		with self.captureOnCommitCallbacks(execute=True) as callbacks:
+			user.last_login = timezone.now()
+			user.save(update_fields=['last_login'])
+		self.assertEqual((callbacks, cache.get(auth_version_key(user.id))), ([], None))
+		with self.captureOnCommitCallbacks(execute=True):
+			user.is_active = False
+			user.save()
+		self.assertEqual(self.client.get('/user/').status_code, 401)
+		with self.captureOnCommitCallbacks(execute=True):
+			user.is_active = True
+			user.save()
+		self.assertEqual(self.client.get('/user/').status_code, 200)
+
+	def test_inactive_user_is_rejected(self):
+		User.objects.filter(id=self.user.id).update(is_active=False)
+		self.assertEqual(self.client.get('/user/').status_code, 401)
+
+
+@override_settings(**TEST_SETTINGS)
+class AsyncViewTest(TransactionTestCase):
+	'''
+		The async views query from the thread pool, whose connections only see committed rows
+	'''
+
+	def setUp(self):
+		AccountTestCase.setUp(self)
+
+	def call(self, view_class, actions, method, path, data=None, **kwargs):
+		import json
+		from asgiref.sync import async_to_sync
+		from django.test import AsyncRequestFactory
+		from Utilities.async_views import as_async_view
+		from django.core.handlers.wsgi import LimitedStream
+		request = getattr(AsyncRequestFactory(), method)(path, data or {},
+														 authorization=f'Bearer {self.user.tokens()["access"]}')
+		# Servers hand ASGI requests a body file that can be read past its end, the test payload cannot be
+		request._stream = LimitedStream(request._stream, int(request.META.get('CONTENT_LENGTH') or 0))
+		response = async_to_sync(as_async_view(view_class, actions))(request, **kwargs)
+		return response.status_code, json.loads(response.render().content)
+
+	def test_profile_matches_the_sync_view(self):
+		from Account.views import UserProfile
+		self.client.post(f'/user/{self.other.id}/action/', {'action': 'follow'}, format='multipart')
+		for path in ('/user/', '/user/?expand=following', '/user/?expand=following,followers'):
+			self.assertEqual(self.call(UserProfile, {'get': 'async_get'}, 'get', path),
+							 (200, self.client.get(path).json()))
+
+	def test_follow_and_unfollow(self):
+		from Account.views import ActionUser
+		follow = lambda action: self.call(ActionUser, {'post': 'async_post'}, 'post',
+										  f'/user/{self.other.id}/action/?expand=following', {'action': action},
+										  id=self.other.id)
+		status, body = follow('follow')
+		self.assertEqual((status, body['data']['no_of_following']), (200, 1))
+		self.assertEqual(body['data']['following'], [{'id': self.other.id, 'username': 'other'}])
+		self.assertEqual(follow('follow'), (400, {'status': 'Failed', 'message': 'You are already following this user'}))
+		self.assertEqual(get_follow_graph().followers(self.other.id), {self.user.id})
+		status, body = follow('unfollow')
+		self.assertEqual((status, body['data']['no_of_following'], body['data']['following']), (200, 0, []))
+		self.assertEqual(User.objects.get(id=self.other.id).no_of_followers, 0)
@@ -1,5 +1,6 @@
 # accounts/urls.py
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.urls import path
 # RESTFRAMEWORK imports
@@ -7,6 +8,7 @@ from rest_framework.routers import DefaultRouter
 
 # View and other imports
 from .views import *
+from Utilities.async_views import as_async_view
 
 app_name = 'Account'
 
@@ -21,9 +23,19 @@ urlpatterns = [
     path('user/login/', Login.as_view(),name="login"),
 	path('user/logout/', Logout.as_view(), name="logout"),
 	path('user/edit/', EditUser.as_view(), name="edit_user"),
-	path('user/<int:id>/action/', ActionUser.as_view(), name="user_action")
+	path('user/<int:id>/action/', ActionUser.as_view(), name="user_action"),
+	path('user/actions/', BulkActionUser.as_view(), name="user_bulk_action"),
+	path('user/suggestions/', UserSuggestions.as_view(), name="user_suggestions"),
+	path('user/<int:id>/followers/', UserFollows.as_view(relation='followers'), name="user_followers"),
+	path('user/<int:id>/following/', UserFollows.as_view(relation='following'), name="user_following")
 
 
 ]
 urlpatterns += router.urls
 
+if settings.ASYNC_VIEWS:
+	urlpatterns = [
+		path('user/', as_async_view(UserProfile, {'get': 'async_get'}), name="user_profile"),
+		path('user/<int:id>/action/', as_async_view(ActionUser, {'post': 'async_post'}), name="user_action"),
+	] + urlpatterns
+
@@ -1,14 +1,25 @@
+import asyncio
+
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets, mixins, status
 # Create your views here.
-from rest_framework.parsers import MultiPartParser
+from rest_framework.parsers import MultiPartParser, JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
-from Account.models import User
+from Account.graph import get_follow_graph
+from Account.models import User, Suggestion
 from Account.serializer import SignupSerializer, BasicUserSerializer, LoginSerializer, UpdateUserDetailsSerializer, \
-	UserSerializer, UserActionSerializer
-from Utilities.api_response import api_exception, APISuccess, user_id
+	UserSerializer, UserActionSerializer, BulkUserActionSerializer
+from Account.authentication import bump_auth_version
+from Account.cache import render_users, profile_version_scopes
+from Utilities.api_response import api_exception, APISuccess, user_id, expand_query, get_expand, cursor_query, \
+	page_size_query
+from Utilities.async_views import run_in_thread
+from Utilities.conditional import conditional_response, async_conditional_response
+from Utilities.fast_serializer import get_fast_serializer
+from Utilities.pagination import KeysetPagination
+from Utilities.replicas import ReplicaReadsMixin
 
 
 class Signup(mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -34,10 +45,10 @@ class Login(APIView):
 	parser_classes = (MultiPartParser,)
 	http_method_names = ('post', )
 
-	@swagger_auto_schema(request_body=LoginSerializer)
+	@swagger_auto_schema(request_body=LoginSerializer, manual_parameters=[expand_query])
 	@api_exception
 	def post(self, request, *args, **kwargs):
-		serializer = LoginSerializer(data=request.data)
+		serializer = LoginSerializer(data=request.data, context={'expand': get_expand(request)})
 		serializer.is_valid(raise_exception=True)
 		data = serializer.login(request)
 		return APISuccess(message='Login successful', data=data)
@@ -51,12 +62,14 @@ class EditUser(APIView):
 	permission_classes = (IsAuthenticated, )
 	http_method_names = ('patch',)
 
-	@swagger_auto_schema(request_body=UpdateUserDetailsSerializer)
+	@swagger_auto_schema(request_body=UpdateUserDetailsSerializer, manual_parameters=[expand_query])
 	@api_exception
 	def patch(self, request, *args, **kwargs):
-		serializer = UpdateUserDetailsSerializer(data=request.data, instance=request.user, partial=True)
+		serializer = UpdateUserDetailsSerializer(data=request.data, instance=User.objects.get(pk=request.user.pk),
+												 partial=True, context={'expand': get_expand(request)})
 		serializer.is_valid(raise_exception=True)
 		data = serializer.execute()
+		bump_auth_version(request.user.pk)
 		return APISuccess(message='User Detail Updated Successfully', data=data)
 
 
@@ -68,27 +81,138 @@ class ActionUser(APIView):
 	permission_classes = (IsAuthenticated,)
 	http_method_names = ('post', )
 
-	@swagger_auto_schema(request_body=UserActionSerializer, manual_parameters=[user_id])
+	@swagger_auto_schema(request_body=UserActionSerializer, manual_parameters=[user_id, expand_query])
 	@api_exception
 	def post(self, request, *args, **kwargs):
-		serializer = UserActionSerializer(data=request.data, instance=request.user)
+		serializer = UserActionSerializer(data=request.data, instance=User.objects.get(pk=request.user.pk),
+										  context={'expand': get_expand(request)})
 		serializer.context['followee'] = kwargs['id']
 		serializer.is_valid(raise_exception=True)
 		data = serializer.execute()
 		return APISuccess(**data)
 
+	@api_exception
+	async def async_post(self, request, *args, **kwargs):
+		'''
+			The follow of the ASGI deployment, the full user is loaded while the action is validated and the timeline,
+			feed and stream updates run while the response is built
+		:return:
+		'''
+		data = await run_in_thread(lambda: request.data)
+		serializer = UserActionSerializer(data=data, instance=request.user, context={'expand': get_expand(request)})
+		serializer.context['followee'] = kwargs['id']
+		_, serializer.instance = await asyncio.gather(run_in_thread(serializer.is_valid, raise_exception=True),
+													  run_in_thread(User.objects.get, pk=request.user.pk))
+		await run_in_thread(serializer.apply)
+		_, data = await asyncio.gather(run_in_thread(serializer.announce), run_in_thread(serializer.result))
+		return APISuccess(**data)
+
+
+class BulkActionUser(APIView):
+	'''
+		This view enables a user to follow and unfollow many users in one request, it takes a JSON body like
+		{"actions": [{"id": 2, "action": "follow"}, {"id": 3, "action": "unfollow"}]}
+	'''
+	parser_classes = (JSONParser,)
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('post', )
+
+	@swagger_auto_schema(request_body=BulkUserActionSerializer)
+	@api_exception
+	def post(self, request, *args, **kwargs):
+		serializer = BulkUserActionSerializer(data=request.data, instance=request.user)
+		serializer.is_valid(raise_exception=True)
+		data = serializer.execute()
+		return APISuccess(**data)
+
 
-class UserProfile(APIView):
+class UserProfile(ReplicaReadsMixin, APIView):
 	'''
 		This view allows a user to view his profile details
 	'''
 	permission_classes = (IsAuthenticated,)
 	http_method_names = ('get',)
 
+	@swagger_auto_schema(manual_parameters=[expand_query])
+	@api_exception
+	def get(self, request, *args, **kwargs):
+		def render():
+			expand = get_expand(request)
+			if expand:
+				data = UserSerializer(instance=User.objects.get(pk=request.user.pk), context={'expand': expand}).data
+			else:
+				data = get_fast_serializer(UserSerializer).queryset(User.objects.filter(pk=request.user.pk))[0]
+			return APISuccess(message='user profile retrieved', data=data)
+		expanded = any(field in get_expand(request) for field in UserSerializer.expandable_fields)
+		return conditional_response(request, 'profile', profile_version_scopes(request.user.pk, expanded), render)
+
+	@api_exception
+	async def async_get(self, request, *args, **kwargs):
+		'''
+			The profile of the ASGI deployment, the user's row and expanded lists are queried at the same time
+		:return:
+		'''
+		expand = [field for field in UserSerializer.expandable_fields if field in get_expand(request)]
+		queries = {
+			'followers': lambda: BasicUserSerializer(request.user.followers.all(), many=True).data,
+			'following': lambda: BasicUserSerializer(request.user.following(), many=True).data,
+		}
+
+		async def fetch():
+			return await asyncio.gather(
+				run_in_thread(lambda: get_fast_serializer(UserSerializer).queryset(User.objects.filter(pk=request.user.pk))[0]),
+				*[run_in_thread(queries[field]) for field in expand])
+
+		def render(content):
+			data = dict(content[0], **dict(zip(expand, content[1:])))
+			return APISuccess(message='user profile retrieved', data=data)
+		return await async_conditional_response(
+			request, 'profile', lambda: profile_version_scopes(request.user.pk, bool(expand)), fetch, render)
+
+
+class UserFollows(ReplicaReadsMixin, APIView):
+	'''
+		This view pages through the followers or the followings of a user, highest user ID first
+	'''
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('get',)
+	relation = 'followers'
+
+	def get_keys(self, user_id, position, limit):
+		owner, member = ('from_user_id', 'to_user_id') if self.relation == 'followers' else ('to_user_id', 'from_user_id')
+		follows = User.followers.through.objects.filter(**{owner: user_id})
+		if position is not None:
+			follows = follows.filter(**{f'{member}__lt': position[0]})
+		return [(member_id,) for member_id in follows.order_by(f'-{member}').values_list(member, flat=True)[:limit]]
+
+	@swagger_auto_schema(manual_parameters=[user_id, cursor_query, page_size_query])
+	@api_exception
+	def get(self, request, *args, **kwargs):
+		if not User.objects.filter(id=kwargs['id']).exists():
+			raise Exception(f'No User exists with this ID "{kwargs["id"]}"')
+		paginator = KeysetPagination()
+		paginator.key_length = 1
+		keys = paginator.paginate_keys(lambda position, limit: self.get_keys(kwargs['id'], position, limit), request)
+		users = render_users([key[0] for key in keys])
+		return paginator.get_paginated_response([users[key[0]] for key in keys if key[0] in users])
+
+
+class UserSuggestions(ReplicaReadsMixin, APIView):
+	'''
+		This view returns the users that the user may want to follow, best first.
+		Suggestions are rebuilt offline by `manage.py build_suggestions`, users followed since are left out
+	'''
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('get',)
+
 	@api_exception
 	def get(self, request, *args, **kwargs):
-		serializer = UserSerializer(instance=request.user)
-		return APISuccess(message='user profile retrieved', data=serializer.data)
+		following = get_follow_graph().following(request.user.id)
+		suggestions = Suggestion.objects.filter(user_id=request.user.id).order_by('-score').values_list(
+			'suggested_id', 'suggested__username', 'score', 'mutual')
+		data = [dict(id=suggested_id, username=username, score=score, mutual=mutual)
+				for suggested_id, username, score, mutual in suggestions if suggested_id not in following]
+		return APISuccess(message='suggestions retrieved', data=data)
 
 
 class Logout(APIView):
@@ -101,5 +225,6 @@ class Logout(APIView):
 	@api_exception
 	def post(self, request, *args, **kwargs):
 		from django.contrib import auth
+		bump_auth_version(request.user.pk)
 		auth.logout(request)
 		return APISuccess(message="user logged out successfully")
\ No newline at end of file
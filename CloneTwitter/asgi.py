@@ -0,0 +1,33 @@
+"""
+ASGI config for CloneTwitter project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Requests for the post stream are served by its own ASGI application, which holds long-lived connections without
+tying up a worker, everything else goes to Django. The API is served by the WSGI `web` process by default, and
+the Procfile's `stream` process serves this application with
+`gunicorn CloneTwitter.asgi:application --worker-class uvicorn.workers.UvicornWorker`. The proxy in front of them
+must send /post/stream/ to the `stream` process, the WSGI application cannot hold the stream open and answers it
+with a 404. Serving all of the API from here is an opt-in, setting ASYNC_VIEWS as well serves the feed, profile
+and follow endpoints with their async views.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CloneTwitter.settings')
+
+django_application = get_asgi_application()
+
+from Post.stream import stream_application  # noqa: E402, imported once Django is set up
+
+STREAM_PATH = '/post/stream/'
+
+
+async def application(scope, receive, send):
+	if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+		return await stream_application(scope, receive, send)
+	return await django_application(scope, receive, send)
@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+	'Utilities.middleware.MetricsMiddleware',
+	'Utilities.middleware.ReplicaMiddleware',
 	'django.middleware.security.SecurityMiddleware',
 	'django.contrib.sessions.middleware.SessionMiddleware',
 	'django.middleware.common.CommonMiddleware',
@@ -92,6 +94,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'CloneTwitter.wsgi.application'
+ASGI_APPLICATION = 'CloneTwitter.asgi.application'
+# Serves the feed, profile and follow endpoints with async views under ASGI. Off by default, the sync views answer
+# about twice the requests per CPU second
+ASYNC_VIEWS = config('ASYNC_VIEWS', False, cast=bool)
 
 CORS_ORIGIN_ALLOW_ALL = True
 
@@ -101,13 +107,20 @@ REST_FRAMEWORK = {
 
 	'DEFAULT_AUTHENTICATION_CLASSES': (
 
-		'rest_framework_simplejwt.authentication.JWTAuthentication',
+		'Account.authentication.CachedJWTAuthentication',
 		# 'allauth.account.auth_backends.AuthenticationBackend',
 	)
 }
 
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 REST_USE_JWT = True
 
+# How long a resolved JWT user is cached in redis and in each process, in seconds
+AUTH_CACHE_TTL = 300
+AUTH_LOCAL_TTL = 5
+
 SIMPLE_JWT = {
 	'ACCESS_TOKEN_LIFETIME': timedelta(days=2),
 	'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -222,19 +235,82 @@ USE_X_FORWARDED_HOST = True
 
 CACHES = {
 	'default': {
-		'BACKEND': 'django_redis.cache.RedisCache',
-		'LOCATION': config('REDISCLOUD_URL', 'redis://127.0.0.1:6379'),
+		'BACKEND': 'Utilities.local_cache.TwoTierCache',
 		'OPTIONS': {
-			'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+			'REMOTE': {
+				'BACKEND': 'django_redis.cache.RedisCache',
+				'LOCATION': config('REDISCLOUD_URL', 'redis://127.0.0.1:6379'),
+				'OPTIONS': {
+					'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+				}
+			}
 		}
 	}
 }
 
+# LOCAL CACHE TIER
+CACHE_INVALIDATION_BACKEND = config('CACHE_INVALIDATION_BACKEND', 'redis')
+LOCAL_CACHE_MAX_BYTES = config('LOCAL_CACHE_MAX_BYTES', 32 * 1024 * 1024, cast=int)
+LOCAL_CACHE_MAX_ENTRY_BYTES = config('LOCAL_CACHE_MAX_ENTRY_BYTES', 256 * 1024, cast=int)
+LOCAL_CACHE_TTL = config('LOCAL_CACHE_TTL', 5, cast=int)
+
+# TIMELINES
+TIMELINE_BACKEND = config('TIMELINE_BACKEND', 'redis')
+TIMELINE_LENGTH = config('TIMELINE_LENGTH', 800, cast=int)
+TIMELINE_FANOUT_LIMIT = config('TIMELINE_FANOUT_LIMIT', 5000, cast=int)
+FEED_CACHE_LENGTH = config('FEED_CACHE_LENGTH', 800, cast=int)
+
+# CACHE STAMPEDES
+STAMPEDE_LOCK_TIMEOUT = config('STAMPEDE_LOCK_TIMEOUT', 10, cast=int)
+STAMPEDE_WAIT = config('STAMPEDE_WAIT', 2, cast=float)
+STAMPEDE_STALE = config('STAMPEDE_STALE', 60, cast=int)
+STAMPEDE_BETA = config('STAMPEDE_BETA', 1.0, cast=float)
+
+# FOLLOW GRAPH
+FOLLOW_GRAPH_BACKEND = config('FOLLOW_GRAPH_BACKEND', 'redis')
+FOLLOW_GRAPH_TTL = config('FOLLOW_GRAPH_TTL', 24 * 60 * 60, cast=int)
+SUGGESTION_LIMIT = config('SUGGESTION_LIMIT', 20, cast=int)
+
+# TRENDS
+TRENDS_BACKEND = config('TRENDS_BACKEND', 'redis')
+TRENDS_HALF_LIFE = config('TRENDS_HALF_LIFE', 60 * 60, cast=int)
+TRENDS_SIZE = config('TRENDS_SIZE', 10, cast=int)
+TRENDS_CAPACITY = config('TRENDS_CAPACITY', 1000, cast=int)
+TRENDS_COMPACT_INTERVAL = config('TRENDS_COMPACT_INTERVAL', 60, cast=int)
+
+# STREAM
+STREAM_BACKEND = config('STREAM_BACKEND', 'redis')
+STREAM_HEARTBEAT = config('STREAM_HEARTBEAT', 15, cast=int)
+STREAM_QUEUE_SIZE = config('STREAM_QUEUE_SIZE', 100, cast=int)
+
+# IMAGES
+IMAGE_QUEUE_BACKEND = config('IMAGE_QUEUE_BACKEND', 'redis')
+IMAGE_WORKERS = config('IMAGE_WORKERS', 2, cast=int)
+MAX_IMAGE_BYTES = config('MAX_IMAGE_BYTES', 20 * 1024 * 1024, cast=int)
+MAX_IMAGE_PIXELS = config('MAX_IMAGE_PIXELS', 50000000, cast=int)
+
+# METRICS
+METRICS_BACKEND = config('METRICS_BACKEND', 'redis')
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', 10, cast=int)
+METRICS_TOKEN = config('METRICS_TOKEN', None)
+
 import dj_database_url
 
 prod_db = dj_database_url.config()
 DATABASES['default'].update(prod_db)
 
+# READ REPLICAS
+# Comma separated URLs of read replicas of the default database, e.g sqlite:///replica.sqlite3
+for index, url in enumerate(config('DATABASE_REPLICA_URLS', '', cast=Csv())):
+	DATABASES[f'replica_{index}'] = dict(dj_database_url.parse(url, conn_max_age=600), TEST={'MIRROR': 'default'})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica_')]
+DATABASE_ROUTERS = ['Utilities.replicas.ReplicaRouter']
+REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', 10, cast=int)
+
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
-django_heroku.settings(locals())
\ No newline at end of file
+django_heroku.settings(locals())
+
+# django_heroku puts WhiteNoise first, its async capable subclass keeps ASGI requests on the event loop
+MIDDLEWARE = ['Utilities.middleware.StaticFilesMiddleware' if name == 'whitenoise.middleware.WhiteNoiseMiddleware' else name
+			  for name in MIDDLEWARE]
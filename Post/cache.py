@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from Account.cache import user_cache_key, render_users
+from Account.graph import get_follow_graph
+from Post.models import Post
+from Post.serializer import PostSerializer
+from Post.timeline import get_timeline_store
+from Utilities.api_response import CACHE_TTL
+from Utilities.cache import get_or_compute, store_many
+from Utilities.fast_serializer import get_fast_serializer
+from Utilities.metrics import count_lookups
+from Utilities.pagination import queryset_keys
+
+FEED_CACHE_LENGTH = getattr(settings, 'FEED_CACHE_LENGTH', 800)
+
+
+def feed_cache_key(choice, user_id):
+	'''
+		The cache key of a feed's ordered ID list, the `all` feed is the same for everybody so it is shared
+	:return:
+	'''
+	if choice == 'all':
+		return 'all_posts_shared'
+	return f'{choice}_posts_{user_id}'
+
+
+def feed_version_scopes(choice, user_id):
+	'''
+		The version scopes a feed's content depends on: its own and, for `following`, the posts of heavy followees,
+		which are not fanned out. Edits to the posts and posters it shows bump its own scope
+	:return:
+	'''
+	scopes = [feed_cache_key(choice, user_id)]
+	if choice == 'following':
+		heavy = get_timeline_store().heavy_users()
+		if heavy:
+			scopes += [feed_cache_key('mine', followee) for followee in heavy & get_follow_graph().following(user_id)]
+	return scopes
+
+
+def post_cache_key(post_id):
+	return f'post_{post_id}'
+
+
+def cached_feed_keys(cache_key, queryset, position, limit):
+	'''
+		Returns the next `limit` (microseconds, id) keys of a feed after position.
+		The newest FEED_CACHE_LENGTH keys are cached as a list, recomputed by one request at a time when they expire
+		or are invalidated, deeper pages are read from the database
+	:return:
+	'''
+	keys = get_or_compute(cache_key, lambda: queryset_keys(queryset, None, FEED_CACHE_LENGTH), timeout=CACHE_TTL)
+	page = [key for key in keys if position is None or key < position][:limit]
+	if len(page) < limit and len(keys) >= FEED_CACHE_LENGTH:
+		page += queryset_keys(queryset, page[-1] if page else position, limit - len(page))
+	return page
+
+
+def render_posts(post_ids, request=None):
+	'''
+		Returns the PostSerializer payloads of these posts in order, built from the shared per-post and per-user
+		cache entries. Posts that no longer exist are skipped
+	:return:
+	'''
+	entries = cache.get_many([post_cache_key(post_id) for post_id in post_ids])
+	count_lookups([post_cache_key(post_id) for post_id in post_ids], entries)
+	missing = [post_id for post_id in post_ids if post_cache_key(post_id) not in entries]
+	known_users = {}
+
+	def load():
+		fresh = {}
+		for data in get_fast_serializer(PostSerializer).queryset(Post.objects.filter(id__in=missing)):
+			# The posters are used for this response, they are cached by render_users which checks their edits
+			known_users[user_cache_key(data['poster']['id'])] = data['poster']
+			data['poster'] = data['poster']['id']
+			fresh[post_cache_key(data['id'])] = data
+		return fresh
+
+	if missing:
+		# A post edited while it is read is not cached, its edit already dropped the entry and bumped the versions
+		entries.update(store_many([post_cache_key(post_id) for post_id in missing], load, timeout=CACHE_TTL))
+	posts = [entries[post_cache_key(post_id)] for post_id in post_ids if post_cache_key(post_id) in entries]
+	users = render_users(list({post['poster'] for post in posts}), known_users)
+	data = []
+	for post in posts:
+		post = dict(post, poster=users.get(post['poster']))
+		if request is not None:
+			if post['image']:
+				post['image'] = request.build_absolute_uri(post['image'])
+			post['renditions'] = {name: request.build_absolute_uri(url) for name, url in post['renditions'].items()}
+		data.append(post)
+	return data
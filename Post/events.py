@@ -0,0 +1,96 @@
+from Account.cache import user_cache_key, profile_scope, listed_users_scope, ALL_LISTED_USERS
+from Account.graph import get_follow_graph
+from Post.cache import feed_cache_key, post_cache_key
+from Post.feeds import fan_out_post, fanned_out_followers, retract_post, follow_timeline
+from Post.stream import follow_event, post_event, publish
+from Post.timeline import TIMELINE_FANOUT_LIMIT
+from Post.trends import get_trend_store, post_terms
+from Utilities.cache import invalidate
+from Utilities.conditional import bump_versions
+
+
+def poster_feed_keys(poster_id):
+	'''
+		The cached feeds that list this poster's posts: their own, the shared one and the `followers`
+		feed of everyone they follow
+	:return:
+	'''
+	followees = get_follow_graph().following(poster_id)
+	return [feed_cache_key('mine', poster_id), feed_cache_key('all', None)] + \
+		   [feed_cache_key('followers', followee) for followee in followees]
+
+
+def poster_version_scopes(poster_id, followers):
+	'''
+		The version scopes of every feed showing this poster's posts: the cached feeds and the `following` feed of
+		each follower whose timeline they were fanned out to. Feeds reading a heavy poster depend on their `mine` feed
+	:return:
+	'''
+	return poster_feed_keys(poster_id) + [feed_cache_key('following', follower) for follower in followers]
+
+
+def post_created(post):
+	'''
+		Runs after a post is created: fans it out, counts its trend terms, drops the cached feeds that now miss it,
+		bumps the versions of every feed and profile that changed and streams it to the poster's followers
+	:return:
+	'''
+	followers = fan_out_post(post)
+	get_trend_store().record(post_terms(post.text))
+	feed_keys = poster_feed_keys(post.poster_id)
+	invalidate(feed_keys)
+	bump_versions(poster_version_scopes(post.poster_id, followers) + [profile_scope(post.poster_id)])
+	publish(post_event('created', post.id, post.poster_id))
+
+
+def post_edited(post):
+	'''
+		Runs after a post is edited or its image is processed: drops its rendered cache entry, bumps the versions
+		of the feeds showing it and streams the edit to the poster's followers
+	:return:
+	'''
+	invalidate([post_cache_key(post.id)])
+	bump_versions(poster_version_scopes(post.poster_id, fanned_out_followers(post.poster_id)))
+	publish(post_event('edited', post.id, post.poster_id))
+
+
+def post_deleted(post_id, poster_id):
+	'''
+		Runs after a post is deleted: removes it from timelines, cached feeds and the render cache and streams the
+		deletion to the poster's followers
+	:return:
+	'''
+	followers = retract_post(post_id, poster_id)
+	feed_keys = poster_feed_keys(poster_id)
+	invalidate(feed_keys + [post_cache_key(post_id)])
+	bump_versions(poster_version_scopes(poster_id, followers) + [profile_scope(poster_id)])
+	publish(post_event('deleted', post_id, poster_id))
+
+
+def follow_changed(follower, followee_ids, action):
+	'''
+		Runs after follows or unfollows: updates the follower's timeline, drops the followees' `followers` feeds,
+		bumps the versions of both sides' feeds and profiles and updates which posts the follower's streams receive
+	:return:
+	'''
+	follow_timeline(follower, followee_ids, action)
+	followers_feeds = [feed_cache_key('followers', followee_id) for followee_id in followee_ids]
+	invalidate(followers_feeds)
+	bump_versions(followers_feeds + [feed_cache_key('following', follower.id)] +
+				  [profile_scope(user_id) for user_id in [follower.id] + list(followee_ids)])
+	publish(follow_event(follower.id, followee_ids, action))
+
+
+def user_edited(user):
+	'''
+		Runs after a user edits their details: drops their rendered cache entry and bumps the versions of the
+		feeds showing their posts, of their profile and of the expanded profiles listing them. Like fan-out, the
+		profiles are bumped one by one up to TIMELINE_FANOUT_LIMIT, beyond that every expanded profile is
+	:return:
+	'''
+	invalidate([user_cache_key(user.id)])
+	graph = get_follow_graph()
+	related = graph.followers(user.id) | graph.following(user.id)
+	listed = [listed_users_scope(user_id) for user_id in related] if len(related) <= TIMELINE_FANOUT_LIMIT else \
+		[ALL_LISTED_USERS]
+	bump_versions(poster_version_scopes(user.id, fanned_out_followers(user.id)) + [profile_scope(user.id)] + listed)
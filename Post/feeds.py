@@ -0,0 +1,129 @@
+import heapq
+
+from Account.graph import get_follow_graph
+from Post.cache import feed_cache_key
+from Post.models import Post
+from Post.timeline import get_timeline_store, TIMELINE_LENGTH, TIMELINE_FANOUT_LIMIT
+from Utilities.cache import single_flight
+from Utilities.metrics import count_lookups
+from Utilities.pagination import to_microseconds, queryset_keys
+
+
+def post_score(post):
+	'''
+		The timeline score of a post, its creation time in microseconds
+	:return:
+	'''
+	return to_microseconds(post.date_created)
+
+
+def follower_ids(user_id):
+	return list(get_follow_graph().followers(user_id))
+
+
+def recent_entries(queryset, limit=TIMELINE_LENGTH):
+	return [(post_id, score) for score, post_id in queryset_keys(queryset, None, limit)]
+
+
+def fan_out_post(post):
+	'''
+		Pushes a new post into the home timeline of each of its poster's followers and returns their IDs.
+		Posters with more than TIMELINE_FANOUT_LIMIT followers are marked heavy and are merged in at read time instead
+	:return:
+	'''
+	store = get_timeline_store()
+	if post.poster_id in store.heavy_users():
+		return []
+	followers = follower_ids(post.poster_id)
+	if len(followers) > TIMELINE_FANOUT_LIMIT:
+		store.mark_heavy(post.poster_id)
+		return []
+	store.add(followers, [(post.id, post_score(post))])
+	return followers
+
+
+def fanned_out_followers(poster_id):
+	'''
+		The followers whose home timelines hold this poster's posts, none for heavy posters. A poster who got more
+		than TIMELINE_FANOUT_LIMIT followers since their last post is marked heavy here, as fan_out_post would
+	:return:
+	'''
+	store = get_timeline_store()
+	if poster_id in store.heavy_users():
+		return []
+	followers = follower_ids(poster_id)
+	if len(followers) > TIMELINE_FANOUT_LIMIT:
+		store.mark_heavy(poster_id)
+		return []
+	return followers
+
+
+def retract_post(post_id, poster_id):
+	'''
+		Removes a deleted post from its poster's followers' timelines and returns their IDs.
+		Heavy posters are skipped, their stale entries fall out when the feed is hydrated
+	:return:
+	'''
+	store = get_timeline_store()
+	if poster_id in store.heavy_users():
+		return []
+	followers = follower_ids(poster_id)
+	store.remove(followers, [post_id])
+	return followers
+
+
+def follow_timeline(follower, followee_ids, action):
+	'''
+		Adds the followees' recent posts to the follower's timeline on follow and removes them on unfollow
+	:return:
+	'''
+	store = get_timeline_store()
+	if action == 'follow':
+		followee_ids = [followee_id for followee_id in followee_ids if followee_id not in store.heavy_users()]
+		if followee_ids:
+			store.add([follower.id], recent_entries(Post.objects.filter(poster_id__in=followee_ids)))
+	else:
+		post_ids = Post.objects.filter(poster_id__in=followee_ids).order_by('-date_created').values_list('id', flat=True)
+		store.remove([follower.id], list(post_ids[:TIMELINE_LENGTH]))
+
+
+def rebuild_timeline(user):
+	'''
+		Rebuilds this user's timeline from the database. Callers go through single_flight with the following feed's
+		cache key so that concurrent requests rebuild it once
+	:return:
+	'''
+	get_timeline_store().rebuild(user.id, recent_entries(Post.objects.filter(poster__in=user.following())))
+
+
+def following_keys(user, position, limit):
+	'''
+		Returns the next `limit` (microseconds, id) keys of the posts of the users this user follows.
+		The timeline is one range read and heavy followees are read from the database and merged in
+	:return:
+	'''
+	store = get_timeline_store()
+	built = store.is_built(user.id)
+	# The timeline is the following feed's cache, it is counted under the feed's key
+	key = feed_cache_key('following', user.id)
+	count_lookups([key], [key] if built else [])
+	if not built:
+		single_flight(key, lambda: rebuild_timeline(user))
+	keys = [(score, post_id) for post_id, score in store.range(user.id, position, limit)]
+	heavy = store.heavy_users()
+	if heavy:
+		heavy_followees = list(heavy & get_follow_graph().following(user.id))
+		if heavy_followees:
+			heavy_keys = queryset_keys(Post.objects.filter(poster_id__in=heavy_followees), position, limit)
+			keys = list(dict.fromkeys(heapq.merge(keys, heavy_keys, reverse=True)))
+	return keys[:limit]
+
+
+def hydrate(post_ids):
+	'''
+		Loads the posts with these IDs in one query, in the given order, skipping any that no longer exist
+	:return:
+	'''
+	from Post.serializer import PostSerializer
+	posts = PostSerializer.setup_eager_loading(Post.objects.all()).in_bulk(post_ids)
+	return [posts[post_id] for post_id in post_ids if post_id in posts]
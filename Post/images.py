@@ -0,0 +1,197 @@
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from Post.models import Post
+from Post import uploads  # noqa: F401, sets Pillow's pixel limit before any render
+
+logger = logging.getLogger(__name__)
+
+# name: (longest side in pixels, format, quality)
+RENDITIONS = {
+	'thumbnail': (150, 'JPEG', 70),
+	'thumbnail_webp': (150, 'WEBP', 70),
+	'feed': (600, 'JPEG', 75),
+	'feed_webp': (600, 'WEBP', 75),
+	'full': (2048, 'JPEG', 85),
+	'full_webp': (2048, 'WEBP', 85),
+}
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+QUEUE_KEY = 'image_jobs'
+
+
+def render_image(upload):
+	'''
+		Decodes an image file and re-encodes it into every size and format in RENDITIONS, returning the bytes
+		of each rendition by name.
+		JPEGs are decoded in draft mode straight at the largest size needed, so a large photo is never held at
+		full resolution, and each rendition is scaled down from the previous one. Peak memory is a few
+		decoded copies of the largest rendition rather than of the upload
+	:return:
+	'''
+	from PIL import Image, ImageOps
+	largest = max(size for size, _, _ in RENDITIONS.values())
+	with Image.open(upload) as image:
+		image.draft('RGB', (largest, largest))
+		image.thumbnail((largest, largest))
+		image = ImageOps.exif_transpose(image)
+	if image.mode != 'RGB':
+		image = image.convert('RGB')
+	encoded = {}
+	for name, (size, image_format, quality) in sorted(RENDITIONS.items(), key=lambda item: -item[1][0]):
+		image.thumbnail((size, size))
+		buffer = io.BytesIO()
+		image.save(buffer, image_format, quality=quality, optimize=image_format == 'JPEG')
+		encoded[name] = buffer.getvalue()
+	return encoded
+
+
+def rendition_path(post, name):
+	'''
+		Where a rendition of the post's image is stored. The path includes the image's digest, so the job of an
+		image that was replaced meanwhile never writes over the renditions of the new one
+	:return:
+	'''
+	return f'post/renditions/{post.id}/{post.image_digest or "original"}/{name}.{EXTENSIONS[RENDITIONS[name][1]]}'
+
+
+def delete_files(paths):
+	for path in paths:
+		default_storage.delete(path)
+
+
+def make_renditions(post):
+	'''
+		Renders the post's uploaded image and stores its renditions. Returns the storage path of each by name
+	:return:
+	'''
+	with post.image.open('rb') as upload:
+		encoded = render_image(upload)
+	paths = {}
+	for name, data in encoded.items():
+		path = rendition_path(post, name)
+		if default_storage.exists(path):
+			default_storage.delete(path)
+		paths[name] = default_storage.save(path, ContentFile(data))
+	return paths
+
+
+def claim(post_id):
+	'''
+		Moves a pending post to processing, returns False when another worker got to it first
+	:return:
+	'''
+	return bool(Post.objects.filter(id=post_id, image_status=Post.IMAGE_PENDING).update(
+		image_status=Post.IMAGE_PROCESSING))
+
+
+def process_image(post_id):
+	'''
+		Builds the renditions of a pending post image and publishes them on the post. Whatever goes wrong once the
+		post is claimed marks it failed, it is never left processing
+	:return:
+	'''
+	if not claim(post_id):
+		return
+	post = None
+	try:
+		post = Post.objects.get(id=post_id)
+		renditions, status = make_renditions(post), Post.IMAGE_READY
+	except Exception:
+		logger.exception('Could not process the image of post %s', post_id)
+		renditions, status = {}, Post.IMAGE_FAILED
+	# The image may have been replaced while this one was processed, the new upload is pending again then
+	current = {'image': post.image.name} if post is not None else {}
+	updated = Post.objects.filter(id=post_id, image_status=Post.IMAGE_PROCESSING, **current).update(
+		image_status=status, renditions=renditions)
+	# Renditions of a replaced image are not referenced, unless the new upload is the same image
+	if not updated and renditions and \
+			not Post.objects.filter(id=post_id, image_digest=post.image_digest).exists():
+		delete_files(renditions.values())
+	if post is not None:
+		from Post.events import post_edited
+		post_edited(post)
+
+
+def run_job(post_id):
+	'''
+		Processes one queued image, logging what it raises so that a failed job does not stop its worker
+	:return:
+	'''
+	try:
+		process_image(post_id)
+	except Exception:
+		logger.exception('The image job of post %s failed', post_id)
+
+
+class ImageQueue:
+	'''
+		This queue hands pending post images to the workers. The post row's image_status is the durable job record,
+		the backend only decides how workers hear about it:
+			'redis': job IDs are pushed on a redis list that `manage.py process_images` workers block on
+			'database': `manage.py process_images` workers poll the post table for pending images
+			'thread': an in-process thread pool, for single process runs
+			'sync': the image is processed inline, for tests
+	'''
+
+	def __init__(self, backend):
+		self.backend = backend
+		self.executor = ThreadPoolExecutor(max_workers=getattr(settings, 'IMAGE_WORKERS', 2)) \
+			if backend == 'thread' else None
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection('default')
+
+	def push(self, post_id):
+		if self.backend == 'redis':
+			self.client.lpush(QUEUE_KEY, post_id)
+		elif self.backend == 'thread':
+			self.executor.submit(run_job, post_id)
+		elif self.backend == 'sync':
+			process_image(post_id)
+
+	def pop(self, timeout=5):
+		'''
+			Returns the ID of the next pending post image, or None when there was none within the timeout
+		:return:
+		'''
+		if self.backend == 'redis':
+			job = self.client.brpop(QUEUE_KEY, timeout=timeout)
+			if job is not None:
+				return int(job[1])
+		post_id = Post.objects.filter(image_status=Post.IMAGE_PENDING).order_by('id').values_list(
+			'id', flat=True).first()
+		if post_id is None and self.backend != 'redis':
+			time.sleep(timeout)
+		return post_id
+
+
+_queues = {}
+
+
+def get_image_queue():
+	'''
+		Returns the image queue selected by settings.IMAGE_QUEUE_BACKEND
+	:return:
+	'''
+	backend = getattr(settings, 'IMAGE_QUEUE_BACKEND', 'redis')
+	if backend not in _queues:
+		_queues[backend] = ImageQueue(backend)
+	return _queues[backend]
+
+
+def enqueue_image(post):
+	'''
+		Queues the post's image for processing once the transaction that stored it commits
+	:return:
+	'''
+	if post.image and post.image_status == Post.IMAGE_PENDING:
+		transaction.on_commit(lambda: get_image_queue().push(post.id))
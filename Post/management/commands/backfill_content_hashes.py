@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from Post.models import Post
+from Post.uploads import file_digest
+
+
+class Command(BaseCommand):
+	'''
+		This command fills in the image digest and content hash of posts created before duplicate detection used them.
+		It walks the posts in primary key batches, reading each image in chunks. Posts that duplicate an earlier
+		post keep an empty hash and are reported, the unique index allows only one of them
+	'''
+	help = 'Backfills Post.content_hash and Post.image_digest in batches'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=500, help='The number of posts read per batch')
+
+	def handle(self, *args, **options):
+		filled = duplicates = missing = 0
+		last_id = 0
+		while True:
+			posts = list(Post.objects.filter(id__gt=last_id, content_hash=None).order_by('id').only(
+				'id', 'text', 'image', 'image_digest')[:options['batch_size']])
+			if not posts:
+				break
+			last_id = posts[-1].id
+			for post in posts:
+				image_digest = post.image_digest
+				if post.image and image_digest is None:
+					try:
+						with post.image.open('rb') as image:
+							image_digest = file_digest(image)
+					except (FileNotFoundError, OSError):
+						missing += 1
+						continue
+				try:
+					with transaction.atomic():
+						Post.objects.filter(id=post.id).update(
+							image_digest=image_digest, content_hash=Post.make_content_hash(post.text, image_digest))
+					filled += 1
+				except IntegrityError:
+					duplicates += 1
+		self.stdout.write(f'Backfilled {filled} posts, {duplicates} duplicates and {missing} posts with missing '
+						  f'images were left without a hash')
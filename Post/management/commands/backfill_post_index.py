@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Post.models import Post, PostTag, PostMention
+from Post.tags import tag_rows, mention_rows
+
+
+class Command(BaseCommand):
+	'''
+		This command indexes the hashtags and mentions of posts created before they were indexed on write.
+		It streams the posts in primary key batches, resolves each batch's mentions with one query and writes each
+		batch in one transaction. Rows that already exist are left alone, so it can be run again safely
+	'''
+	help = 'Backfills the hashtag and mention indexes of posts in batches'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=1000, help='The number of posts read per batch')
+
+	def handle(self, *args, **options):
+		posts_read = tags = mentions = 0
+		last_id = 0
+		while True:
+			posts = list(Post.objects.filter(id__gt=last_id).order_by('id').only(
+				'id', 'text', 'date_created')[:options['batch_size']])
+			if not posts:
+				break
+			last_id = posts[-1].id
+			new_tags, new_mentions = tag_rows(posts), mention_rows(posts)
+			with transaction.atomic():
+				PostTag.objects.bulk_create(new_tags, ignore_conflicts=True)
+				PostMention.objects.bulk_create(new_mentions, ignore_conflicts=True)
+			posts_read += len(posts)
+			tags += len(new_tags)
+			mentions += len(new_mentions)
+		self.stdout.write(f'Indexed {tags} hashtags and {mentions} mentions in {posts_read} posts')
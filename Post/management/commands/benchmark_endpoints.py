@@ -0,0 +1,342 @@
+import json
+import subprocess
+import time
+from contextlib import ExitStack
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.urls import URLPattern
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Account.graph import get_follow_graph
+from Account.models import User
+from Post.management.commands.seed_dataset import USERNAME_PREFIX, SEED_PASSWORD, WORDS
+from Post.models import Post, PostTag, PostMention
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, percent):
+	values = sorted(values)
+	return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+def endpoint_names():
+	'''
+		The names of the URL patterns of the Account and Post apps, each is an endpoint the suite should drive.
+		The stream has its own benchmark, benchmark_stream, its WSGI pattern only points clients to the stream process
+	:return:
+	'''
+	return {pattern.name for urlconf in ('Account.urls', 'Post.urls') for pattern in import_module(urlconf).urlpatterns
+			if isinstance(pattern, URLPattern) and pattern.name and pattern.name not in ('api-root', 'stream_posts')}
+
+
+class QueryCounter:
+	'''
+		Counts the queries run on every database connection, without the cost of recording their SQL
+	'''
+
+	def __init__(self):
+		self.count = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		self.count += 1
+		return execute(sql, params, many, context)
+
+	def __enter__(self):
+		self.stack = ExitStack()
+		for connection in connections.all():
+			self.stack.enter_context(connection.execute_wrapper(self))
+		return self
+
+	def __exit__(self, *exc_info):
+		self.stack.close()
+
+
+class Scenario:
+	'''
+		One endpoint under load. `build(index, member)` returns the (method, path, data, format) of its index-th
+		request, made as `member`, `record(member, response)` sees each response and `cleanup()` undoes what the
+		requests changed
+	'''
+
+	def __init__(self, name, url_name, build, record=None, cleanup=None, anonymous=False):
+		self.name = name
+		self.url_name = url_name
+		self.build = build
+		self.record = record or (lambda member, response: None)
+		self.cleanup = cleanup or (lambda: None)
+		self.anonymous = anonymous
+
+
+class Member:
+	'''
+		A seeded user making requests, with its own authenticated client and the state its writes left behind
+	'''
+
+	def __init__(self, user, host):
+		self.user = user
+		self.client = APIClient(SERVER_NAME=host)
+		self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+		self.following = set(get_follow_graph().following(user.id))
+		self.followed = False
+		self.bulk_followed = False
+		self.edited = False
+		self.posts = []
+
+	def request(self, method, path, data=None, format=None):
+		return getattr(self.client, method)(path, data, format=format)
+
+
+class Command(BaseCommand):
+	'''
+		This command drives every endpoint of the Account and Post apps through the Django request handler, as a
+		sample of the users seeded by seed_dataset, and reports the p50, p95 and p99 latency, the database queries
+		per request and the bytes per response of each. Reads run first, then writes, whose changes are undone after
+		each endpoint. The results and the settings they ran under are saved as JSON, pass an earlier file to
+		--compare to see what changed
+	'''
+	help = 'Benchmarks the latency, queries and response size of every endpoint on a seeded dataset'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--requests', type=int, default=100, help='Measured requests per endpoint')
+		parser.add_argument('--warmup', type=int, default=10, help='Requests per endpoint made before measuring')
+		parser.add_argument('--users', type=int, default=20, help='The seeded users the requests are spread over')
+		parser.add_argument('--endpoints', nargs='+', help='Only run these endpoints')
+		parser.add_argument('--prefix', default=USERNAME_PREFIX, help='The prefix of the seeded usernames')
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--output', default='benchmark_endpoints.json', help='Where the JSON results are written')
+		parser.add_argument('--compare', help='The JSON results of an earlier run to compare with')
+
+	def handle(self, *args, **options):
+		import numpy as np
+		seeded = list(User.objects.filter(username__startswith=options['prefix']).exclude(
+			username__startswith=f'{options["prefix"]}bench_').order_by('id').values_list('id', flat=True))
+		if not seeded:
+			raise CommandError(f'There are no users with the prefix "{options["prefix"]}", run seed_dataset first')
+		rng = np.random.default_rng(options['seed'])
+		sample = sorted(rng.choice(seeded, min(options['users'], len(seeded)), replace=False).tolist())
+		host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+		self.members = [Member(user, host) for user in User.objects.filter(id__in=sample).order_by('id')]
+		self.anonymous = APIClient(SERVER_NAME=host)
+		self.seeded, self.rng, self.options = seeded, rng, options
+		self.nonce = int(time.time())
+
+		scenarios = self.scenarios()
+		uncovered = endpoint_names() - {scenario.url_name for scenario in scenarios}
+		if uncovered:
+			self.stderr.write(f'No scenario drives {", ".join(sorted(uncovered))}')
+		if options['endpoints']:
+			unknown = set(options['endpoints']) - {scenario.name for scenario in scenarios}
+			if unknown:
+				raise CommandError(f'Unknown endpoints: {", ".join(sorted(unknown))}')
+			scenarios = [scenario for scenario in scenarios if scenario.name in options['endpoints']]
+
+		baseline = {}
+		if options['compare']:
+			with open(options['compare']) as baseline_file:
+				baseline = json.load(baseline_file)['endpoints']
+		self.stdout.write(f'{"endpoint":>16} {"requests":>8} {"errors":>6} ' +
+						  ' '.join(f'{f"p{percent} ms":>8}' for percent in PERCENTILES) +
+						  f' {"queries":>7} {"bytes":>8}' + (f' {"p50 vs base":>11}' if baseline else ''))
+		results = {}
+		try:
+			for scenario in scenarios:
+				results[scenario.name] = result = self.run(scenario)
+				line = f'{scenario.name:>16} {result["requests"]:>8} {result["errors"]:>6} ' + ' '.join(
+					f'{result[f"p{percent}_ms"]:>8.2f}' for percent in PERCENTILES) + \
+					f' {result["queries_per_request"]:>7.1f} {result["bytes_per_response"]:>8.0f}'
+				if scenario.name in baseline:
+					before = baseline[scenario.name]['p50_ms']
+					line += f' {(result["p50_ms"] - before) / before * 100 if before else 0:>+10.1f}%'
+				self.stdout.write(line)
+		finally:
+			User.objects.filter(username__startswith=f'{options["prefix"]}bench_').delete()
+
+		with open(options['output'], 'w') as output:
+			json.dump(self.report(results), output, indent=2)
+		self.stdout.write(f'Results saved to {options["output"]}')
+
+	def run(self, scenario):
+		'''
+			Makes the warm up requests then the measured ones, round robin over the members, and summarizes them
+		:return:
+		'''
+		latencies, queries, sizes, statuses = [], [], [], {}
+		warmup, requests = self.options['warmup'], self.options['requests']
+		try:
+			for index in range(warmup + requests):
+				member = self.members[index % len(self.members)]
+				method, path, data, data_format = scenario.build(index, member)
+				client = self.anonymous if scenario.anonymous else member.client
+				with QueryCounter() as counter:
+					started = time.perf_counter()
+					response = getattr(client, method)(path, data, format=data_format)
+					elapsed = time.perf_counter() - started
+				scenario.record(member, response)
+				if index < warmup:
+					continue
+				latencies.append(elapsed * 1000)
+				queries.append(counter.count)
+				sizes.append(len(response.content))
+				statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+		finally:
+			scenario.cleanup()
+		result = {'url_name': scenario.url_name, 'requests': len(latencies),
+				  'errors': sum(count for status, count in statuses.items() if int(status) >= 400), 'statuses': statuses}
+		result.update({f'p{percent}_ms': round(percentile(latencies, percent), 3) for percent in PERCENTILES})
+		result.update({
+			'mean_ms': round(sum(latencies) / len(latencies), 3),
+			'queries_per_request': sum(queries) / len(queries),
+			'bytes_per_response': sum(sizes) / len(sizes),
+		})
+		return result
+
+	def report(self, results):
+		'''
+			The saved results, with what they were measured on
+		:return:
+		'''
+		try:
+			commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+									cwd=settings.BASE_DIR).stdout.strip() or None
+		except OSError:
+			commit = None
+		seeded = User.objects.filter(username__startswith=self.options['prefix'])
+		return {
+			'started': timezone.now().isoformat(),
+			'commit': commit,
+			'options': {name: self.options[name] for name in ('requests', 'warmup', 'users', 'prefix', 'seed')},
+			'settings': {
+				'database': connections['default'].vendor,
+				'cache': settings.CACHES['default']['BACKEND'],
+				'async_views': getattr(settings, 'ASYNC_VIEWS', False),
+				**{name: getattr(settings, name, 'redis') for name in (
+					'TIMELINE_BACKEND', 'FOLLOW_GRAPH_BACKEND', 'TRENDS_BACKEND', 'STREAM_BACKEND',
+					'IMAGE_QUEUE_BACKEND', 'CACHE_INVALIDATION_BACKEND')},
+			},
+			'dataset': {
+				'users': seeded.count(),
+				'follows': User.followers.through.objects.filter(to_user__in=seeded).count(),
+				'posts': Post.objects.filter(poster__in=seeded).count(),
+			},
+			'endpoints': results,
+		}
+
+	def scenarios(self):
+		'''
+			One scenario per endpoint and per feed choice, reads first
+		:return:
+		'''
+		prefix = self.options['prefix']
+		seeded = User.objects.filter(username__startswith=prefix)
+		popular = seeded.order_by('-no_of_followers').values_list('id', flat=True).first()
+		tag = PostTag.objects.filter(post__poster__in=seeded).values('tag').annotate(
+			total=Count('*')).order_by('-total').values_list('tag', flat=True).first() or 'news'
+		mentioned = PostMention.objects.filter(user__in=seeded).values('user_id').annotate(
+			total=Count('*')).order_by('-total').values_list('user_id', flat=True).first() or popular
+		post_ids = list(Post.objects.filter(poster__in=seeded).values_list('id', flat=True))
+		post_ids = self.rng.choice(post_ids, min(len(post_ids), 1000), replace=False).tolist() if post_ids else [0]
+		self.targets = {member.user.id: [user_id for user_id in self.seeded
+										 if user_id != member.user.id and user_id not in member.following][:5]
+						for member in self.members}
+
+		def get(path, data=None):
+			return lambda index, member: ('get', path(index, member) if callable(path) else path, data, None)
+
+		def feed(choice):
+			return Scenario(f'feed_{choice}', 'post-list', get('/post/', {'choice': choice}))
+
+		return [
+			Scenario('profile', 'user_profile', get('/user/')),
+			Scenario('suggestions', 'user_suggestions', get('/user/suggestions/')),
+			Scenario('followers', 'user_followers', get(f'/user/{popular}/followers/')),
+			Scenario('following', 'user_following', get(lambda index, member: f'/user/{member.user.id}/following/')),
+			feed('all'), feed('following'), feed('mine'), feed('followers'),
+			Scenario('post', 'post-detail', get(lambda index, member: f'/post/{post_ids[index % len(post_ids)]}/')),
+			Scenario('search', 'search_posts', lambda index, member: (
+				'get', '/post/search/', {'q': WORDS[index % len(WORDS)]}, None)),
+			Scenario('tag', 'tag_posts', get(f'/post/tags/{tag}/')),
+			Scenario('mentions', 'mention_posts', get(f'/post/mentions/{mentioned}/')),
+			Scenario('trends', 'trends', get('/trends/')),
+			Scenario('login', 'login', lambda index, member: (
+				'post', '/user/login/', {'username': member.user.username, 'password': SEED_PASSWORD}, 'multipart'),
+					 anonymous=True),
+			Scenario('signup', 'user-list', lambda index, member: ('post', '/user/signup/', dict(
+				first_name='Bench', last_name=str(index), username=f'{prefix}bench_{self.nonce}_{index}',
+				email=f'{prefix}bench_{self.nonce}_{index}@example.com', password_1=SEED_PASSWORD,
+				password_2=SEED_PASSWORD), 'multipart'), anonymous=True),
+			Scenario('edit_user', 'edit_user', self.edit_user, self.record_edit, self.restore_edits),
+			Scenario('follow', 'user_action', self.follow, self.record_follow, self.restore_follows),
+			Scenario('bulk_follow', 'user_bulk_action', self.bulk_follow, self.record_bulk_follow,
+					 self.restore_bulk_follows),
+			Scenario('refresh', 'refresh_posts', get('/post/feeds/refresh/')),
+			Scenario('create_post', 'create_post', lambda index, member: (
+				'post', '/post/create/', {'text': f'Benchmark post {self.nonce} {index} #benchmark'}, 'multipart'),
+					 self.record_post),
+			Scenario('edit_post', 'edit_post', lambda index, member: (
+				'patch', f'/post/{self.own_post(index, member)}/edit/',
+				{'text': f'Benchmark post {self.nonce} {index} edited'}, 'multipart')),
+			Scenario('delete_post', 'post-detail', lambda index, member: (
+				'delete', f'/post/{member.posts.pop() if member.posts else 0}/', None, None)),
+			Scenario('logout', 'logout', lambda index, member: ('post', '/user/logout/', None, None)),
+		]
+
+	@staticmethod
+	def own_post(index, member):
+		return member.posts[index % len(member.posts)] if member.posts else 0
+
+	@staticmethod
+	def record_post(member, response):
+		if response.status_code == 200:
+			member.posts.append(response.data['data']['id'])
+
+	def edit_user(self, index, member):
+		return 'patch', '/user/edit/', {'first_name': 'Seed' if member.edited else 'Edited'}, 'multipart'
+
+	@staticmethod
+	def record_edit(member, response):
+		if response.status_code == 200:
+			member.edited = not member.edited
+
+	def restore_edits(self):
+		for member in self.members:
+			if member.edited:
+				member.request(*self.edit_user(0, member))
+				member.edited = False
+
+	def follow(self, index, member):
+		action = 'unfollow' if member.followed else 'follow'
+		return 'post', f'/user/{self.targets[member.user.id][0]}/action/', {'action': action}, 'multipart'
+
+	@staticmethod
+	def record_follow(member, response):
+		if response.status_code == 200:
+			member.followed = not member.followed
+
+	def restore_follows(self):
+		for member in self.members:
+			if member.followed:
+				member.request(*self.follow(0, member))
+				member.followed = False
+
+	def bulk_follow(self, index, member):
+		action = 'unfollow' if member.bulk_followed else 'follow'
+		return 'post', '/user/actions/', {'actions': [
+			{'id': user_id, 'action': action} for user_id in self.targets[member.user.id]]}, 'json'
+
+	@staticmethod
+	def record_bulk_follow(member, response):
+		if response.status_code == 200:
+			member.bulk_followed = not member.bulk_followed
+
+	def restore_bulk_follows(self):
+		for member in self.members:
+			if member.bulk_followed:
+				member.request(*self.bulk_follow(0, member))
+				member.bulk_followed = False
@@ -0,0 +1,80 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from Post.images import render_image
+
+
+def status_kb(field):
+	with open('/proc/self/status') as status:
+		for line in status:
+			if line.startswith(f'{field}:'):
+				return int(line.split()[1])
+
+
+def full_decode(upload):
+	'''
+		The way images were handled before renditions, a full resolution decode re-saved at quality 20
+	:return:
+	'''
+	from PIL import Image
+	Image.MAX_IMAGE_PIXELS = None
+	buffer = io.BytesIO()
+	Image.open(upload).save(buffer, 'JPEG', quality=20, optimize=True)
+
+
+def measure(mode, path, results):
+	'''
+		Runs one ingestion in a fresh forked process and reports its latency and the peak memory it added
+	:return:
+	'''
+	# A forked process inherits its parent's peak, writing 5 to clear_refs resets it to the current RSS
+	with open('/proc/self/clear_refs', 'w') as clear_refs:
+		clear_refs.write('5')
+	baseline = status_kb('VmRSS')
+	started = time.perf_counter()
+	with open(path, 'rb') as upload:
+		(render_image if mode == 'renditions' else full_decode)(upload)
+	elapsed = time.perf_counter() - started
+	results.put((elapsed, status_kb('VmHWM') - baseline))
+
+
+class Command(BaseCommand):
+	'''
+		This command measures the latency and peak resident memory of processing an uploaded JPEG per upload size,
+		for the rendition pipeline and for a plain full resolution decode. Linux only, each run is a forked process
+	'''
+	help = 'Benchmarks image ingestion latency and peak RSS per upload size'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12, 40])
+		parser.add_argument('--repeat', type=int, default=3, help='Runs per size, the best one is reported')
+
+	def handle(self, *args, **options):
+		from PIL import Image
+		context = multiprocessing.get_context('fork')
+		self.stdout.write(f'{"megapixels":>10} {"bytes":>12} {"mode":>12} {"latency ms":>11} {"peak RSS MB":>12}')
+		for megapixels in options['megapixels']:
+			width = int((megapixels * 1000000 * 4 / 3) ** 0.5)
+			height = width * 3 // 4
+			with tempfile.NamedTemporaryFile(suffix='.jpg') as upload:
+				noise = Image.effect_noise((width, height), 64)
+				Image.merge('RGB', (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(
+					Image.FLIP_TOP_BOTTOM))).save(upload, 'JPEG', quality=90)
+				del noise
+				upload.flush()
+				for mode in ('renditions', 'full decode'):
+					runs = []
+					for _ in range(options['repeat']):
+						results = context.Queue()
+						process = context.Process(target=measure, args=(mode, upload.name, results))
+						process.start()
+						runs.append(results.get())
+						process.join()
+					elapsed, peak = min(runs)
+					self.stdout.write(f'{megapixels:>10} {os.path.getsize(upload.name):>12} {mode:>12} '
+									  f'{elapsed * 1000:>11.1f} {peak / 1024:>12.1f}')
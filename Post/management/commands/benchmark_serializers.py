@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from Account.models import User
+from Post.models import Post
+from Post.serializer import PostSerializer
+from Utilities.fast_serializer import FastSerializer
+
+
+class Command(BaseCommand):
+	'''
+		This command compares PostSerializer with its FastSerializer on pages of posts, from the query to the
+		rendered JSON, and checks both render the same bytes. The posts are created in a transaction that is
+		rolled back at the end
+	'''
+	help = 'Benchmarks PostSerializer against FastSerializer per page size'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--posts', type=int, nargs='+', default=[1000, 10000])
+		parser.add_argument('--repeat', type=int, default=5, help='Runs per page size, the best one is reported')
+
+	def handle(self, *args, **options):
+		self.stdout.write(f'{"posts":>8} {"serializer":>12} {"ms":>9} {"posts/s":>10}')
+		with transaction.atomic():
+			poster = User.objects.create_user(username='benchmark_serializers', password=None)
+			created = 0
+			for size in options['posts']:
+				Post.objects.bulk_create([Post(poster=poster, text=f'benchmark post {index} #benchmark',
+											   renditions={'thumbnail': f'post/renditions/{index}/thumbnail.jpg'})
+										  for index in range(created, size)], batch_size=1000)
+				created = max(created, size)
+				posts = Post.objects.filter(poster=poster).order_by('-id')[:size]
+				runs = {
+					'drf': lambda: JSONRenderer().render(PostSerializer(
+						PostSerializer.setup_eager_loading(posts), many=True).data),
+					'fast': lambda: JSONRenderer().render(FastSerializer(PostSerializer).queryset(posts)),
+				}
+				output = {name: run() for name, run in runs.items()}
+				if output['drf'] != output['fast']:
+					raise Exception(f'The serializers rendered different output for {size} posts')
+				for name, run in runs.items():
+					elapsed = min(self.time(run) for _ in range(options['repeat']))
+					self.stdout.write(f'{size:>8} {name:>12} {elapsed * 1000:>9.1f} {size / elapsed:>10.0f}')
+			transaction.set_rollback(True)
+
+	@staticmethod
+	def time(run):
+		started = time.perf_counter()
+		run()
+		return time.perf_counter() - started
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Account.models import User
+from Post.models import Post
+
+USERNAME_PREFIX = 'benchmark_servers_'
+SERVERS = {
+	'wsgi': ['CloneTwitter.wsgi', '--worker-class', 'sync'],
+	'wsgi-threads': ['CloneTwitter.wsgi', '--worker-class', 'gthread', '--threads', '8'],
+	'asgi': ['CloneTwitter.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+BOUNDARY = 'benchmark-boundary'
+
+
+def cpu_seconds(pid):
+	'''
+		The CPU time used by a process and its children so far, read from /proc
+	:return:
+	'''
+	ticks = 0
+	pids = [pid]
+	while pids:
+		pid = pids.pop()
+		try:
+			with open(f'/proc/{pid}/stat') as stat:
+				fields = stat.read().rsplit(')', 1)[1].split()
+			with open(f'/proc/{pid}/task/{pid}/children') as children:
+				pids += [int(child) for child in children.read().split()]
+		except OSError:
+			continue
+		ticks += int(fields[11]) + int(fields[12])
+	return ticks / os.sysconf('SC_CLK_TCK')
+
+
+class Connection:
+	'''
+		A keep-alive HTTP/1.1 client connection that reconnects when the server closes it
+	'''
+
+	def __init__(self, port):
+		self.port = port
+		self.reader = self.writer = None
+
+	async def request(self, raw):
+		if self.writer is None:
+			self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+		self.writer.write(raw)
+		status = int((await self.reader.readline()).split()[1])
+		headers = {}
+		while True:
+			line = await self.reader.readline()
+			if line in (b'\r\n', b''):
+				break
+			name, _, value = line.decode('latin1').partition(':')
+			headers[name.strip().lower()] = value.strip().lower()
+		body = b''
+		if 'content-length' in headers:
+			body = await self.reader.readexactly(int(headers['content-length']))
+		elif headers.get('transfer-encoding') == 'chunked':
+			while True:
+				size = int((await self.reader.readline()).strip(), 16)
+				body += (await self.reader.readexactly(size + 2))[:size]
+				if not size:
+					break
+		if headers.get('connection') == 'close':
+			self.close()
+		return status, body
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+		self.reader = self.writer = None
+
+
+def build_request(method, path, token, fields=None):
+	headers = f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer {token}\r\n'
+	body = ''
+	if fields:
+		body = ''.join(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+					   for name, value in fields.items()) + f'--{BOUNDARY}--\r\n'
+		headers += f'Content-Type: multipart/form-data; boundary={BOUNDARY}\r\nContent-Length: {len(body)}\r\n'
+	return (headers + '\r\n' + body).encode()
+
+
+class Command(BaseCommand):
+	'''
+		This command serves the project with a single gunicorn worker, in turn with sync WSGI workers, threaded WSGI
+		workers and uvicorn's ASGI worker, and loads the following feed, the profile and the follow endpoint with
+		concurrent keep-alive clients. It reports requests per second and requests per second of server CPU time,
+		which is what one core serves whether or not the clients share it. The servers use this process's settings
+		and database, the users and posts it creates are deleted at the end
+	'''
+	help = 'Benchmarks WSGI against ASGI workers on the feed, profile and follow endpoints'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+		parser.add_argument('--endpoints', nargs='+', choices=('feed', 'profile', 'follow'),
+							default=['feed', 'profile', 'follow'])
+		parser.add_argument('--connections', type=int, default=16)
+		parser.add_argument('--duration', type=float, default=10, help='Seconds each endpoint is loaded for')
+		parser.add_argument('--posters', type=int, default=20)
+		parser.add_argument('--posts', type=int, default=50, help='Posts per poster')
+		parser.add_argument('--port', type=int, default=8400)
+
+	def handle(self, *args, **options):
+		self.following = {}
+		User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+		try:
+			readers, posters = self.create_data(options['connections'], options['posters'], options['posts'])
+			self.stdout.write(f'{"server":>14} {"endpoint":>9} {"requests":>9} {"errors":>7} {"req/s":>8} '
+							  f'{"req/cpu s":>10}')
+			for server in options['servers']:
+				process = self.start(server, options['port'])
+				try:
+					for endpoint in options['endpoints']:
+						self.load(server, endpoint, process.pid, readers, posters[0], options)
+				finally:
+					os.killpg(process.pid, signal.SIGTERM)
+					process.wait()
+		finally:
+			User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+	@staticmethod
+	def create_data(readers, posters, posts):
+		'''
+			Readers that follow every poster, and the posters' posts
+		:return:
+		'''
+		User.objects.bulk_create([User(username=f'{USERNAME_PREFIX}{kind}{index}', password='!')
+								  for kind, count in (('reader', readers), ('poster', posters)) for index in range(count)])
+		readers = list(User.objects.filter(username__startswith=f'{USERNAME_PREFIX}reader').order_by('id'))
+		posters = list(User.objects.filter(username__startswith=f'{USERNAME_PREFIX}poster').order_by('id'))
+		User.followers.through.objects.bulk_create([User.followers.through(from_user_id=poster.id, to_user_id=reader.id)
+													for poster in posters for reader in readers])
+		Post.objects.bulk_create([Post(poster=poster, text=f'benchmark post {index} by {poster.username}')
+								  for poster in posters for index in range(posts)], batch_size=1000)
+		User.objects.filter(id__in=[reader.id for reader in readers]).update(no_of_following=len(posters))
+		User.objects.filter(id__in=[poster.id for poster in posters]).update(no_of_followers=len(readers),
+																			   no_of_posts=posts)
+		return readers, posters
+
+	def start(self, server, port):
+		command = [sys.executable, '-m', 'gunicorn', *SERVERS[server], '--workers', '1', '--bind', f'127.0.0.1:{port}',
+				   '--log-level', 'warning']
+		# The ASGI deployment is measured with its async views, which it only serves when they are turned on
+		env = dict(os.environ, ASYNC_VIEWS=str(server == 'asgi'))
+		process = subprocess.Popen(command, start_new_session=True, env=env)
+		deadline = time.monotonic() + 30
+		while time.monotonic() < deadline:
+			try:
+				socket.create_connection(('127.0.0.1', port), timeout=1).close()
+				return process
+			except OSError:
+				if process.poll() is not None:
+					break
+				time.sleep(0.2)
+		if process.poll() is None:
+			os.killpg(process.pid, signal.SIGTERM)
+		raise CommandError(f'The {server} server did not start')
+
+	def load(self, server, endpoint, pid, readers, followee, options):
+		tokens = [str(AccessToken.for_user(reader)) for reader in readers]
+		# A first second warms caches and timelines up and is left out
+		asyncio.run(self.run(endpoint, tokens, followee, dict(options, duration=1)))
+		started, cpu_started = time.perf_counter(), cpu_seconds(pid)
+		results = asyncio.run(self.run(endpoint, tokens, followee, options))
+		elapsed, cpu = time.perf_counter() - started, cpu_seconds(pid) - cpu_started
+		requests = sum(ok for ok, _ in results)
+		errors = sum(failed for _, failed in results)
+		self.stdout.write(f'{server:>14} {endpoint:>9} {requests:>9} {errors:>7} {requests / elapsed:>8.0f} '
+						  f'{requests / cpu if cpu else 0:>10.0f}')
+
+	async def run(self, endpoint, tokens, followee, options):
+		deadline = time.perf_counter() + options['duration']
+		return await asyncio.gather(*[self.client(endpoint, token, followee, deadline, options['port'])
+									  for token in tokens])
+
+	async def client(self, endpoint, token, followee, deadline, port):
+		'''
+			Sends requests one after the other until the deadline, a reader unfollows and follows back in turn
+		:return:
+		'''
+		connection = Connection(port)
+		ok = failed = 0
+		try:
+			while time.perf_counter() < deadline:
+				if endpoint == 'feed':
+					raw = build_request('GET', '/post/?choice=following', token)
+				elif endpoint == 'profile':
+					raw = build_request('GET', '/user/', token)
+				else:
+					action = 'unfollow' if self.following.get(token, True) else 'follow'
+					raw = build_request('POST', f'/user/{followee.id}/action/', token, {'action': action})
+				status, body = await connection.request(raw)
+				if 200 <= status < 300:
+					ok += 1
+				else:
+					failed += 1
+				if endpoint == 'follow' and (b'You just' in body or b'following this user' in body):
+					# A request can fail after its write, the messages tell where the relationship stands
+					self.following[token] = b'You just followed' in body or b'already following' in body
+		finally:
+			connection.close()
+		return ok, failed
@@ -0,0 +1,183 @@
+import asyncio
+import re
+import resource
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Account.models import User
+from Post.stream import post_event, publish
+
+USERNAME_PREFIX = 'benchmark_stream_'
+EVENT_ID = re.compile(rb'^id: (\d+)$', re.M)
+
+
+def rss():
+	'''
+		The resident memory of this process in MB
+	:return:
+	'''
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+	except OSError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class InProcessStream:
+	'''
+		A stream opened by calling the ASGI application in this process, no sockets involved
+	'''
+
+	def __init__(self, token, on_event):
+		self.token = token
+		self.on_event = on_event
+		self.status = None
+		self.started = asyncio.Event()
+		self.closed = asyncio.Event()
+		self.requested = False
+
+	async def receive(self):
+		if not self.requested:
+			self.requested = True
+			return {'type': 'http.request', 'body': b''}
+		await self.closed.wait()
+		return {'type': 'http.disconnect'}
+
+	async def send(self, message):
+		if message['type'] == 'http.response.start':
+			self.status = message['status']
+			self.started.set()
+		elif message['body'].startswith(b'event:'):
+			self.on_event(message['body'])
+
+	async def open(self):
+		from CloneTwitter.asgi import application
+		scope = {'type': 'http', 'method': 'GET', 'path': '/post/stream/', 'query_string': b'',
+				 'headers': [(b'authorization', f'Bearer {self.token}'.encode())]}
+		self.task = asyncio.ensure_future(application(scope, self.receive, self.send))
+		await self.started.wait()
+
+	async def close(self):
+		self.closed.set()
+		await self.task
+
+
+class SocketStream:
+	'''
+		A stream opened over HTTP against a running ASGI server
+	'''
+
+	def __init__(self, url, token, on_event):
+		self.url = urlsplit(url)
+		self.token = token
+		self.on_event = on_event
+		self.status = None
+
+	async def open(self):
+		self.reader, self.writer = await asyncio.open_connection(self.url.hostname, self.url.port or 80)
+		self.writer.write(f'GET /post/stream/ HTTP/1.1\r\nHost: {self.url.netloc}\r\n'
+						  f'Authorization: Bearer {self.token}\r\nAccept: text/event-stream\r\n\r\n'.encode())
+		self.status = int((await self.reader.readline()).split()[1])
+		while (await self.reader.readline()) not in (b'\r\n', b''):
+			pass
+		self.task = asyncio.ensure_future(self.read())
+
+	async def read(self):
+		buffer = b''
+		while True:
+			chunk = await self.reader.read(65536)
+			if not chunk:
+				return
+			*frames, buffer = (buffer + chunk).split(b'\n\n')
+			for frame in frames:
+				if EVENT_ID.search(frame):
+					self.on_event(frame)
+
+	async def close(self):
+		self.writer.close()
+		self.task.cancel()
+
+
+class Command(BaseCommand):
+	'''
+		This command holds thousands of idle streams open, publishes posts to all of them and reports the memory each
+		stream holds and how long events take to reach them. Streams are opened through the ASGI application in this
+		process, or with --url against a running server, e.g `uvicorn CloneTwitter.asgi:application`, whose memory
+		should then be read on the server. The users it creates are deleted at the end
+	'''
+	help = 'Load tests the post stream with idle connections'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--connections', type=int, default=2000)
+		parser.add_argument('--users', type=int, default=200, help='The readers the connections are spread over')
+		parser.add_argument('--posters', type=int, default=10, help='The users every reader follows')
+		parser.add_argument('--events', type=int, default=50)
+		parser.add_argument('--interval', type=float, default=0.05, help='Seconds between published events')
+		parser.add_argument('--idle', type=float, default=0, help='Seconds to hold the streams idle before publishing')
+		parser.add_argument('--url', help='The base URL of a running ASGI server, e.g http://127.0.0.1:8000')
+
+	def handle(self, *args, **options):
+		if options['url'] and getattr(settings, 'STREAM_BACKEND', 'redis') == 'local':
+			raise CommandError('A server in another process only receives events through the redis stream backend')
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+		try:
+			readers, posters = self.create_users(options['users'], options['posters'])
+			tokens = [str(AccessToken.for_user(reader)) for reader in readers]
+			asyncio.run(self.run([tokens[index % len(tokens)] for index in range(options['connections'])],
+								 [poster.id for poster in posters], options))
+		finally:
+			User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+	@staticmethod
+	def create_users(readers, posters):
+		User.objects.bulk_create([User(username=f'{USERNAME_PREFIX}{kind}{index}', password='!')
+								  for kind, count in (('reader', readers), ('poster', posters)) for index in range(count)])
+		readers = list(User.objects.filter(username__startswith=f'{USERNAME_PREFIX}reader'))
+		posters = list(User.objects.filter(username__startswith=f'{USERNAME_PREFIX}poster'))
+		User.followers.through.objects.bulk_create([User.followers.through(from_user_id=poster.id, to_user_id=reader.id)
+													for poster in posters for reader in readers])
+		return readers, posters
+
+	async def run(self, tokens, poster_ids, options):
+		published, latencies = {}, []
+
+		def on_event(frame):
+			latencies.append(time.perf_counter() - published[int(EVENT_ID.search(frame).group(1))])
+
+		streams = [SocketStream(options['url'], token, on_event) if options['url'] else InProcessStream(token, on_event)
+				   for token in tokens]
+		memory = rss()
+		started = time.perf_counter()
+		for batch in range(0, len(streams), 500):
+			await asyncio.gather(*[stream.open() for stream in streams[batch:batch + 500]])
+		connected = time.perf_counter()
+		if any(stream.status != 200 for stream in streams):
+			raise CommandError(f'{sum(stream.status != 200 for stream in streams)} streams were refused')
+		self.stdout.write(f'{len(streams)} streams opened in {(connected - started) * 1000:.0f} ms')
+		if not options['url']:
+			self.stdout.write(f'{(rss() - memory) * 1024 / len(streams):.1f} KB per idle stream')
+		await asyncio.sleep(options['idle'])
+
+		loop = asyncio.get_running_loop()
+		expected = options['events'] * len(streams)
+		for event_id in range(1, options['events'] + 1):
+			published[event_id] = time.perf_counter()
+			await loop.run_in_executor(None, publish, post_event('created', event_id, poster_ids[event_id % len(poster_ids)]))
+			await asyncio.sleep(options['interval'])
+		deadline = time.perf_counter() + 10
+		while len(latencies) < expected and time.perf_counter() < deadline:
+			await asyncio.sleep(0.05)
+		await asyncio.gather(*[stream.close() for stream in streams])
+
+		latencies.sort()
+		self.stdout.write(f'{len(latencies)} of {expected} events delivered')
+		if latencies:
+			self.stdout.write('latency ms: ' + ', '.join(
+				f'p{percentile} {latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] * 1000:.1f}'
+				for percentile in (50, 90, 99, 100)))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from Post.trends import get_trend_store, TRENDS_COMPACT_INTERVAL
+
+
+class Command(BaseCommand):
+	'''
+		This command compacts the trend counters and publishes the top terms. Reads compact on their own when the
+		published terms are stale, running this keeps that work off requests
+	'''
+	help = 'Compacts the trend counters and publishes the top terms'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--every', type=int, default=0,
+							help=f'Compact every this many seconds instead of once, e.g {TRENDS_COMPACT_INTERVAL}')
+
+	def handle(self, *args, **options):
+		while True:
+			get_trend_store().compact()
+			if not options['every']:
+				break
+			time.sleep(options['every'])
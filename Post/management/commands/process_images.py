@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from Post.images import get_image_queue, run_job
+from Post.models import Post
+
+
+class Command(BaseCommand):
+	'''
+		This command runs a pool of image workers that turn pending post uploads into their renditions.
+		It takes its jobs from the queue selected by settings.IMAGE_QUEUE_BACKEND ('redis' or 'database')
+	'''
+	help = 'Processes pending post images into their renditions'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=getattr(settings, 'IMAGE_WORKERS', 2),
+							help='The number of images processed at the same time')
+		parser.add_argument('--once', action='store_true', help='Exit once no image is pending instead of waiting')
+		parser.add_argument('--backfill', action='store_true',
+							help='Queue the images of posts created before renditions existed')
+		parser.add_argument('--requeue-stuck', action='store_true',
+							help='Queue images left processing by a worker that died, only run it with no worker up')
+
+	def handle(self, *args, **options):
+		if options['backfill']:
+			queued = Post.objects.filter(image_status=None).exclude(image=None).exclude(image='').update(
+				image_status=Post.IMAGE_PENDING)
+			self.stdout.write(f'Queued {queued} existing images')
+		if options['requeue_stuck']:
+			queued = Post.objects.filter(image_status=Post.IMAGE_PROCESSING).update(image_status=Post.IMAGE_PENDING)
+			self.stdout.write(f'Requeued {queued} stuck images')
+		with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+			for _ in range(options['workers']):
+				pool.submit(self.work, options['once'])
+
+	def work(self, once):
+		queue = get_image_queue()
+		processed = 0
+		while True:
+			post_id = queue.pop(timeout=1 if once else 5)
+			if post_id is None:
+				if once:
+					break
+				continue
+			try:
+				run_job(post_id)
+			finally:
+				close_old_connections()
+			processed += 1
+		self.stdout.write(f'A worker processed {processed} images')
@@ -0,0 +1,253 @@
+import io
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Account.management.commands.benchmark_suggestions import synthetic_graph
+from Account.models import User
+from Post.cache import feed_cache_key
+from Post.images import get_image_queue
+from Post.models import Post, PostTag, PostMention
+from Post.tags import tag_rows, mention_rows
+from Post.timeline import get_timeline_store, TIMELINE_FANOUT_LIMIT
+from Post.uploads import file_digest
+from Post.trends import get_trend_store, post_terms, TRENDS_HALF_LIFE
+from Utilities.cache import invalidate
+from Utilities.conditional import bump_versions
+
+USERNAME_PREFIX = 'seed_'
+# Every seeded user logs in with this password
+SEED_PASSWORD = 'seed-password'
+WORDS = (
+	'morning', 'coffee', 'weekend', 'music', 'football', 'election', 'weather', 'traffic', 'movie', 'dinner',
+	'python', 'django', 'startup', 'market', 'crypto', 'concert', 'holiday', 'travel', 'photo', 'garden',
+	'running', 'workout', 'recipe', 'kitchen', 'school', 'exam', 'office', 'meeting', 'release', 'update',
+	'phone', 'laptop', 'camera', 'podcast', 'novel', 'library', 'museum', 'beach', 'mountain', 'river',
+	'city', 'village', 'bridge', 'train', 'airport', 'flight', 'hotel', 'festival', 'birthday', 'wedding',
+	'friends', 'family', 'puppy', 'kitten', 'sunset', 'sunrise', 'storm', 'rain', 'snow', 'summer',
+	'winter', 'autumn', 'spring', 'news', 'story', 'thread', 'question', 'answer', 'idea', 'project',
+	'design', 'code', 'bug', 'deploy', 'server', 'database', 'cache', 'feature', 'team', 'game',
+	'match', 'league', 'final', 'goal', 'score', 'player', 'coach', 'season', 'album', 'song',
+	'great', 'amazing', 'terrible', 'tired', 'happy', 'excited', 'finally', 'today', 'tonight', 'tomorrow',
+)
+TAGS = ('news', 'sports', 'tech', 'music', 'travel', 'food', 'python', 'django', 'weather', 'movies',
+		'gaming', 'books', 'art', 'science', 'health', 'fitness', 'photography', 'politics', 'fashion', 'crypto')
+# The share of posts written in each hour of the day, UTC, quiet at night and busiest in the evening
+HOURLY_ACTIVITY = (3, 2, 1, 1, 1, 2, 4, 6, 7, 7, 6, 6, 7, 6, 6, 6, 7, 8, 9, 10, 10, 9, 7, 5)
+
+
+def power_law(rng, count, exponent):
+	'''
+		Normalized weights for `count` items where the item ranked k weighs 1 / k ** exponent, in a shuffled order
+	:return:
+	'''
+	import numpy as np
+	weights = 1 / np.arange(1, count + 1) ** exponent
+	rng.shuffle(weights)
+	return weights / weights.sum()
+
+
+def post_text(rng, username_weights, usernames):
+	'''
+		A post of 5 to 25 words, with a hashtag in about a third of posts and a mention in about a tenth
+	:return:
+	'''
+	words = [WORDS[index] for index in rng.integers(0, len(WORDS), rng.integers(5, 26))]
+	if rng.random() < 0.35:
+		words.insert(rng.integers(0, len(words) + 1), f'#{TAGS[min(int(rng.zipf(1.6)) - 1, len(TAGS) - 1)]}')
+	if rng.random() < 0.1:
+		words.insert(rng.integers(0, len(words) + 1), f'@{usernames[rng.choice(len(usernames), p=username_weights)]}')
+	return ' '.join(words).capitalize()
+
+
+def post_times(rng, count, end, days):
+	'''
+		Creation times over the `days` before `end`, posted more in the evening than at night and a little more
+		lately than long ago, oldest first
+	:return:
+	'''
+	import numpy as np
+	hours = np.array(HOURLY_ACTIVITY, dtype=float)
+	start = (end - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+	times = []
+	while len(times) < count:
+		day = np.floor(days * rng.power(1.3, count))
+		hour = rng.choice(24, count, p=hours / hours.sum())
+		seconds = day * 86400 + hour * 3600 + rng.integers(0, 3600, count)
+		times += [moment for moment in (start + timedelta(seconds=int(second)) for second in seconds) if moment < end]
+	return sorted(times[:count])
+
+
+def image_bytes(rng):
+	'''
+		A small JPEG of a random gradient
+	:return:
+	'''
+	from PIL import Image
+	start, stop = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+	gradient = Image.linear_gradient('L').resize((320, 240))
+	image = Image.merge('RGB', [gradient.point(lambda value, a=a, b=b: a + (b - a) * value // 255)
+								for a, b in zip(start.tolist(), stop.tolist())])
+	buffer = io.BytesIO()
+	image.save(buffer, 'JPEG', quality=80)
+	return buffer.getvalue()
+
+
+class Command(BaseCommand):
+	'''
+		This command seeds a reproducible synthetic dataset to measure changes against: users whose follower counts
+		follow a power law, as in benchmark_suggestions, and posts from a long-tailed mix of posters at the times of
+		day people post, with hashtags, mentions and optionally images. The same arguments give the same users,
+		follows and posts, dated up to the current hour so that feeds and trends look live. Counters, hashtag and
+		mention indexes, recent trend terms and suggestions are written alongside, timelines and follow graph sets
+		load from the database on first read. Seeded users share the password SEED_PASSWORD
+	'''
+	help = 'Seeds a reproducible synthetic social graph with posts'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--users', type=int, default=1000)
+		parser.add_argument('--follows', type=int, default=20000, help='Follow edges drawn, before duplicates')
+		parser.add_argument('--posts', type=int, default=20000)
+		parser.add_argument('--days', type=int, default=30, help='The days the posts are spread over')
+		parser.add_argument('--images', type=float, default=0, help='The share of posts with an image')
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--prefix', default=USERNAME_PREFIX, help='The prefix of the seeded usernames')
+		parser.add_argument('--clear', action='store_true', help='Delete the users seeded with this prefix first')
+		parser.add_argument('--batch-size', type=int, default=1000)
+
+	def handle(self, *args, **options):
+		import numpy as np
+		prefix, batch_size = options['prefix'], options['batch_size']
+		if options['clear']:
+			deleted, _ = User.objects.filter(username__startswith=prefix).delete()
+			self.stdout.write(f'Deleted {deleted} rows seeded with the prefix "{prefix}"')
+		elif User.objects.filter(username__startswith=prefix).exists():
+			self.stderr.write(f'Users with the prefix "{prefix}" exist already, pass --clear to replace them')
+			return
+		rng = np.random.default_rng(options['seed'])
+		started = time.perf_counter()
+
+		usernames = [f'{prefix}{index}' for index in range(options['users'])]
+		password = make_password(SEED_PASSWORD)
+		User.objects.bulk_create([User(username=username, password=password, first_name='Seed', last_name=str(index),
+									   email=f'{username}@example.com') for index, username in enumerate(usernames)],
+								 batch_size=batch_size)
+		ids = dict(User.objects.filter(username__startswith=prefix).values_list('username', 'id'))
+		user_ids = [ids[username] for username in usernames]
+
+		# The graph and the posters are drawn as indexes into `usernames`
+		followers, followees = synthetic_graph(options['users'], options['follows'], options['seed'])
+		followers, followees = followers - 1, followees - 1
+		Follow = User.followers.through
+		Follow.objects.bulk_create([Follow(from_user_id=user_ids[followee], to_user_id=user_ids[follower])
+									for follower, followee in zip(followers.tolist(), followees.tolist())],
+								   batch_size=batch_size * 5)
+
+		# Popular accounts post more and are mentioned more
+		popularity = np.bincount(followees, minlength=len(user_ids)) + 1
+		posting = power_law(rng, len(user_ids), 1.1) * np.sqrt(popularity)
+		end = timezone.now().replace(minute=0, second=0, microsecond=0)
+		times = post_times(rng, options['posts'], end, options['days'])
+		posters = rng.choice(len(user_ids), len(times), p=posting / posting.sum())
+		written, images = self.create_posts(rng, times, [user_ids[poster] for poster in posters.tolist()], usernames,
+											popularity / popularity.sum(), options)
+
+		counts = {
+			'no_of_followers': np.bincount(followees, minlength=len(user_ids)),
+			'no_of_following': np.bincount(followers, minlength=len(user_ids)),
+			# Posts skipped as duplicates are not counted
+			'no_of_posts': np.bincount(posters[written], minlength=len(user_ids)),
+		}
+		users = [User(id=user_id, **{field: int(values[index]) for field, values in counts.items()})
+				 for index, user_id in enumerate(user_ids)]
+		User.objects.bulk_update(users, list(counts), batch_size=batch_size)
+
+		store = get_timeline_store()
+		for user in users:
+			if user.no_of_followers > TIMELINE_FANOUT_LIMIT:
+				store.mark_heavy(user.id)
+		tags, mentions = self.index_posts(user_ids, batch_size)
+		self.record_trends(prefix, end)
+		invalidate([feed_cache_key('all', None)])
+		bump_versions([feed_cache_key('all', None)])
+		for post_id in images:
+			get_image_queue().push(post_id)
+		call_command('build_suggestions', stdout=self.stdout)
+
+		self.stdout.write(f'Seeded {len(users)} users, {len(followers)} follows, {len(written)} posts with {len(images)} '
+						  f'images, {tags} hashtags and {mentions} mentions in {time.perf_counter() - started:.1f} s')
+
+	def create_posts(self, rng, times, posters, usernames, mentioned, options):
+		'''
+			Writes the posts in batches and returns the indexes of those written, posts whose content repeats an
+			earlier one are skipped, and the IDs of those with an image. date_created is set by the database on save,
+			so it is turned off while the seeded times are written
+		:return:
+		'''
+		field = Post._meta.get_field('date_created')
+		prefix, hashes, image_ids, written = options['prefix'], set(), [], []
+		field.auto_now_add = False
+		try:
+			for batch in range(0, len(times), options['batch_size']):
+				posts = []
+				for index in range(batch, min(batch + options['batch_size'], len(times))):
+					text, data, image, digest = post_text(rng, mentioned, usernames), None, None, None
+					if rng.random() < options['images']:
+						data = image_bytes(rng)
+						digest = file_digest(ContentFile(data))
+					content_hash = Post.make_content_hash(text, digest)
+					if content_hash in hashes:
+						continue
+					hashes.add(content_hash)
+					if data is not None:
+						image = default_storage.save(f'post/images/{prefix}{index}.jpg', ContentFile(data))
+					posts.append(Post(text=text, image=image, image_digest=digest, content_hash=content_hash,
+									  image_status=Post.IMAGE_PENDING if image else None, date_created=times[index],
+									  poster_id=posters[index]))
+					written.append(index)
+				Post.objects.bulk_create(posts)
+		finally:
+			field.auto_now_add = True
+		if options['images']:
+			image_ids = list(Post.objects.filter(poster__username__startswith=prefix, image_status=Post.IMAGE_PENDING)
+							 .values_list('id', flat=True))
+		return written, image_ids
+
+	@staticmethod
+	def index_posts(user_ids, batch_size):
+		'''
+			Indexes the hashtags and mentions of the seeded posts, like backfill_post_index
+		:return:
+		'''
+		tags = mentions = 0
+		last_id = 0
+		while True:
+			posts = list(Post.objects.filter(id__gt=last_id, poster_id__in=user_ids).order_by('id').only(
+				'id', 'text', 'date_created')[:batch_size])
+			if not posts:
+				return tags, mentions
+			last_id = posts[-1].id
+			new_tags, new_mentions = tag_rows(posts), mention_rows(posts)
+			PostTag.objects.bulk_create(new_tags)
+			PostMention.objects.bulk_create(new_mentions)
+			tags += len(new_tags)
+			mentions += len(new_mentions)
+
+	@staticmethod
+	def record_trends(prefix, end):
+		'''
+			Counts the trend terms of the posts recent enough to weigh in, oldest first as if they had just been posted
+		:return:
+		'''
+		since = end - timedelta(seconds=TRENDS_HALF_LIFE * 8)
+		store = get_trend_store()
+		for text, date_created in Post.objects.filter(
+				poster__username__startswith=prefix, date_created__gte=since).order_by(
+				'date_created').values_list('text', 'date_created').iterator():
+			store.record(post_terms(text), now=date_created.timestamp())
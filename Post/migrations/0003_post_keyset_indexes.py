@@ -0,0 +1,21 @@
+# Generated by Django 3.2.8 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Post', '0002_alter_post_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['date_created', 'id'], name='post_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['poster', 'date_created', 'id'], name='post_poster_created_idx'),
+        ),
+    ]
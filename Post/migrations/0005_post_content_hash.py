@@ -0,0 +1,23 @@
+# Generated by Django 3.2.8 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Post', '0004_post_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='content_hash',
+            field=models.CharField(default=None, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_digest',
+            field=models.CharField(default=None, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+POSTGRES_FORWARD = [
+	'''ALTER TABLE "Post_post" ADD COLUMN search_vector tsvector
+		GENERATED ALWAYS AS (to_tsvector('english', coalesce(text, ''))) STORED''',
+	'CREATE INDEX post_search_vector_idx ON "Post_post" USING gin (search_vector)',
+]
+POSTGRES_BACKWARD = [
+	'DROP INDEX post_search_vector_idx',
+	'ALTER TABLE "Post_post" DROP COLUMN search_vector',
+]
+
+# SQLite migrations that alter the post table rebuild it and drop these triggers, they must create them again
+SQLITE_FORWARD = [
+	'''CREATE VIRTUAL TABLE post_search USING fts5(text, content='Post_post', content_rowid='id')''',
+	'''CREATE TRIGGER post_search_insert AFTER INSERT ON "Post_post" BEGIN
+		INSERT INTO post_search(rowid, text) VALUES (new.id, coalesce(new.text, ''));
+	END''',
+	'''CREATE TRIGGER post_search_delete AFTER DELETE ON "Post_post" BEGIN
+		INSERT INTO post_search(post_search, rowid, text) VALUES ('delete', old.id, coalesce(old.text, ''));
+	END''',
+	'''CREATE TRIGGER post_search_update AFTER UPDATE OF text ON "Post_post" BEGIN
+		INSERT INTO post_search(post_search, rowid, text) VALUES ('delete', old.id, coalesce(old.text, ''));
+		INSERT INTO post_search(rowid, text) VALUES (new.id, coalesce(new.text, ''));
+	END''',
+	'''INSERT INTO post_search(post_search) VALUES ('rebuild')''',
+]
+SQLITE_BACKWARD = [
+	'DROP TRIGGER post_search_update',
+	'DROP TRIGGER post_search_delete',
+	'DROP TRIGGER post_search_insert',
+	'DROP TABLE post_search',
+]
+
+
+def run(statements):
+	'''
+		Runs the statements for the database in use, the search index is built by the database itself on
+		PostgreSQL with a generated tsvector column and on SQLite with an FTS5 table kept in sync by triggers
+	:return:
+	'''
+	def operation(apps, schema_editor):
+		for statement in statements.get(schema_editor.connection.vendor, []):
+			schema_editor.execute(statement)
+	return operation
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('Post', '0005_post_content_hash'),
+	]
+
+	operations = [
+		migrations.RunPython(
+			run({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+			run({'postgresql': POSTGRES_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+		),
+	]
@@ -1,10 +1,80 @@
+import hashlib
+import unicodedata
+
 from django.db import models
 
 
 # Create your models here.
 
 class Post(models.Model):
+	IMAGE_PENDING = 'pending'
+	IMAGE_PROCESSING = 'processing'
+	IMAGE_READY = 'ready'
+	IMAGE_FAILED = 'failed'
+	IMAGE_STATUSES = (
+		(IMAGE_PENDING, 'Pending'),
+		(IMAGE_PROCESSING, 'Processing'),
+		(IMAGE_READY, 'Ready'),
+		(IMAGE_FAILED, 'Failed'),
+	)
+
 	text = models.TextField(default=None, null=True)
 	image = models.ImageField(upload_to='post/images', default=None, null=True)
+	image_status = models.CharField(max_length=16, choices=IMAGE_STATUSES, default=None, null=True)
+	renditions = models.JSONField(default=dict, blank=True)
+	image_digest = models.CharField(max_length=64, default=None, null=True)
+	content_hash = models.CharField(max_length=64, default=None, null=True, unique=True)
 	date_created = models.DateTimeField(auto_now_add=True)
 	poster = models.ForeignKey('Account.User', on_delete=models.CASCADE)
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['date_created', 'id'], name='post_created_idx'),
+			models.Index(fields=['poster', 'date_created', 'id'], name='post_poster_created_idx'),
+			models.Index(fields=['image_status', 'id'], name='post_image_status_idx'),
+		]
+
+	@staticmethod
+	def make_content_hash(text, image_digest):
+		'''
+			The sha256 of a post's normalized text and its image's digest, two posts with the same hash are duplicates.
+			Text is compared in NFC form with runs of whitespace collapsed
+		:return:
+		'''
+		text = ' '.join(unicodedata.normalize('NFC', text).split()) if text is not None else ''
+		return hashlib.sha256(f'{text}\0{image_digest or ""}'.encode()).hexdigest()
+
+
+class PostTag(models.Model):
+	'''
+		A hashtag used in a post. The post's creation time is copied here so a tag feed is read from this table's index
+	'''
+	post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='tags')
+	tag = models.CharField(max_length=100)
+	date_created = models.DateTimeField()
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['post', 'tag'], name='unique_post_tag'),
+		]
+		indexes = [
+			models.Index(fields=['tag', 'date_created', 'post'], name='post_tag_created_idx'),
+		]
+
+
+class PostMention(models.Model):
+	'''
+		A user mentioned in a post. The post's creation time is copied here so a mention feed is read from this
+		table's index
+	'''
+	post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='mentions')
+	user = models.ForeignKey('Account.User', on_delete=models.CASCADE, related_name='mentions')
+	date_created = models.DateTimeField()
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['post', 'user'], name='unique_post_mention'),
+		]
+		indexes = [
+			models.Index(fields=['user', 'date_created', 'post'], name='post_mention_created_idx'),
+		]
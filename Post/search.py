@@ -0,0 +1,55 @@
+from django.db import connections, router
+
+from Post.models import Post
+
+# Ranks are kept as integers so they can be part of a keyset cursor
+RANK_SCALE = 1000000000
+
+# PostgreSQL ranks the generated `search_vector` column, matched through its GIN index
+POSTGRES_SEARCH = f'''
+	SELECT score, id FROM (
+		SELECT CAST(ts_rank(search_vector, query) * {RANK_SCALE} AS bigint) AS score, id
+		FROM "Post_post", websearch_to_tsquery('english', %s) query
+		WHERE search_vector @@ query
+	) ranked
+'''
+
+# SQLite ranks the `post_search` FTS5 table with bm25, which is lower for better matches
+SQLITE_SEARCH = f'''
+	SELECT score, id FROM (
+		SELECT CAST(-bm25(post_search) * {RANK_SCALE} AS INTEGER) AS score, rowid AS id
+		FROM post_search WHERE post_search MATCH %s
+	) ranked
+'''
+
+
+def sqlite_match(query):
+	'''
+		Turns a search into an FTS5 query that matches posts with all its words, quoted so that user input
+		is never read as FTS5 syntax
+	:return:
+	'''
+	return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def search_keys(query, position, limit):
+	'''
+		Returns the (rank, id) keys of the next `limit` posts matching the search after the given position,
+		best match first. It runs on the database the router picks for reading posts, a replica when the request
+		reads from one
+	:return:
+	'''
+	connection = connections[router.db_for_read(Post)]
+	if connection.vendor == 'postgresql':
+		sql, params = POSTGRES_SEARCH, [query]
+	elif connection.vendor == 'sqlite':
+		sql, params = SQLITE_SEARCH, [sqlite_match(query)]
+	else:
+		raise Exception(f'Search is not supported on {connection.vendor}')
+	if position is not None:
+		sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+		params += [position[0], position[0], position[1]]
+	sql += ' ORDER BY score DESC, id DESC LIMIT %s'
+	with connection.cursor() as cursor:
+		cursor.execute(sql, params + [limit])
+		return [tuple(row) for row in cursor.fetchall()]
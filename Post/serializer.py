@@ -1,8 +1,14 @@
+from django.core.files.storage import default_storage
+from django.db import transaction, IntegrityError
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
+from Account.models import User
 from Account.serializer import BasicUserSerializer
+from Post.images import delete_files, enqueue_image
 from Post.models import Post
+from Post.tags import index_post
+from Post.uploads import file_digest
 
 
 class PostSerializer(ModelSerializer):
@@ -10,10 +16,28 @@ class PostSerializer(ModelSerializer):
 		This serializer shows the details of a post
 	'''
 	poster = BasicUserSerializer(read_only=True)
+	renditions = serializers.SerializerMethodField()
+	# The model fields each method field reads, for FastSerializer
+	method_sources = {'renditions': ('renditions',)}
 
 	class Meta:
 		model = Post
-		fields = "__all__"
+		exclude = ('image_digest', 'content_hash')
+
+	def get_renditions(self, obj):
+		request = self.context.get('request')
+		urls = {name: default_storage.url(path) for name, path in obj.renditions.items()}
+		if request is not None:
+			return {name: request.build_absolute_uri(url) for name, url in urls.items()}
+		return urls
+
+	@staticmethod
+	def setup_eager_loading(queryset):
+		'''
+			Loads everything this serializer reads from related models in the same query as the posts
+		:return:
+		'''
+		return queryset.select_related('poster')
 
 
 class AddPostSerializer(ModelSerializer):
@@ -27,34 +51,74 @@ class AddPostSerializer(ModelSerializer):
 		fields = ('text',)
 
 	def validate(self, initial_data):
-		if self.instance and self.context['user'] != self.instance.poster:
+		if self.instance and self.context['user'].id != self.instance.poster_id:
 			raise Exception('You are not the author of this post')
 		text = initial_data.get('text', None)
 		image = self.context.get('image', None)
 		if text is None and image is None:
 			raise Exception('Query cannot be empty')
-		if Post.objects.filter(text=text, image=image).exists():
-			raise Exception('Duplicate data')
 		if image:
 			initial_data['image'] = image
+			initial_data['image_status'] = Post.IMAGE_PENDING
+			initial_data['renditions'] = {}
+			initial_data['image_digest'] = file_digest(image)
+		if self.instance:
+			text = self.instance.text if text is None else text
+		image_digest = initial_data.get('image_digest', self.instance.image_digest if self.instance else None)
+		initial_data['content_hash'] = Post.make_content_hash(text, image_digest)
+		if Post.objects.filter(content_hash=initial_data['content_hash']).exclude(
+				pk=getattr(self.instance, 'pk', None)).exists():
+			raise Exception('Duplicate data')
 		initial_data['poster'] = self.context['user']
 		return initial_data
 
 	def create(self, validated_data):
-		post = Post.objects.create(**validated_data)
-		from PIL import Image
-		if post.image:
-			image = Image.open(post.image.path)
-			image.save(post.image.path, quality=20, optimize=True)
+		upload = validated_data.pop('image', None)
+		post = Post(**validated_data)
+		try:
+			with transaction.atomic():
+				if upload is not None:
+					post.image.save(upload.name, upload, save=False)
+				post.save()
+				User.adjust_counters(post.poster_id, no_of_posts=1)
+				index_post(post)
+				enqueue_image(post)
+		except Exception as error:
+			# The row was rolled back, the image stored for it must not be left behind
+			if upload is not None and post.image:
+				post.image.storage.delete(post.image.name)
+			if isinstance(error, IntegrityError):
+				# A concurrent request stored the same content between validate() and here
+				raise Exception('Duplicate data')
+			raise
 		return post
 
 	def update(self, instance, validated_data):
-		Post.objects.filter(pk=instance.pk).update(**validated_data)
-		instance.refresh_from_db()
-		from PIL import Image
-		if 'image' in validated_data:
-			image = Image.open(instance.image.path)
-			image.save(instance.image.path, quality=20, optimize=True)
+		upload = validated_data.pop('image', None)
+		old_text, old_image = instance.text, instance.image.name
+		old_digest, old_renditions = instance.image_digest, list(instance.renditions.values())
+		stored = None
+		try:
+			with transaction.atomic():
+				if upload is not None:
+					instance.image.save(upload.name, upload, save=False)
+					validated_data['image'] = stored = instance.image.name
+				Post.objects.filter(pk=instance.pk).update(**validated_data)
+				instance.refresh_from_db(fields=[field for field in validated_data if field != 'poster'])
+				if 'text' in validated_data:
+					index_post(instance, old_text)
+				if stored is not None and old_image:
+					# Renditions of the same image are at the same paths, the new job rewrites them
+					replaced = [old_image] + (old_renditions if old_digest != instance.image_digest else [])
+					transaction.on_commit(lambda: delete_files(replaced))
+				enqueue_image(instance)
+		except Exception as error:
+			if stored is not None:
+				instance.image.storage.delete(stored)
+				instance.image.name = old_image
+			if isinstance(error, IntegrityError):
+				raise Exception('Duplicate data')
+			raise
 		return instance
 
 
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHANNEL = 'stream:posts'
+STREAM_HEARTBEAT = getattr(settings, 'STREAM_HEARTBEAT', 15)
+STREAM_QUEUE_SIZE = getattr(settings, 'STREAM_QUEUE_SIZE', 100)
+# How long EventSource clients wait before reconnecting, in milliseconds
+STREAM_RETRY = 5000
+
+
+def post_event(kind, post_id, poster_id):
+	'''
+		The compact event sent to a poster's followers when they create, edit or delete a post, clients fetch the
+		post itself through the post endpoints
+	:return:
+	'''
+	return {'type': kind, 'id': post_id, 'poster': poster_id}
+
+
+def follow_event(follower_id, followee_ids, action):
+	'''
+		The event that tells every process to start or stop streaming the followees' posts to the follower
+	:return:
+	'''
+	return {'type': 'follow', 'follower': follower_id, 'followees': list(followee_ids), 'action': action}
+
+
+class RedisStreamBroker:
+	'''
+		This broker carries stream events over a redis pub/sub channel, each process listens on a single connection
+		whatever the number of clients it streams to
+	'''
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def publish(self, event):
+		self.client.publish(STREAM_CHANNEL, json.dumps(event))
+
+	def listen(self, callback):
+		'''
+			Calls back with every published event, for ever. Events published while the connection is down are lost,
+			so a `reconnect` event is called back once listening again
+		:return:
+		'''
+		reconnected = False
+		while True:
+			try:
+				pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+				pubsub.subscribe(STREAM_CHANNEL)
+				if reconnected:
+					callback({'type': 'reconnect'})
+					reconnected = False
+				for message in pubsub.listen():
+					callback(json.loads(message['data']))
+			except Exception:
+				# A timeout, a dropped connection or an event that failed to dispatch must not stop the listener
+				logger.exception('The post stream lost its broker connection')
+				reconnected = True
+				time.sleep(1)
+
+
+class LocalStreamBroker:
+	'''
+		This is an in-process stand-in for the redis stream broker, used by tests and single process runs
+	'''
+
+	def __init__(self):
+		self.callbacks = []
+
+	def publish(self, event):
+		for callback in list(self.callbacks):
+			callback(json.loads(json.dumps(event)))
+
+	def listen(self, callback):
+		self.callbacks.append(callback)
+
+
+def encode(event):
+	'''
+		The server-sent event frame of an event, with the post ID as the event ID
+	:return:
+	'''
+	lines = [f'event: {event["type"]}']
+	if 'id' in event:
+		lines.append(f'id: {event["id"]}')
+	lines.append(f'data: {json.dumps(event)}')
+	return ('\n'.join(lines) + '\n\n').encode()
+
+
+# Streams queue (type, frame) pairs, these are the ones that do not come from the broker
+HEARTBEAT = ('heartbeat', b': keep-alive\n\n')
+RECONNECT = ('reconnect', encode({'type': 'reconnect'}))
+CLOSED = ('closed', b'')
+
+
+class Subscription:
+	'''
+		One open stream, it holds the frames waiting to be sent on the event loop that serves it and queues a
+		heartbeat every STREAM_HEARTBEAT seconds
+	'''
+
+	def __init__(self, user_id, followee_ids):
+		self.user_id = user_id
+		self.followee_ids = set(followee_ids)
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.Queue()
+		self.timer = self.loop.call_later(STREAM_HEARTBEAT, self.beat)
+
+	def beat(self):
+		self.put(HEARTBEAT)
+		self.timer = self.loop.call_later(STREAM_HEARTBEAT, self.beat)
+
+	def put(self, frame):
+		'''
+			A client that falls STREAM_QUEUE_SIZE frames behind is told to reconnect and catch up from its feed
+		:return:
+		'''
+		if self.queue.qsize() >= STREAM_QUEUE_SIZE:
+			while not self.queue.empty():
+				self.queue.get_nowait()
+			frame = RECONNECT
+		self.queue.put_nowait(frame)
+
+	def close(self):
+		self.timer.cancel()
+		self.queue.put_nowait(CLOSED)
+
+
+def deliver(subscriptions, frame):
+	for subscription in subscriptions:
+		subscription.put(frame)
+
+
+class StreamHub:
+	'''
+		This hub holds the open streams of one process, indexed by the users whose posts they receive. It listens to the
+		broker on a background thread, started by the first stream, and hands each event to the streams it concerns
+	'''
+
+	def __init__(self, broker):
+		self.broker = broker
+		self.lock = threading.Lock()
+		self.listening = False
+		self.by_followee = {}
+		self.by_user = {}
+
+	def subscribe(self, user_id, followee_ids):
+		subscription = Subscription(user_id, followee_ids)
+		with self.lock:
+			if not self.listening:
+				threading.Thread(target=self.broker.listen, args=(self.dispatch,), daemon=True).start()
+				self.listening = True
+			self.by_user.setdefault(user_id, set()).add(subscription)
+			for followee_id in subscription.followee_ids:
+				self.by_followee.setdefault(followee_id, set()).add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription):
+		with self.lock:
+			for index, key in [(self.by_user, subscription.user_id)] + \
+							  [(self.by_followee, followee_id) for followee_id in subscription.followee_ids]:
+				index.get(key, set()).discard(subscription)
+				if not index.get(key, True):
+					del index[key]
+
+	def count(self):
+		with self.lock:
+			return sum(len(subscriptions) for subscriptions in self.by_user.values())
+
+	def dispatch(self, event):
+		with self.lock:
+			if event['type'] == 'follow':
+				for subscription in self.by_user.get(event['follower'], ()):
+					for followee_id in event['followees']:
+						if event['action'] == 'follow':
+							subscription.followee_ids.add(followee_id)
+							self.by_followee.setdefault(followee_id, set()).add(subscription)
+						else:
+							subscription.followee_ids.discard(followee_id)
+							self.by_followee.get(followee_id, set()).discard(subscription)
+				return
+			if event['type'] == 'reconnect':
+				subscriptions = [subscription for user in self.by_user.values() for subscription in user]
+			else:
+				subscriptions = list(self.by_followee.get(event['poster'], ()))
+		# One frame per event and one hand-off per event loop rather than per stream, waking a loop up is what costs
+		frame = (event['type'], encode(event))
+		by_loop = {}
+		for subscription in subscriptions:
+			by_loop.setdefault(subscription.loop, []).append(subscription)
+		for loop, subscriptions in by_loop.items():
+			try:
+				loop.call_soon_threadsafe(deliver, subscriptions, frame)
+			except RuntimeError:
+				# The loop has been closed, its streams are gone
+				pass
+
+
+_brokers = {}
+_hubs = {}
+
+
+def get_stream_broker():
+	'''
+		Returns the stream broker selected by settings.STREAM_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'STREAM_BACKEND', 'redis')
+	if backend not in _brokers:
+		_brokers[backend] = LocalStreamBroker() if backend == 'local' else RedisStreamBroker()
+	return _brokers[backend]
+
+
+def get_stream_hub():
+	'''
+		Returns this process's hub for the broker selected by settings.STREAM_BACKEND
+	:return:
+	'''
+	backend = getattr(settings, 'STREAM_BACKEND', 'redis')
+	if backend not in _hubs:
+		_hubs[backend] = StreamHub(get_stream_broker())
+	return _hubs[backend]
+
+
+def publish(event):
+	get_stream_broker().publish(event)
+
+
+def authenticate(scope):
+	'''
+		Returns the user ID of the stream's JWT and the IDs the user follows, or None when it is missing or invalid.
+		The token is read from the Authorization header or, for EventSource clients that cannot set headers,
+		from the `token` query parameter
+	:return:
+	'''
+	from rest_framework.exceptions import AuthenticationFailed
+	from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+	from Account.authentication import CachedJWTAuthentication
+	from Account.graph import get_follow_graph
+	close_old_connections()
+	try:
+		authentication = CachedJWTAuthentication()
+		header = dict(scope['headers']).get(b'authorization')
+		raw_token = authentication.get_raw_token(header) if header else \
+			parse_qs(scope['query_string'].decode()).get('token', [None])[0]
+		if raw_token is None:
+			return None
+		user = authentication.get_user(authentication.get_validated_token(raw_token))
+		return user.id, get_follow_graph().following(user.id)
+	except (InvalidToken, TokenError, AuthenticationFailed):
+		return None
+	finally:
+		close_old_connections()
+
+
+def cors_headers(scope):
+	'''
+		The CORS headers of a stream response. The stream is not served through the middleware, so it allows the
+		origins of settings.CORS_WHITELIST itself, and no others
+	:return:
+	'''
+	origin = dict(scope['headers']).get(b'origin')
+	if origin is None:
+		return []
+	if origin.decode('latin-1') not in getattr(settings, 'CORS_WHITELIST', ()):
+		return [(b'vary', b'origin')]
+	return [(b'access-control-allow-origin', origin), (b'vary', b'origin')]
+
+
+async def respond(send, status, message, headers=()):
+	body = json.dumps({'status': 'Failed', 'message': message}).encode()
+	await send({'type': 'http.response.start', 'status': status,
+				'headers': [(b'content-type', b'application/json')] + list(headers)})
+	await send({'type': 'http.response.body', 'body': body})
+
+
+async def preflight(send, headers):
+	'''
+		Answers a CORS preflight, clients that send the token in the Authorization header need one
+	:return:
+	'''
+	if not any(name == b'access-control-allow-origin' for name, _ in headers):
+		return await respond(send, 403, 'Origin not allowed', headers)
+	await send({'type': 'http.response.start', 'status': 200, 'headers': headers + [
+		(b'access-control-allow-methods', b'GET, OPTIONS'), (b'access-control-allow-headers', b'authorization'),
+		(b'access-control-max-age', b'86400')]})
+	await send({'type': 'http.response.body', 'body': b''})
+
+
+async def wait_for_disconnect(receive):
+	while (await receive())['type'] != 'http.disconnect':
+		pass
+
+
+async def stream_application(scope, receive, send):
+	'''
+		The ASGI application of /post/stream/. It holds a server-sent events stream open and pushes `created`,
+		`edited` and `deleted` events for the posts of the users the client follows, with a comment every
+		STREAM_HEARTBEAT seconds to keep idle connections alive. A `reconnect` event ends the stream when the client
+		may have missed events, it should refresh its feed when it reconnects
+	:return:
+	'''
+	cors = cors_headers(scope)
+	if scope['method'] == 'OPTIONS':
+		return await preflight(send, cors)
+	if scope['method'] != 'GET':
+		return await respond(send, 405, 'Method not allowed', cors)
+	principal = await sync_to_async(authenticate)(scope)
+	if principal is None:
+		return await respond(send, 401, 'Authentication credentials were not provided or are invalid', cors)
+	subscription = get_stream_hub().subscribe(*principal)
+	disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+	disconnect.add_done_callback(lambda _: subscription.close())
+	try:
+		await send({'type': 'http.response.start', 'status': 200, 'headers': [
+			(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')] + cors})
+		await send({'type': 'http.response.body', 'body': f'retry: {STREAM_RETRY}\n\n'.encode(), 'more_body': True})
+		while True:
+			# Frames that queued up while the last ones were sent go out together
+			frames = [await subscription.queue.get()]
+			while not subscription.queue.empty():
+				frames.append(subscription.queue.get_nowait())
+			if CLOSED in frames:
+				return
+			await send({'type': 'http.response.body', 'body': b''.join(frame for _, frame in frames), 'more_body': True})
+			if RECONNECT in frames:
+				break
+		await send({'type': 'http.response.body', 'body': b''})
+	finally:
+		get_stream_hub().unsubscribe(subscription)
+		subscription.timer.cancel()
+		disconnect.cancel()
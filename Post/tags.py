@@ -0,0 +1,67 @@
+import re
+
+from Account.models import User
+from Post.models import PostTag, PostMention
+
+HASHTAG_PATTERN = re.compile(r'(?<![\w#])#(\w{1,100})')
+MENTION_PATTERN = re.compile(r'(?<![\w@])@([\w.@+-]{0,149}\w)')
+
+
+def extract_tags(text):
+	'''
+		The lowercased hashtags in a post's text, e.g {'django'} for "Hello #Django"
+	:return:
+	'''
+	return {tag.lower() for tag in HASHTAG_PATTERN.findall(text or '')}
+
+
+def extract_mentions(text):
+	'''
+		The usernames mentioned in a post's text, e.g {'louis'} for "Hi @louis."
+	:return:
+	'''
+	return set(MENTION_PATTERN.findall(text or ''))
+
+
+def tag_rows(posts):
+	return [PostTag(post_id=post.id, tag=tag, date_created=post.date_created)
+			for post in posts for tag in extract_tags(post.text)]
+
+
+def mention_rows(posts):
+	'''
+		The mentions of these posts that name existing users, resolved with one query
+	:return:
+	'''
+	mentions = {post.id: extract_mentions(post.text) for post in posts}
+	usernames = set().union(*mentions.values())
+	if not usernames:
+		return []
+	users = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+	return [PostMention(post_id=post.id, user_id=users[username], date_created=post.date_created)
+			for post in posts for username in mentions[post.id] if username in users]
+
+
+def index_post(post, old_text=None):
+	'''
+		Brings the hashtag and mention rows of a post in line with its text. `old_text` is the text the rows were
+		last built from, only what changed between the two is written, so posts without tags or mentions cost
+		no queries. It should run in the same transaction as the change to the post
+	:return:
+	'''
+	old_tags, new_tags = extract_tags(old_text), extract_tags(post.text)
+	if old_tags - new_tags:
+		PostTag.objects.filter(post_id=post.id, tag__in=old_tags - new_tags).delete()
+	if new_tags - old_tags:
+		PostTag.objects.bulk_create([PostTag(post_id=post.id, tag=tag, date_created=post.date_created)
+									 for tag in new_tags - old_tags], ignore_conflicts=True)
+	old_mentions, new_mentions = extract_mentions(old_text), extract_mentions(post.text)
+	if old_mentions == new_mentions:
+		return
+	# Rows are kept by user ID, a mentioned user may have been renamed since their row was written
+	user_ids = list(User.objects.filter(username__in=new_mentions).values_list('id', flat=True)) if new_mentions else []
+	if old_mentions - new_mentions:
+		PostMention.objects.filter(post_id=post.id).exclude(user_id__in=user_ids).delete()
+	if new_mentions - old_mentions:
+		PostMention.objects.bulk_create([PostMention(post_id=post.id, user_id=user_id, date_created=post.date_created)
+										 for user_id in user_ids], ignore_conflicts=True)
@@ -1,3 +1,1145 @@
-from django.test import TestCase
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from PIL import Image
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from Account.graph import get_follow_graph
+from Account.models import User
+from Post.feeds import fan_out_post, following_keys
+from Post.images import RENDITIONS, render_image
+from Post.models import Post, PostTag, PostMention
+from Post.serializer import PostSerializer
+from Post.timeline import get_timeline_store
+from Post import trends
+from Post.trends import get_trend_store, post_terms, TRENDS_HALF_LIFE
+from Utilities.conditional import bump_versions
+from Utilities.metrics import get_metric_store
+from Utilities.replicas import pin_key
 
 # Create your tests here.
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+TEST_SETTINGS = dict(
+	CACHES={'default': {'BACKEND': 'Utilities.local_cache.TwoTierCache',
+						'OPTIONS': {'REMOTE': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}}},
+	CACHE_INVALIDATION_BACKEND='local',
+	TIMELINE_BACKEND='local',
+	FOLLOW_GRAPH_BACKEND='local',
+	STREAM_BACKEND='local',
+	IMAGE_QUEUE_BACKEND='sync',
+	TRENDS_BACKEND='local',
+	METRICS_BACKEND='local',
+	MEDIA_ROOT=MEDIA_ROOT,
+)
+
+
+# A second database standing in for a read replica. It is registered before the runner sets up the test databases,
+# which creates and migrates it like the default one, and it is separate from the default so replica lag shows
+REPLICA = 'replica'
+connections.databases.setdefault(REPLICA, dict(connections.databases['default'], TEST={
+	'NAME': None if 'sqlite' in connections.databases['default']['ENGINE'] else
+	f'test_{connections.databases["default"]["NAME"]}_replica'}))
+
+# The most queries each endpoint may run per request, whatever the number of posts or users involved
+QUERY_BUDGETS = {
+	'list': 2,
+	'list_following': 3,
+	'retrieve': 1,
+	'create': 5,
+	'edit': 4,
+	'delete': 5,
+}
+
+
+def image_file(name='image.png', color='red', size=(32, 32)):
+	buffer = io.BytesIO()
+	Image.new('RGB', size, color).save(buffer, 'PNG')
+	return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(**TEST_SETTINGS)
+class PostTestCase(TestCase):
+	'''
+		The base test case for post tests, it runs against the local cache and timeline stand-ins
+	'''
+
+	@classmethod
+	def tearDownClass(cls):
+		super().tearDownClass()
+		shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+	def setUp(self):
+		get_timeline_store().clear()
+		get_follow_graph().clear()
+		get_trend_store().clear()
+		get_metric_store().clear()
+		cache.clear()
+		self.user = User.objects.create_user(username='reader', password='password')
+		self.author = User.objects.create_user(username='author', password='password')
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+
+	def follow(self, followee):
+		return self.client.post(f'/user/{followee.id}/action/', {'action': 'follow'}, format='multipart')
+
+	def unfollow(self, followee):
+		return self.client.post(f'/user/{followee.id}/action/', {'action': 'unfollow'}, format='multipart')
+
+	def publish(self, author, text):
+		post = Post.objects.create(poster=author, text=text)
+		fan_out_post(post)
+		return post
+
+	def create(self, text, color='red'):
+		response = self.client.post('/post/create/', {'text': text, 'image': image_file(color=color)}, format='multipart')
+		self.assertEqual(response.status_code, 200, response.data)
+		return response.data['data']
+
+	@contextmanager
+	def assertWithinBudget(self, endpoint):
+		'''
+			Fails when the wrapped request runs more queries than QUERY_BUDGETS allows for the endpoint.
+			Savepoints are not counted, they are how TestCase nests the transactions a request opens
+		:return:
+		'''
+		with CaptureQueriesContext(connection) as context:
+			yield context
+		queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+		self.assertLessEqual(len(queries), QUERY_BUDGETS[endpoint],
+							 f'{endpoint} ran {len(queries)} queries, over its budget:\n' + '\n'.join(queries))
+
+	def following_ids(self, user):
+		return [post_id for _, post_id in following_keys(user, None, 100)]
+
+	def walk(self, url):
+		'''
+			Follows the `next` cursors of a feed and returns the IDs of every page
+		:return:
+		'''
+		pages = []
+		while url:
+			response = self.client.get(url)
+			self.assertEqual(response.status_code, 200)
+			pages.append([post['id'] for post in response.data['results']])
+			url = response.data['next']
+		return pages
+
+
+class TimelineTest(PostTestCase):
+
+	def test_fan_out_reaches_followers(self):
+		self.follow(self.author)
+		post = self.publish(self.author, 'hello')
+		self.assertEqual([entry[0] for entry in get_timeline_store().range(self.user.id)], [post.id])
+		self.assertEqual(self.following_ids(self.user), [post.id])
+
+	def test_unfollow_removes_entries(self):
+		self.follow(self.author)
+		self.publish(self.author, 'hello')
+		self.unfollow(self.author)
+		self.assertEqual(get_timeline_store().range(self.user.id), [])
+
+	def test_delete_removes_entries(self):
+		self.follow(self.author)
+		post = self.publish(self.author, 'hello')
+		self.client.force_authenticate(self.author)
+		self.client.delete(f'/post/{post.id}/')
+		self.assertEqual(get_timeline_store().range(self.user.id), [])
+
+	def test_cold_timeline_is_rebuilt(self):
+		self.follow(self.author)
+		post = Post.objects.create(poster=self.author, text='before the timeline existed')
+		self.assertEqual(self.following_ids(self.user), [post.id])
+
+	def test_heavy_poster_is_read_on_demand(self):
+		self.follow(self.author)
+		with mock.patch('Post.feeds.TIMELINE_FANOUT_LIMIT', 0):
+			post = self.publish(self.author, 'hello')
+		self.assertIn(self.author.id, get_timeline_store().heavy_users())
+		self.assertEqual(get_timeline_store().range(self.user.id), [])
+		self.assertEqual(self.following_ids(self.user), [post.id])
+
+
+class FeedPaginationTest(PostTestCase):
+
+	def test_pages_follow_cursor(self):
+		posts = [Post.objects.create(poster=self.author, text=f'post {index}') for index in range(5)]
+		Post.objects.filter(id__in=[posts[1].id, posts[2].id, posts[3].id]).update(date_created=posts[1].date_created)
+		expected = [post.id for post in sorted(Post.objects.all(), key=lambda post: (post.date_created, post.id),
+											   reverse=True)]
+		pages = self.walk('/post/?choice=all&page_size=2')
+		self.assertEqual([len(page) for page in pages], [2, 2, 1])
+		self.assertEqual(sum(pages, []), expected)
+
+	def test_following_feed_pages_over_timeline(self):
+		self.follow(self.author)
+		posts = [self.publish(self.author, f'post {index}') for index in range(3)]
+		pages = self.walk('/post/?choice=following&page_size=2')
+		self.assertEqual(sum(pages, []), [post.id for post in reversed(posts)])
+
+	def test_page_size_is_capped(self):
+		with mock.patch('Utilities.pagination.KeysetPagination.max_page_size', 1):
+			Post.objects.create(poster=self.author, text='one')
+			Post.objects.create(poster=self.author, text='two')
+			self.assertEqual(len(self.client.get('/post/?page_size=50').data['results']), 1)
+
+	def test_invalid_cursor(self):
+		self.assertEqual(self.client.get('/post/?cursor=nonsense').status_code, 400)
+		# A cursor must hold a whole key, here a single integer
+		response = self.client.get('/post/?cursor=MTIz')
+		self.assertEqual((response.status_code, response.data['message']), (400, 'Invalid cursor'))
+
+
+class FeedCacheTest(PostTestCase):
+
+	def test_feeds_cache_ids_and_render_like_post_serializer(self):
+		self.client.force_authenticate(self.author)
+		created = self.create('hello')
+		self.client.force_authenticate(self.user)
+		response = self.client.get('/post/')
+		self.assertEqual(cache.get('all_posts_shared')['value'], [(mock.ANY, created['id'])])
+		expected = PostSerializer(Post.objects.get(id=created['id']), context={'request': response.wsgi_request}).data
+		self.assertEqual(response.data['results'], [expected])
+
+	def test_create_edit_and_delete_invalidate_feeds(self):
+		self.client.force_authenticate(self.author)
+		self.assertEqual(self.walk('/post/?choice=mine'), [[]])
+		created = self.create('hello')
+		self.assertEqual(self.walk('/post/?choice=mine'), [[created['id']]])
+		self.client.patch(f'/post/{created["id"]}/edit/', {'text': 'edited'}, format='multipart')
+		self.assertEqual(self.client.get('/post/?choice=mine').data['results'][0]['text'], 'edited')
+		self.client.delete(f'/post/{created["id"]}/')
+		self.assertEqual(self.walk('/post/?choice=mine'), [[]])
+
+	def test_follow_and_user_edit_invalidate_feeds(self):
+		self.client.force_authenticate(self.author)
+		created = self.create('hello')
+		self.client.force_authenticate(self.user)
+		self.assertEqual(self.walk('/post/?choice=followers'), [[]])
+		self.client.force_authenticate(self.author)
+		self.follow(self.user)
+		self.client.force_authenticate(self.user)
+		self.assertEqual(self.walk('/post/?choice=followers'), [[created['id']]])
+		self.client.force_authenticate(self.author)
+		self.client.patch('/user/edit/', {'username': 'renamed'}, format='multipart')
+		self.assertEqual(self.client.get('/post/').data['results'][0]['poster']['username'], 'renamed')
+
+
+class QueryBudgetTest(PostTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.follow(self.author)
+		for index in range(12):
+			poster = User.objects.create_user(username=f'poster{index}', password='password')
+			self.client.force_authenticate(poster)
+			self.follow(self.user)
+			self.publish(poster, f'post {index}')
+			self.publish(self.author, f'author post {index}')
+		self.client.force_authenticate(self.user)
+		cache.clear()
+
+	def test_list(self):
+		for choice in ('all', 'mine', 'followers'):
+			with self.assertWithinBudget('list'):
+				response = self.client.get(f'/post/?choice={choice}&page_size=50')
+			self.assertEqual(response.status_code, 200)
+		with self.assertWithinBudget('list_following'):
+			response = self.client.get('/post/?choice=following&page_size=50')
+		self.assertEqual(len(response.data['results']), 12)
+
+	def test_retrieve(self):
+		post = Post.objects.first()
+		with self.assertWithinBudget('retrieve'):
+			response = self.client.get(f'/post/{post.id}/')
+		self.assertEqual(response.status_code, 200)
+
+	def test_create_edit_and_delete(self):
+		with self.assertWithinBudget('create'):
+			created = self.create('hello')
+		with self.assertWithinBudget('edit'):
+			response = self.client.patch(f'/post/{created["id"]}/edit/', {'text': 'edited'}, format='multipart')
+		self.assertEqual(response.status_code, 200)
+		with self.assertWithinBudget('delete'):
+			response = self.client.delete(f'/post/{created["id"]}/')
+		self.assertEqual(response.status_code, 204)
+
+
+class ImagePipelineTest(PostTestCase):
+
+	def test_upload_is_acknowledged_then_processed(self):
+		with self.captureOnCommitCallbacks() as callbacks:
+			response = self.client.post('/post/create/', {'text': 'hi', 'image': image_file(size=(1000, 500))},
+										format='multipart')
+		self.assertEqual(response.data['data']['image_status'], Post.IMAGE_PENDING)
+		self.assertEqual(response.data['data']['renditions'], {})
+		for callback in callbacks:
+			callback()
+		post = self.client.get(f'/post/{response.data["data"]["id"]}/').data
+		self.assertEqual(post['image_status'], Post.IMAGE_READY)
+		self.assertEqual(set(post['renditions']), set(RENDITIONS))
+		digest = Post.objects.get(id=post['id']).image_digest
+		with Image.open(f'{MEDIA_ROOT}/post/renditions/{post["id"]}/{digest}/feed.jpg') as feed:
+			self.assertEqual(feed.size, (600, 300))
+
+	def test_edited_image_is_processed_again(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			created = self.create('hi')
+		with self.captureOnCommitCallbacks(execute=True):
+			response = self.client.patch(f'/post/{created["id"]}/edit/', {'image': image_file('new.png', 'blue')},
+										 format='multipart')
+		post = Post.objects.get(id=created['id'])
+		self.assertEqual(response.data['data']['image_status'], Post.IMAGE_PENDING)
+		self.assertEqual(post.image_status, Post.IMAGE_READY)
+		self.assertTrue(post.image.name.startswith('post/images/new'))
+
+
+	def test_replaced_images_and_renditions_are_deleted(self):
+		import os
+		with self.captureOnCommitCallbacks(execute=True):
+			created = self.create('hi')
+		old = Post.objects.get(id=created['id'])
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.patch(f'/post/{created["id"]}/edit/', {'image': image_file('new.png', 'blue')},
+							  format='multipart')
+		new = Post.objects.get(id=created['id'])
+		self.assertFalse(any(os.path.exists(f'{MEDIA_ROOT}/{path}') for path in
+							 [old.image.name] + list(old.renditions.values())))
+		self.assertTrue(all(os.path.exists(f'{MEDIA_ROOT}/{path}') for path in
+							[new.image.name] + list(new.renditions.values())))
+
+	def test_a_superseded_job_does_not_keep_its_renditions(self):
+		import os
+		from Post import images
+		with self.captureOnCommitCallbacks():
+			created = self.create('hi')
+		written = {}
+
+		def replaced_meanwhile(post):
+			written.update(make_renditions(post))
+			Post.objects.filter(id=post.id).update(image='post/images/other.png', image_digest='other',
+												   image_status=Post.IMAGE_PENDING)
+			return written
+
+		make_renditions = images.make_renditions
+		with mock.patch.object(images, 'make_renditions', replaced_meanwhile):
+			images.process_image(created['id'])
+		self.assertEqual(Post.objects.get(id=created['id']).image_status, Post.IMAGE_PENDING)
+		self.assertTrue(written)
+		self.assertFalse(any(os.path.exists(f'{MEDIA_ROOT}/{path}') for path in written.values()))
+
+	def test_images_of_failed_writes_are_not_left_behind(self):
+		import os
+		from django.db import IntegrityError
+		created = self.create('hi')
+		image = Post.objects.get(id=created['id']).image.name
+		images = set(os.listdir(f'{MEDIA_ROOT}/post/images'))
+		with mock.patch('Post.serializer.enqueue_image', side_effect=IntegrityError):
+			response = self.client.patch(f'/post/{created["id"]}/edit/', {'image': image_file('new.png', 'blue')},
+										 format='multipart')
+			self.assertEqual(response.data['message'], 'Duplicate data')
+			response = self.client.post('/post/create/', {'text': 'other', 'image': image_file('other.png', 'blue')},
+										format='multipart')
+			self.assertEqual(response.data['message'], 'Duplicate data')
+		self.assertEqual(set(os.listdir(f'{MEDIA_ROOT}/post/images')), images)
+		self.assertEqual(Post.objects.get(id=created['id']).image.name, image)
+
+	def test_a_job_that_raises_marks_the_post_failed(self):
+		from Post.images import run_job
+		with self.captureOnCommitCallbacks():
+			created = self.create('hi')
+		with mock.patch.object(Post.objects, 'get', side_effect=OSError('storage is down')):
+			run_job(created['id'])
+		self.assertEqual(Post.objects.filter(id=created['id']).values_list('image_status', flat=True).get(),
+						 Post.IMAGE_FAILED)
+
+class ImageIngestionTest(PostTestCase):
+
+	def test_upload_over_byte_limit_is_stopped(self):
+		with mock.patch('Post.uploads.MAX_IMAGE_BYTES', 50):
+			response = self.client.post('/post/create/', {'text': 'hi', 'image': image_file()}, format='multipart')
+		self.assertEqual(response.status_code, 400)
+		self.assertFalse(Post.objects.exists())
+
+	def test_upload_over_pixel_limit_is_stopped_before_decoding(self):
+		image = image_file()
+		with mock.patch('Post.uploads.MAX_IMAGE_PIXELS', 32 * 32 - 1), mock.patch('PIL.Image.Image.load') as load:
+			response = self.client.post('/post/create/', {'text': 'hi', 'image': image}, format='multipart')
+		self.assertEqual(response.status_code, 400)
+		self.assertIn('pixels', response.data['message'])
+		load.assert_not_called()
+
+	def test_decompression_bomb_header_is_stopped(self):
+		from Post.uploads import check_image_header
+		buffer = io.BytesIO()
+		Image.new('1', (20000, 20000)).save(buffer, 'PNG')
+		with self.assertRaisesRegex(ValueError, 'pixels'):
+			check_image_header(buffer.getvalue()[:1024])
+		buffer.seek(0)
+		response = self.client.post('/post/create/', {'text': 'hi', 'image': SimpleUploadedFile(
+			'bomb.png', buffer.getvalue(), content_type='image/png')}, format='multipart')
+		self.assertEqual(response.status_code, 400)
+		self.assertIn('cannot be more than', response.data['message'])
+
+	def test_large_jpeg_is_decoded_in_draft_mode(self):
+		from PIL.JpegImagePlugin import JpegImageFile
+		buffer = io.BytesIO()
+		Image.new('RGB', (8000, 6000), 'green').save(buffer, 'JPEG')
+		buffer.seek(0)
+		with mock.patch.object(JpegImageFile, 'draft', autospec=True, side_effect=JpegImageFile.draft) as draft:
+			encoded = render_image(buffer)
+		draft.assert_any_call(mock.ANY, 'RGB', (2048, 2048))
+		with Image.open(io.BytesIO(encoded['full'])) as full:
+			self.assertEqual(full.size, (2048, 1536))
+
+
+class DuplicateTest(PostTestCase):
+
+	def test_duplicates_are_found_by_hash(self):
+		self.create('hello  world')
+		response = self.client.post('/post/create/', {'text': 'hello world', 'image': image_file()}, format='multipart')
+		self.assertEqual(response.data['message'], 'Duplicate data')
+		self.create('hello world', color='blue')
+		self.assertEqual(Post.objects.count(), 2)
+
+	def test_edit_to_a_duplicate_is_rejected(self):
+		self.create('first')
+		second = self.create('second')
+		response = self.client.patch(f'/post/{second["id"]}/edit/', {'text': 'first'}, format='multipart')
+		self.assertEqual(response.data['message'], 'Duplicate data')
+
+	def test_concurrent_duplicate_is_rejected_by_the_index(self):
+		from Post.serializer import AddPostSerializer
+		serializer = AddPostSerializer(data={'text': 'hello'}, context={'user': self.user})
+		serializer.is_valid(raise_exception=True)
+		Post.objects.create(poster=self.author, text='hello', content_hash=Post.make_content_hash('hello', None))
+		with self.assertRaisesMessage(Exception, 'Duplicate data'):
+			serializer.save()
+
+	def test_backfill(self):
+		first = Post.objects.create(poster=self.author, text='hello')
+		second = Post.objects.create(poster=self.author, text=' hello ')
+		output = io.StringIO()
+		call_command('backfill_content_hashes', batch_size=1, stdout=output)
+		first.refresh_from_db()
+		second.refresh_from_db()
+		self.assertEqual(first.content_hash, Post.make_content_hash('hello', None))
+		self.assertIsNone(second.content_hash)
+		self.assertIn('Backfilled 1 posts, 1 duplicates', output.getvalue())
+
+
+class SearchTest(PostTestCase):
+
+	def search(self, query):
+		return [[post['text'] for post in page] for page in self.walk_search(f'/post/search/?q={query}&page_size=2')]
+
+	def walk_search(self, url):
+		while url:
+			response = self.client.get(url)
+			self.assertEqual(response.status_code, 200, response.data)
+			yield response.data['results']
+			url = response.data['next']
+
+	def test_results_are_ranked_and_paginated(self):
+		self.publish(self.author, 'coffee and tea')
+		self.publish(self.author, 'coffee coffee coffee')
+		self.publish(self.author, 'only tea here')
+		self.publish(self.author, 'coffee time')
+		for index in range(6):
+			self.publish(self.author, f'unrelated post {index}')
+		pages = self.search('coffee')
+		self.assertEqual(pages[0][0], 'coffee coffee coffee')
+		self.assertEqual(sorted(text for page in pages for text in page), ['coffee and tea', 'coffee coffee coffee',
+																			'coffee time'])
+		self.assertEqual([len(page) for page in pages], [2, 1])
+		self.assertEqual(self.search('coffee tea'), [['coffee and tea']])
+
+	def test_index_follows_edits_and_deletes(self):
+		post = self.create('hello world')
+		self.client.patch(f'/post/{post["id"]}/edit/', {'text': 'goodbye world'}, format='multipart')
+		self.assertEqual(self.search('hello'), [[]])
+		self.assertEqual(self.search('goodbye'), [['goodbye world']])
+		self.client.delete(f'/post/{post["id"]}/')
+		self.assertEqual(self.search('world'), [[]])
+
+	def test_search_input_is_not_query_syntax(self):
+		self.publish(self.author, 'say "hi" (now)')
+		self.assertEqual(self.search('"hi" OR NEAR('), [[]])
+		self.assertEqual(self.search('"hi"'), [['say "hi" (now)']])
+		self.assertEqual(self.client.get('/post/search/?q=').data['message'], 'Please enter a search query')
+
+
+class TagTest(PostTestCase):
+
+	def texts(self, url):
+		return [[Post.objects.get(id=post_id).text for post_id in page] for page in self.walk(url)]
+
+	def test_tags_and_mentions_are_indexed_on_write(self):
+		self.create('Hello #Django and #python @author')
+		self.create('more #django, mail me at user@example.com')
+		self.create('nothing here')
+		self.assertEqual(self.texts('/post/tags/django/?page_size=1'),
+						 [['more #django, mail me at user@example.com'], ['Hello #Django and #python @author']])
+		self.assertEqual(self.texts(f'/post/mentions/{self.author.id}/'), [['Hello #Django and #python @author']])
+		self.assertEqual(self.texts('/post/tags/example/'), [[]])
+		self.assertEqual(self.texts(f'/post/mentions/{self.user.id}/'), [[]])
+
+	def test_index_follows_edits_and_deletes(self):
+		post = self.create('#one #two @author')
+		self.client.patch(f'/post/{post["id"]}/edit/', {'text': '#two #three @reader'}, format='multipart')
+		self.assertEqual(sorted(PostTag.objects.values_list('tag', flat=True)), ['three', 'two'])
+		self.assertEqual(list(PostMention.objects.values_list('user_id', flat=True)), [self.user.id])
+		self.client.delete(f'/post/{post["id"]}/')
+		self.assertFalse(PostTag.objects.exists())
+		self.assertFalse(PostMention.objects.exists())
+
+	def test_mentions_of_renamed_users_are_removed_on_edit(self):
+		post = self.create('hi @author')
+		User.objects.filter(id=self.author.id).update(username='renamed')
+		self.client.patch(f'/post/{post["id"]}/edit/', {'text': 'hi @reader'}, format='multipart')
+		self.assertEqual(list(PostMention.objects.values_list('user_id', flat=True)), [self.user.id])
+		self.assertEqual(self.texts(f'/post/mentions/{self.author.id}/'), [[]])
+
+	def test_backfill(self):
+		Post.objects.create(poster=self.author, text='#old @reader')
+		Post.objects.create(poster=self.author, text='#old #news')
+		output = io.StringIO()
+		call_command('backfill_post_index', batch_size=1, stdout=output)
+		call_command('backfill_post_index', stdout=io.StringIO())
+		self.assertIn('Indexed 3 hashtags and 1 mentions in 2 posts', output.getvalue())
+		self.assertEqual(PostTag.objects.filter(tag='old').count(), 2)
+		self.assertEqual(PostMention.objects.get().user_id, self.user.id)
+
+
+class TrendTest(PostTestCase):
+
+	def test_terms(self):
+		self.assertEqual(post_terms('Loving #Django with @author, see https://example.com and this really great framework'),
+						 {'#django', 'loving', 'really', 'great', 'framework'})
+
+	def test_created_posts_trend(self):
+		self.create('#launch day')
+		self.create('#launch party')
+		self.create('quiet evening')
+		with self.assertNumQueries(0):
+			data = self.client.get('/trends/').data['data']
+		self.assertEqual(data[0], {'name': '#launch', 'score': 2.0})
+		self.assertEqual({entry['name'] for entry in data}, {'#launch', 'party', 'quiet', 'evening'})
+
+	def test_counters_decay_and_compact(self):
+		store = get_trend_store()
+		now = 1000000.0
+		for _ in range(4):
+			store.record({'old'}, now)
+		store.record({'new'}, now + 3 * TRENDS_HALF_LIFE)
+		store.record({'new'}, now + 3 * TRENDS_HALF_LIFE)
+		top = store.top(now + 3 * TRENDS_HALF_LIFE)
+		self.assertEqual([term for term, _ in top], ['new', 'old'])
+		self.assertAlmostEqual(dict(top)['old'], 0.5)
+		with mock.patch.object(trends, 'TRENDS_CAPACITY', 1):
+			store.compact(now + 3 * TRENDS_HALF_LIFE)
+		self.assertEqual(list(store.scores), ['new'])
+		# Far enough ahead the counters are rebased and keep their decayed values
+		later = now + (trends.REBASE_AFTER + 1) * TRENDS_HALF_LIFE
+		store.compact(later)
+		self.assertEqual(store.landmark, later)
+		store.record({'new'}, later)
+		self.assertAlmostEqual(dict(store.top(later + TRENDS_HALF_LIFE))['new'], 0.5)
+
+
+class ConditionalGetTest(PostTestCase):
+
+	def get(self, url, etag):
+		return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+	def test_unchanged_feed_is_not_modified_without_queries(self):
+		from Utilities.conditional import conditional_responses
+		self.follow(self.author)
+		self.publish(self.author, 'hello')
+		response = self.client.get('/post/?choice=following')
+		self.assertEqual(response.status_code, 200)
+		self.assertNotIn('Last-Modified', response)
+		with self.assertNumQueries(0):
+			response = self.get('/post/?choice=following', response['ETag'])
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(dict((labels['result'], value) for labels, value in conditional_responses.values()
+							  if labels['endpoint'] == 'feed'), {'full': 1, 'not_modified': 1})
+		# Versions change within a second, only the ETag tells whether the content did
+		self.assertEqual(self.client.get('/post/?choice=following',
+										 HTTP_IF_MODIFIED_SINCE='Sun, 18 Oct 2099 00:00:00 GMT').status_code, 200)
+
+	def test_changes_bump_the_feed_version(self):
+		post = self.create('hello')
+		for choice in ('all', 'mine'):
+			etag = self.client.get(f'/post/?choice={choice}')['ETag']
+			self.assertEqual(self.get(f'/post/?choice={choice}', etag).status_code, 304)
+			self.assertNotEqual(self.client.get(f'/post/?choice={choice}&page_size=5')['ETag'], etag)
+		etags = {choice: self.client.get(f'/post/?choice={choice}')['ETag'] for choice in ('all', 'mine')}
+		self.client.patch(f'/post/{post["id"]}/edit/', {'text': 'edited'}, format='multipart')
+		self.assertEqual(self.get('/post/?choice=mine', etags['mine']).status_code, 200)
+		etag = self.client.get('/post/?choice=all')['ETag']
+		self.client.delete(f'/post/{post["id"]}/')
+		self.assertEqual(self.get('/post/?choice=all', etag).status_code, 200)
+
+	def test_fan_out_and_follows_bump_the_following_feed(self):
+		self.follow(self.author)
+		etag = self.client.get('/post/?choice=following')['ETag']
+		self.client.force_authenticate(self.author)
+		self.create('hello')
+		self.client.force_authenticate(self.user)
+		response = self.get('/post/?choice=following', etag)
+		self.assertEqual([post['text'] for post in response.data['results']], ['hello'])
+		self.unfollow(self.author)
+		self.assertEqual(self.get('/post/?choice=following', response['ETag']).status_code, 200)
+
+	def test_edits_only_bump_the_feeds_and_profiles_showing_them(self):
+		from Post.events import user_edited
+		self.follow(self.author)
+		self.client.force_authenticate(self.author)
+		post = self.create('hello')
+		self.client.force_authenticate(self.user)
+		urls = ('/post/?choice=following', '/post/?choice=mine', '/user/', '/user/?expand=following')
+		etags = {url: self.client.get(url)['ETag'] for url in urls}
+		self.client.force_authenticate(self.author)
+		self.client.patch(f'/post/{post["id"]}/edit/', {'text': 'edited'}, format='multipart')
+		self.client.force_authenticate(self.user)
+		self.assertEqual(self.get('/post/?choice=mine', etags['/post/?choice=mine']).status_code, 304)
+		self.assertEqual(self.get('/user/', etags['/user/']).status_code, 304)
+		response = self.get('/post/?choice=following', etags['/post/?choice=following'])
+		self.assertEqual([post['text'] for post in response.data['results']], ['edited'])
+		user_edited(self.author)
+		self.assertEqual(self.get('/post/?choice=mine', etags['/post/?choice=mine']).status_code, 304)
+		self.assertEqual(self.get('/post/?choice=following', response['ETag']).status_code, 200)
+		# Only the expanded profile lists the author
+		self.assertEqual(self.get('/user/', etags['/user/']).status_code, 304)
+		response = self.get('/user/?expand=following', etags['/user/?expand=following'])
+		self.assertEqual(response.status_code, 200)
+		# Users listed too widely bump every expanded profile once instead of each one
+		with mock.patch('Post.events.TIMELINE_FANOUT_LIMIT', 0), \
+				mock.patch('Post.events.bump_versions', wraps=bump_versions) as bump:
+			user_edited(self.author)
+		self.assertIn('listed_users', bump.call_args[0][0])
+		self.assertNotIn(f'listed_users_{self.user.id}', bump.call_args[0][0])
+		self.assertEqual(self.get('/user/?expand=following', response['ETag']).status_code, 200)
+
+	def test_profile_is_conditional(self):
+		etag = self.client.get('/user/')['ETag']
+		with self.assertNumQueries(0):
+			self.assertEqual(self.get('/user/', etag).status_code, 304)
+		self.follow(self.author)
+		response = self.get('/user/', etag)
+		self.assertEqual(response.data['data']['no_of_following'], 1)
+		self.client.force_authenticate(self.author)
+		self.create('hello')
+		self.client.force_authenticate(self.user)
+		self.assertEqual(self.get('/user/', response['ETag']).status_code, 304)
+
+
+class FastSerializerTest(PostTestCase):
+
+	def test_output_is_byte_identical(self):
+		from rest_framework.renderers import JSONRenderer
+		from rest_framework.test import APIRequestFactory
+		from Utilities.fast_serializer import FastSerializer
+		self.create('with an image')
+		Post.objects.create(poster=self.author, text=None, image_status=Post.IMAGE_FAILED)
+		Post.objects.create(poster=self.user, text='plain \u00e9 "quoted"')
+		request = APIRequestFactory().get('/post/')
+		for context in ({}, {'request': request}):
+			posts = PostSerializer.setup_eager_loading(Post.objects.order_by('id'))
+			fast = FastSerializer(PostSerializer, context=context)
+			self.assertEqual(JSONRenderer().render(fast.queryset(Post.objects.order_by('id'))),
+							 JSONRenderer().render(PostSerializer(posts, many=True, context=context).data))
+		self.assertNotIn('image_digest', FastSerializer(PostSerializer).columns)
+
+
+class StreamTest(PostTestCase):
+
+	def author_client(self):
+		client = APIClient()
+		client.force_authenticate(self.author)
+		return client
+
+	async def open(self, token, method='GET', headers=()):
+		from asgiref.testing import ApplicationCommunicator
+		from CloneTwitter.asgi import application
+		communicator = ApplicationCommunicator(application, {
+			'type': 'http', 'method': method, 'path': '/post/stream/', 'query_string': f'token={token}'.encode(),
+			'headers': list(headers)})
+		await communicator.send_input({'type': 'http.request', 'body': b''})
+		return communicator
+
+	async def next_event(self, communicator):
+		body = (await communicator.receive_output(1))['body'].decode()
+		return dict(line.split(': ', 1) for line in body.strip().split('\n'))
+
+	def test_followed_posts_are_streamed(self):
+		from asgiref.sync import async_to_sync, sync_to_async
+		self.follow(self.author)
+		author = self.author_client()
+
+		async def scenario():
+			communicator = await self.open(self.user.tokens()['access'])
+			start = await communicator.receive_output(1)
+			self.assertEqual((start['status'], dict(start['headers'])[b'content-type']), (200, b'text/event-stream'))
+			self.assertEqual((await communicator.receive_output(1))['body'], b'retry: 5000\n\n')
+			response = await sync_to_async(author.post)('/post/create/', {'text': 'hello'}, format='multipart')
+			post_id = response.data['data']['id']
+			event = await self.next_event(communicator)
+			self.assertEqual((event['event'], event['id']), ('created', str(post_id)))
+			self.assertEqual(json.loads(event['data']), {'type': 'created', 'id': post_id, 'poster': self.author.id})
+			await sync_to_async(author.patch)(f'/post/{post_id}/edit/', {'text': 'edited'}, format='multipart')
+			self.assertEqual((await self.next_event(communicator))['event'], 'edited')
+			await sync_to_async(author.delete)(f'/post/{post_id}/')
+			self.assertEqual((await self.next_event(communicator))['event'], 'deleted')
+			# Posts of users the reader does not follow, or stops following, are not streamed
+			await sync_to_async(self.unfollow)(self.author)
+			await sync_to_async(author.post)('/post/create/', {'text': 'unseen'}, format='multipart')
+			self.assertTrue(await communicator.receive_nothing(0.1))
+			await communicator.send_input({'type': 'http.disconnect'})
+			await communicator.wait(1)
+		async_to_sync(scenario)()
+		from Post.stream import get_stream_hub
+		self.assertEqual(get_stream_hub().count(), 0)
+
+	def test_wsgi_points_streams_to_the_stream_process(self):
+		response = self.client.get('/post/stream/')
+		self.assertEqual((response.status_code, response.data['message']),
+						 (404, 'The post stream is served by the stream process, not this one'))
+
+	def test_stream_needs_a_valid_token(self):
+		from asgiref.sync import async_to_sync
+
+		async def scenario():
+			communicator = await self.open('invalid')
+			self.assertEqual((await communicator.receive_output(1))['status'], 401)
+		async_to_sync(scenario)()
+
+	@override_settings(CORS_WHITELIST=['https://app.example'])
+	def test_stream_allows_whitelisted_origins(self):
+		from asgiref.sync import async_to_sync
+
+		async def scenario():
+			allowed = [(b'origin', b'https://app.example')]
+			start = await (await self.open('', 'OPTIONS', allowed)).receive_output(1)
+			self.assertEqual((start['status'], dict(start['headers'])[b'access-control-allow-origin']),
+							 (200, b'https://app.example'))
+			communicator = await self.open(self.user.tokens()['access'], headers=allowed)
+			start = await communicator.receive_output(1)
+			self.assertEqual(dict(start['headers'])[b'access-control-allow-origin'], b'https://app.example')
+			await communicator.send_input({'type': 'http.disconnect'})
+			await communicator.wait(1)
+			denied = [(b'origin', b'https://evil.example')]
+			self.assertEqual((await (await self.open('', 'OPTIONS', denied)).receive_output(1))['status'], 403)
+			start = await (await self.open('invalid', headers=denied)).receive_output(1)
+			self.assertNotIn(b'access-control-allow-origin', dict(start['headers']))
+		async_to_sync(scenario)()
+
+	def test_idle_streams_get_heartbeats_and_slow_ones_reconnect(self):
+		from asgiref.sync import async_to_sync
+		from Post import stream
+		self.follow(self.author)
+
+		async def scenario():
+			communicator = await self.open(self.user.tokens()['access'])
+			await communicator.receive_output(1)
+			await communicator.receive_output(1)
+			self.assertEqual((await communicator.receive_output(1))['body'], b': keep-alive\n\n')
+			for post_id in range(stream.STREAM_QUEUE_SIZE + 1):
+				stream.get_stream_hub().dispatch(stream.post_event('created', post_id, self.author.id))
+			self.assertEqual((await self.next_event(communicator))['event'], 'reconnect')
+			self.assertFalse((await communicator.receive_output(1)).get('more_body', False))
+		with mock.patch.object(stream, 'STREAM_HEARTBEAT', 0.05):
+			async_to_sync(scenario)()
+
+	def test_broker_listener_survives_any_error(self):
+		from redis.exceptions import TimeoutError
+		from Post import stream
+
+		class Stop(BaseException):
+			pass
+
+		class PubSub:
+			def __init__(self, messages):
+				self.messages = messages
+
+			def subscribe(self, channel):
+				pass
+
+			def listen(self):
+				for message in self.messages:
+					if isinstance(message, BaseException):
+						raise message
+					yield {'data': json.dumps(message)}
+
+		sessions = iter([PubSub([TimeoutError()]), PubSub([{'type': 'created'}, {'type': 'created'}]),
+						 PubSub([{'type': 'edited'}, Stop()])])
+		client = mock.Mock(pubsub=lambda **kwargs: next(sessions))
+		events = []
+
+		def callback(event):
+			# The second event fails to dispatch, the listener resubscribes rather than stopping
+			if len(events) == 2:
+				events.append('failed')
+				raise KeyError(event['type'])
+			events.append(event['type'])
+		broker = stream.RedisStreamBroker()
+		with mock.patch.object(stream.RedisStreamBroker, 'client', client), mock.patch.object(stream.time, 'sleep'), \
+				self.assertLogs('Post.stream', 'ERROR'), self.assertRaises(Stop):
+			broker.listen(callback)
+		self.assertEqual(events, ['reconnect', 'created', 'failed', 'reconnect', 'edited'])
+
+
+class StampedeTest(PostTestCase):
+
+	def test_concurrent_misses_compute_once(self):
+		from Utilities.cache import get_or_compute, recomputes
+		calls = []
+
+		def compute():
+			calls.append(1)
+			time.sleep(0.1)
+			return ['keys']
+
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(get_or_compute('all_posts_shared', compute)))
+				   for _ in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual((len(calls), results), (1, [['keys']] * 5))
+		self.assertEqual({labels['result']: value for labels, value in recomputes.values()}, {'computed': 1, 'waited': 4})
+
+	def test_expired_value_is_served_while_another_request_recomputes(self):
+		from Utilities.cache import acquire, get_or_compute, recomputes
+		cache.set('mine_posts_1', {'value': ['stale'], 'expires': time.time() - 1, 'delta': 0.01})
+		acquire('mine_posts_1')
+		self.assertEqual(get_or_compute('mine_posts_1', lambda: ['fresh']), ['stale'])
+		self.assertEqual(recomputes.values(), [({'family': 'mine_posts_', 'result': 'stale'}, 1)])
+		cache.delete('lock:mine_posts_1')
+		self.assertEqual(get_or_compute('mine_posts_1', lambda: ['fresh']), ['fresh'])
+
+	def test_values_are_refreshed_early_at_random(self):
+		from Utilities.cache import get_or_compute, recomputes
+		cache.set('mine_posts_1', {'value': ['old'], 'expires': time.time() + 5, 'delta': 1})
+		with mock.patch('Utilities.cache.random.random', return_value=0.5):
+			self.assertEqual(get_or_compute('mine_posts_1', lambda: ['new']), ['old'])
+		with mock.patch('Utilities.cache.random.random', return_value=0.999):
+			self.assertEqual(get_or_compute('mine_posts_1', lambda: ['new']), ['new'])
+		self.assertEqual(recomputes.values(), [({'family': 'mine_posts_', 'result': 'early'}, 1)])
+
+	def test_a_value_computed_across_an_invalidation_is_not_stored(self):
+		from Utilities.cache import get_or_compute, invalidate, recomputes
+
+		def compute():
+			invalidate(['mine_posts_1'])
+			return ['stale']
+
+		self.assertEqual(get_or_compute('mine_posts_1', compute), ['stale'])
+		self.assertIsNone(cache.get('mine_posts_1'))
+		self.assertIn(({'family': 'mine_posts_', 'result': 'invalidated'}, 1), recomputes.values())
+		# An invalidation between the check and the write drops the written value
+		with mock.patch('Utilities.cache.cache.set', side_effect=lambda *args, **kwargs: invalidate(['mine_posts_1'])):
+			get_or_compute('mine_posts_1', lambda: ['stale'])
+		self.assertIsNone(cache.get('mine_posts_1'))
+		self.assertEqual(get_or_compute('mine_posts_1', lambda: ['fresh']), ['fresh'])
+		self.assertEqual(cache.get('mine_posts_1')['value'], ['fresh'])
+
+	def test_renders_racing_an_edit_are_not_cached(self):
+		from Post.cache import render_posts
+		from Post.events import post_edited
+		from Utilities.fast_serializer import FastSerializer
+		post = Post.objects.get(id=self.create('hello')['id'])
+		cache.clear()
+		queryset = FastSerializer.queryset
+
+		def edited_meanwhile(serializer, rows):
+			rendered = list(queryset(serializer, rows))
+			Post.objects.filter(id=post.id).update(text='edited')
+			post_edited(post)
+			return rendered
+
+		with mock.patch.object(FastSerializer, 'queryset', edited_meanwhile):
+			self.assertEqual(render_posts([post.id])[0]['text'], 'hello')
+		self.assertIsNone(cache.get(f'post_{post.id}'))
+		self.assertEqual(render_posts([post.id])[0]['text'], 'edited')
+
+	def test_refresh_waits_for_a_rebuild_in_progress(self):
+		from Utilities.cache import acquire, release
+		key = f'following_posts_{self.user.id}'
+		token = acquire(key)
+		threading.Timer(0.05, release, (key, token)).start()
+		with mock.patch('Post.views.rebuild_timeline') as rebuild:
+			self.assertEqual(self.client.get('/post/feeds/refresh/').status_code, 200)
+		rebuild.assert_not_called()
+		with mock.patch('Post.views.rebuild_timeline') as rebuild:
+			self.client.get('/post/feeds/refresh/')
+		rebuild.assert_called_once()
+
+
+class LocalCacheTest(PostTestCase):
+
+	@staticmethod
+	def worker(name):
+		'''
+			A two tier cache with its own local tier in front of the test cache's remote store, like another process
+		:return:
+		'''
+		from Utilities.local_cache import TwoTierCache
+		return TwoTierCache(name, {'OPTIONS': {'REMOTE': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+														  'LOCATION': 'two-tier-test'}}})
+
+	def test_deletes_reach_every_process(self):
+		first, second = self.worker('first'), self.worker('second')
+		first.set('basic_user_1', {'username': 'old'})
+		self.assertEqual(second.get('basic_user_1'), {'username': 'old'})
+		# Sets are not published, the second process keeps its copy
+		first.remote.set('basic_user_1', {'username': 'new'})
+		self.assertEqual(second.get_many(['basic_user_1']), {'basic_user_1': {'username': 'old'}})
+		first.delete('basic_user_1')
+		self.assertIsNone(second.get('basic_user_1'))
+		self.assertEqual(second.stats()['hits'], 1)
+
+	def test_only_local_families_are_kept_in_process(self):
+		worker = self.worker('families')
+		worker.set('version_posts', 1)
+		worker.set('post_1', {'text': 'hello'})
+		self.assertEqual(worker.stats()['entries'], 1)
+		self.assertEqual(worker.get_many(['version_posts', 'post_1', 'post_2']), {'version_posts': 1, 'post_1': {'text': 'hello'}})
+
+	def test_least_recently_used_values_are_evicted_by_size(self):
+		from Utilities.local_cache import LocalTier
+		tier = LocalTier(max_bytes=2000, ttl=60)
+		for index in range(3):
+			tier.set(f'post_{index}', 'x' * 400)
+		tier.get('post_0')
+		tier.set('post_3', 'x' * 400)
+		self.assertEqual(list(tier.entries), ['post_2', 'post_0', 'post_3'])
+		self.assertLessEqual(tier.stats()['bytes'], 2000)
+		tier.set('post_4', 'x' * 5000)
+		self.assertEqual(tier.get('post_4'), (False, None))
+
+	def test_values_expire_locally(self):
+		from Utilities.local_cache import LocalTier
+		tier = LocalTier(ttl=5)
+		tier.set('post_1', 'short', timeout=1)
+		tier.set('post_2', 'long')
+		with mock.patch('Utilities.local_cache.time.monotonic', return_value=time.monotonic() + 2):
+			self.assertEqual((tier.get('post_1'), tier.get('post_2')), ((False, None), (True, 'long')))
+
+	def test_edits_are_seen_through_the_local_tier(self):
+		post = self.publish(self.author, 'hello')
+		self.client.get('/post/')
+		self.assertEqual(self.client.get('/post/').data['results'][0]['text'], 'hello')
+		self.client.force_authenticate(self.author)
+		self.client.patch(f'/post/{post.id}/edit/', {'text': 'edited'}, format='multipart')
+		self.assertEqual(self.client.get('/post/').data['results'][0]['text'], 'edited')
+		metrics = self.client.get('/metrics').content.decode()
+		self.assertIn('local_cache_lookups_total{family="post_",result="hit"} 1', metrics)
+		self.assertRegex(metrics, r'local_cache_bytes{process="[^"]+"} [1-9]')
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA], REPLICA_STICKY_SECONDS=60)
+class ReplicaTest(PostTestCase):
+	databases = {'default', REPLICA}
+
+	def setUp(self):
+		super().setUp()
+		self.post = self.publish(self.author, 'on the primary')
+		# The replica lags behind: it has the users but an older version of the post
+		for user in (self.user, self.author):
+			user.save(using=REPLICA)
+		Post.objects.using(REPLICA).create(id=self.post.id, poster_id=self.author.id, text='on the replica')
+
+	def text(self, user):
+		self.client.force_authenticate(user)
+		response = self.client.get(f'/post/{self.post.id}/')
+		self.assertEqual(response.status_code, 200)
+		return response.data['text']
+
+	def test_reads_go_to_the_replica(self):
+		self.assertEqual(self.text(self.user), 'on the replica')
+
+	def test_writers_read_from_the_primary_for_a_while(self):
+		self.assertEqual(self.follow(self.author).status_code, 200)
+		self.assertEqual(self.text(self.user), 'on the primary')
+		self.assertEqual(self.text(self.author), 'on the replica')
+		# The window has passed
+		cache.delete(pin_key(self.user.id))
+		self.assertEqual(self.text(self.user), 'on the replica')
+
+	def test_shared_caches_are_filled_from_the_primary(self):
+		response = self.client.get('/post/')
+		self.assertEqual([post['text'] for post in response.data['results']], ['on the primary'])
+
+	def test_recently_changed_content_is_read_from_the_primary(self):
+		User.objects.using(REPLICA).filter(id=self.user.id).update(username='lagging')
+		# Versions start at their first read, a minute later the profile has not changed for a while
+		self.client.get('/user/')
+		with mock.patch('Utilities.replicas.time.time_ns', return_value=time.time_ns() + 61 * 1000000000):
+			self.assertEqual(self.client.get('/user/').data['data']['username'], 'lagging')
+		self.client.force_authenticate(self.author)
+		self.follow(self.user)
+		self.client.force_authenticate(self.user)
+		self.assertEqual(self.client.get('/user/').data['data']['username'], 'reader')
+
+	def test_search_matches_on_the_replica(self):
+		# The matched posts are rendered through the shared cache, which is filled from the primary
+		self.assertEqual([post['id'] for post in self.client.get('/post/search/?q=replica').data['results']],
+						 [self.post.id])
+		self.assertEqual(self.client.get('/post/search/?q=primary').data['results'], [])
+
+	def test_views_that_are_not_marked_use_the_primary(self):
+		self.client.force_authenticate(self.author)
+		self.assertEqual(self.client.get('/post/feeds/refresh/').status_code, 200)
+		self.assertEqual(self.client.delete(f'/post/{self.post.id}/').status_code, 204)
+		self.assertFalse(Post.objects.filter(id=self.post.id).exists())
+
+
+class MetricsTest(PostTestCase):
+
+	def scrape(self, **headers):
+		response = self.client.get('/metrics', **headers)
+		self.assertEqual(response.status_code, 200)
+		return response.content.decode()
+
+	def test_requests_queries_and_cache_families_are_exposed(self):
+		self.publish(self.author, 'hello')
+		self.client.get('/post/')
+		self.client.get('/post/')
+		metrics = self.scrape()
+		labels = 'view="Post:post-list",method="GET",status="200"'
+		self.assertIn(f'http_request_duration_seconds_count{{{labels}}} 2', metrics)
+		self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', metrics)
+		self.assertIn('# TYPE http_request_duration_seconds histogram', metrics)
+		self.assertIn('db_queries_total{view="Post:post-list"}', metrics)
+		self.assertIn('cache_lookups_total{family="all_posts_",result="hit"} 1', metrics)
+		self.assertIn('cache_lookups_total{family="all_posts_",result="miss"} 1', metrics)
+		self.assertIn('cache_lookups_total{family="post_",result="hit"} 1', metrics)
+
+	def test_api_exception_counts_errors_by_class(self):
+		self.client.get('/post/?choice=nobody')
+		self.client.get('/user/12345/followers/')
+		metrics = self.scrape()
+		self.assertIn('api_errors_total{view="ReadListDeletePost",exception="Exception"} 1', metrics)
+		self.assertIn('api_errors_total{view="UserFollows",exception="Exception"} 1', metrics)
+
+	def test_deltas_of_every_process_add_up(self):
+		from Utilities import metrics
+		histogram = metrics.Histogram('test_seconds', 'A test histogram', ('kind',), buckets=(0.1, 1))
+		try:
+			for value in (0.05, 0.5, 5):
+				histogram.observe(value, kind='a')
+			metrics.flush_metrics()
+			# Another process's deltas land in the same totals
+			histogram.observe(0.05, kind='a')
+			exposition = metrics.exposition()
+		finally:
+			metrics.Metric.registry.remove(histogram)
+		self.assertIn('test_seconds_bucket{kind="a",le="0.1"} 2', exposition)
+		self.assertIn('test_seconds_bucket{kind="a",le="1"} 3', exposition)
+		self.assertIn('test_seconds_bucket{kind="a",le="+Inf"} 4', exposition)
+		self.assertIn('test_seconds_sum{kind="a"} 5.6', exposition)
+
+	def test_an_unreachable_store_does_not_fail_requests(self):
+		from Utilities import metrics
+		with mock.patch.object(metrics.LocalMetricStore, 'add', side_effect=ConnectionError), \
+				mock.patch('Utilities.middleware.flush_due', return_value=True), self.assertLogs('Utilities.metrics'):
+			self.assertEqual(self.client.get('/post/').status_code, 200)
+		self.assertIn('http_request_duration_seconds_count{view="Post:post-list",method="GET",status="200"} 1',
+					  self.scrape())
+
+	def test_token(self):
+		with override_settings(METRICS_TOKEN='secret'):
+			self.assertEqual(self.client.get('/metrics').status_code, 401)
+			self.scrape(HTTP_AUTHORIZATION='Bearer secret')
+
+
+class SeedDatasetTest(PostTestCase):
+
+	def seed(self, **options):
+		call_command('seed_dataset', users=30, follows=200, posts=100, stdout=io.StringIO(), **options)
+		return list(Post.objects.filter(poster__username__startswith='seed_').order_by('id').values_list(
+			'poster__username', 'text')), list(User.followers.through.objects.filter(
+			to_user__username__startswith='seed_').order_by('id').values_list('to_user__username', 'from_user__username'))
+
+	def test_seed_is_reproducible_and_consistent(self):
+		posts, follows = self.seed(images=0.05)
+		self.assertEqual(len(posts), 100)
+		self.assertTrue(Post.objects.filter(image_status=Post.IMAGE_READY).exists())
+		self.assertEqual(PostTag.objects.count(), sum('#' in text for _, text in posts))
+		output = io.StringIO()
+		call_command('reconcile_counters', dry_run=True, stdout=output)
+		self.assertIn(', 0 had drifted', output.getvalue())
+		self.assertEqual(self.seed(clear=True, images=0.05), (posts, follows))
+
+	def test_duplicate_posts_are_neither_counted_nor_stored(self):
+		import os
+		from Post.management.commands import seed_dataset
+		with mock.patch.object(seed_dataset, 'post_text', return_value='Same text'), \
+				mock.patch.object(seed_dataset, 'image_bytes', return_value=image_file().read()):
+			self.seed(images=1)
+		self.assertEqual(Post.objects.filter(poster__username__startswith='seed_').count(), 1)
+		self.assertEqual(sum(User.objects.filter(username__startswith='seed_').values_list('no_of_posts', flat=True)), 1)
+		self.assertEqual(len(os.listdir(os.path.join(MEDIA_ROOT, 'post', 'images'))), 1)
+
+	def test_benchmark_drives_every_endpoint(self):
+		from Post.management.commands.benchmark_endpoints import endpoint_names
+		self.seed()
+		follows = User.followers.through.objects.count()
+		with tempfile.NamedTemporaryFile(suffix='.json') as output:
+			call_command('benchmark_endpoints', requests=2, warmup=0, users=2, output=output.name, stdout=io.StringIO(),
+						 stderr=io.StringIO())
+			results = json.load(output)
+		self.assertEqual({result['url_name'] for result in results['endpoints'].values()}, endpoint_names())
+		self.assertEqual({name: result['errors'] for name, result in results['endpoints'].items() if result['errors']}, {})
+		self.assertEqual(results['dataset']['posts'], 100)
+		self.assertEqual(User.followers.through.objects.count(), follows)
+		self.assertFalse(User.objects.filter(username__startswith='seed_bench_').exists())
+
+
+@override_settings(**TEST_SETTINGS)
+class AsyncViewTest(TransactionTestCase):
+	'''
+		The async views query from the thread pool, whose connections only see committed rows
+	'''
+
+	def setUp(self):
+		PostTestCase.setUp(self)
+
+	def async_get(self, path, **headers):
+		from asgiref.sync import async_to_sync
+		from django.test import AsyncRequestFactory
+		from Post.views import ReadListDeletePost
+		from Utilities.async_views import as_async_view
+		request = AsyncRequestFactory().get(path, authorization=f'Bearer {self.user.tokens()["access"]}', **headers)
+		response = async_to_sync(as_async_view(ReadListDeletePost, {'get': 'async_list'}))(request)
+		return response.render() if hasattr(response, 'render') else response
+
+	def test_feeds_match_the_sync_view(self):
+		self.client.post(f'/user/{self.author.id}/action/', {'action': 'follow'}, format='multipart')
+		for index in range(3):
+			Post.objects.create(poster=self.author, text=f'post {index}')
+		self.client.post('/post/create/', {'text': 'mine'}, format='multipart')
+		for choice in ('all', 'mine', 'following'):
+			path = f'/post/?choice={choice}&page_size=2'
+			response = self.async_get(path)
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(json.loads(response.content), json.loads(self.client.get(path).content))
+			self.assertEqual(self.async_get(path, **{'if-none-match': response['ETag']}).status_code, 304)
+		self.assertEqual(self.async_get('/post/?choice=nobody').status_code, 400)
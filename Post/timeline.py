@@ -0,0 +1,150 @@
+import threading
+
+from django.conf import settings
+
+TIMELINE_LENGTH = getattr(settings, 'TIMELINE_LENGTH', 800)
+TIMELINE_FANOUT_LIMIT = getattr(settings, 'TIMELINE_FANOUT_LIMIT', 5000)
+
+
+class RedisTimelineStore:
+	'''
+		This store keeps every user's home timeline as a capped redis sorted set of post IDs scored by creation time
+	'''
+	key_prefix = 'timeline'
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def key(self, user_id):
+		return f'{self.key_prefix}:{user_id}'
+
+	def built_key(self, user_id):
+		return f'{self.key_prefix}:{user_id}:built'
+
+	def add(self, user_ids, entries):
+		'''
+			Adds (post_id, score) entries to the timelines of the given users and trims them to TIMELINE_LENGTH
+		:return:
+		'''
+		mapping = {str(post_id): score for post_id, score in entries}
+		if not mapping:
+			return
+		pipe = self.client.pipeline(transaction=False)
+		for user_id in user_ids:
+			pipe.zadd(self.key(user_id), mapping)
+			pipe.zremrangebyrank(self.key(user_id), 0, -(TIMELINE_LENGTH + 1))
+		pipe.execute()
+
+	def remove(self, user_ids, post_ids):
+		post_ids = [str(post_id) for post_id in post_ids]
+		if not post_ids:
+			return
+		pipe = self.client.pipeline(transaction=False)
+		for user_id in user_ids:
+			pipe.zrem(self.key(user_id), *post_ids)
+		pipe.execute()
+
+	def range(self, user_id, position=None, limit=TIMELINE_LENGTH):
+		'''
+			Returns up to `limit` (post_id, score) entries, newest first, that come after the (score, post_id) position
+		:return:
+		'''
+		key = self.key(user_id)
+		if position is None:
+			entries = self.client.zrevrangebyscore(key, '+inf', '-inf', start=0, num=limit, withscores=True)
+		else:
+			pipe = self.client.pipeline(transaction=False)
+			pipe.zrangebyscore(key, position[0], position[0], withscores=True)
+			pipe.zrevrangebyscore(key, f'({position[0]}', '-inf', start=0, num=limit, withscores=True)
+			ties, entries = pipe.execute()
+			entries = [entry for entry in ties if int(entry[0]) < position[1]] + entries
+		entries = [(int(post_id), int(score)) for post_id, score in entries]
+		return sorted(entries, key=lambda entry: (entry[1], entry[0]), reverse=True)[:limit]
+
+	def is_built(self, user_id):
+		return bool(self.client.exists(self.built_key(user_id)))
+
+	def rebuild(self, user_id, entries):
+		pipe = self.client.pipeline()
+		pipe.delete(self.key(user_id))
+		if entries:
+			pipe.zadd(self.key(user_id), {str(post_id): score for post_id, score in entries})
+		pipe.set(self.built_key(user_id), 1)
+		pipe.execute()
+
+	def mark_heavy(self, user_id):
+		self.client.sadd(f'{self.key_prefix}:heavy', user_id)
+
+	def heavy_users(self):
+		return {int(user_id) for user_id in self.client.smembers(f'{self.key_prefix}:heavy')}
+
+
+class LocalTimelineStore:
+	'''
+		This is an in-process stand-in for the redis timeline store, used by tests and single process runs
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		self.timelines = {}
+		self.built = set()
+		self.heavy = set()
+
+	def add(self, user_ids, entries):
+		with self.lock:
+			for user_id in user_ids:
+				timeline = self.timelines.setdefault(user_id, {})
+				timeline.update(entries)
+				if len(timeline) > TIMELINE_LENGTH:
+					kept = sorted(timeline.items(), key=lambda entry: (entry[1], entry[0]))[-TIMELINE_LENGTH:]
+					self.timelines[user_id] = dict(kept)
+
+	def remove(self, user_ids, post_ids):
+		with self.lock:
+			for user_id in user_ids:
+				timeline = self.timelines.get(user_id, {})
+				for post_id in post_ids:
+					timeline.pop(post_id, None)
+
+	def range(self, user_id, position=None, limit=TIMELINE_LENGTH):
+		with self.lock:
+			entries = self.timelines.get(user_id, {}).items()
+			if position is not None:
+				entries = [entry for entry in entries if (entry[1], entry[0]) < position]
+			return sorted(entries, key=lambda entry: (entry[1], entry[0]), reverse=True)[:limit]
+
+	def is_built(self, user_id):
+		return user_id in self.built
+
+	def rebuild(self, user_id, entries):
+		with self.lock:
+			self.timelines[user_id] = dict(entries)
+			self.built.add(user_id)
+
+	def mark_heavy(self, user_id):
+		self.heavy.add(user_id)
+
+	def heavy_users(self):
+		return set(self.heavy)
+
+
+_stores = {}
+
+
+def get_timeline_store():
+	'''
+		Returns the timeline store selected by settings.TIMELINE_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'TIMELINE_BACKEND', 'redis')
+	if backend not in _stores:
+		_stores[backend] = LocalTimelineStore() if backend == 'local' else RedisTimelineStore()
+	return _stores[backend]
@@ -0,0 +1,182 @@
+import heapq
+import json
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from Post.tags import HASHTAG_PATTERN, MENTION_PATTERN, extract_tags
+
+TRENDS_HALF_LIFE = getattr(settings, 'TRENDS_HALF_LIFE', 60 * 60)
+TRENDS_SIZE = getattr(settings, 'TRENDS_SIZE', 10)
+TRENDS_CAPACITY = getattr(settings, 'TRENDS_CAPACITY', 1000)
+TRENDS_COMPACT_INTERVAL = getattr(settings, 'TRENDS_COMPACT_INTERVAL', 60)
+# Counters are rebased once their weights have grown by 2 ** REBASE_AFTER, far from the float limit
+REBASE_AFTER = 64
+
+URL_PATTERN = re.compile(r'https?://\S+')
+WORD_PATTERN = re.compile(r"[^\W\d_][\w']{3,}")
+STOPWORDS = {
+	'about', 'after', 'again', 'also', 'been', 'before', 'being', 'both', 'could', 'does', 'doing', 'down', 'each',
+	'even', 'from', 'have', 'having', 'here', 'into', 'just', 'like', 'many', 'more', 'most', 'much', 'only', 'other',
+	'over', 'same', 'should', 'some', 'such', 'than', 'that', 'their', 'them', 'then', 'there', 'these', 'they',
+	'this', 'those', 'through', 'very', 'want', 'were', 'what', 'when', 'where', 'which', 'while', 'will', 'with',
+	'would', 'your', "it's", "don't", "i'm",
+}
+
+
+def post_terms(text):
+	'''
+		The trend terms of a post's text, its hashtags as '#tag' and its other words of four letters or more
+		that are not stopwords, each counted once
+	:return:
+	'''
+	words = WORD_PATTERN.findall(MENTION_PATTERN.sub(' ', HASHTAG_PATTERN.sub(' ', URL_PATTERN.sub(' ', text or ''))))
+	return {f'#{tag}' for tag in extract_tags(text)} | {word.lower() for word in words} - STOPWORDS
+
+
+def weight(now, landmark):
+	'''
+		Counters use forward decay: a post counts 2 ** ((now - landmark) / TRENDS_HALF_LIFE) when recorded, so stored
+		counters never have to be decayed, they all shrink by the same factor when read
+	:return:
+	'''
+	return 2 ** ((now - landmark) / TRENDS_HALF_LIFE)
+
+
+# Records the terms of one post against the current landmark atomically
+RECORD_SCRIPT = '''
+local landmark = tonumber(redis.call('get', KEYS[2]))
+if not landmark then
+	landmark = tonumber(ARGV[1])
+	redis.call('set', KEYS[2], ARGV[1])
+end
+local weight = 2 ^ ((tonumber(ARGV[1]) - landmark) / tonumber(ARGV[2]))
+for index = 3, #ARGV do
+	redis.call('zincrby', KEYS[1], weight, ARGV[index])
+end
+return 1
+'''
+
+
+class RedisTrendStore:
+	'''
+		This store keeps a decayed counter per term in a redis sorted set. Compaction trims the set to the
+		TRENDS_CAPACITY highest counters and publishes the TRENDS_SIZE highest as a snapshot, which is all a read loads
+	'''
+	key_prefix = 'trends'
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def key(self, name):
+		return f'{self.key_prefix}:{name}'
+
+	def record(self, terms, now=None):
+		if terms:
+			self.client.eval(RECORD_SCRIPT, 2, self.key('scores'), self.key('landmark'),
+							 now or time.time(), TRENDS_HALF_LIFE, *terms)
+
+	def compact(self, now=None):
+		'''
+			Trims the counters, rebases them when their weights have grown large and publishes the top terms.
+			Only one process compacts at a time
+		:return:
+		'''
+		now = now or time.time()
+		client = self.client
+		if not client.set(self.key('compacting'), 1, nx=True, ex=TRENDS_COMPACT_INTERVAL):
+			return
+		try:
+			with client.pipeline() as pipe:
+				pipe.zremrangebyrank(self.key('scores'), 0, -(TRENDS_CAPACITY + 1))
+				pipe.zrevrange(self.key('scores'), 0, TRENDS_SIZE - 1, withscores=True)
+				pipe.get(self.key('landmark'))
+				_, top, landmark = pipe.execute()
+			landmark = float(landmark) if landmark is not None else now
+			decay = 1 / weight(now, landmark)
+			snapshot = [(term.decode(), score * decay) for term, score in top]
+			with client.pipeline() as pipe:
+				pipe.set(self.key('top'), json.dumps({'at': now, 'top': snapshot}))
+				if now - landmark > REBASE_AFTER * TRENDS_HALF_LIFE:
+					# The rebase is one transaction so no post is recorded against a stale landmark
+					pipe.zunionstore(self.key('scores'), {self.key('scores'): decay})
+					pipe.set(self.key('landmark'), now)
+				pipe.execute()
+		finally:
+			client.delete(self.key('compacting'))
+
+	def top(self, now=None):
+		'''
+			Returns the snapshot of the top (term, score) pairs, compacting first when it is older than
+			TRENDS_COMPACT_INTERVAL
+		:return:
+		'''
+		now = now or time.time()
+		snapshot = self.client.get(self.key('top'))
+		snapshot = json.loads(snapshot) if snapshot is not None else None
+		if snapshot is None or now - snapshot['at'] > TRENDS_COMPACT_INTERVAL:
+			self.compact(now)
+			snapshot = json.loads(self.client.get(self.key('top')) or 'null') or snapshot
+		return [tuple(entry) for entry in snapshot['top']] if snapshot else []
+
+
+class LocalTrendStore:
+	'''
+		This is an in-process stand-in for the redis trend store, used by tests and single process runs
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		self.scores = {}
+		self.landmark = None
+		self.snapshot = None
+
+	def record(self, terms, now=None):
+		now = now or time.time()
+		with self.lock:
+			if self.landmark is None:
+				self.landmark = now
+			increment = weight(now, self.landmark)
+			for term in terms:
+				self.scores[term] = self.scores.get(term, 0) + increment
+
+	def compact(self, now=None):
+		now = now or time.time()
+		with self.lock:
+			kept = heapq.nlargest(TRENDS_CAPACITY, self.scores.items(), key=lambda entry: (entry[1], entry[0]))
+			decay = 1 / weight(now, self.landmark) if self.landmark is not None else 1
+			self.scores = dict(kept)
+			self.snapshot = {'at': now, 'top': [(term, score * decay) for term, score in kept[:TRENDS_SIZE]]}
+			if self.landmark is not None and now - self.landmark > REBASE_AFTER * TRENDS_HALF_LIFE:
+				self.scores = {term: score * decay for term, score in self.scores.items()}
+				self.landmark = now
+
+	def top(self, now=None):
+		now = now or time.time()
+		if self.snapshot is None or now - self.snapshot['at'] > TRENDS_COMPACT_INTERVAL:
+			self.compact(now)
+		return list(self.snapshot['top'])
+
+
+_stores = {}
+
+
+def get_trend_store():
+	'''
+		Returns the trend store selected by settings.TRENDS_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'TRENDS_BACKEND', 'redis')
+	if backend not in _stores:
+		_stores[backend] = LocalTrendStore() if backend == 'local' else RedisTrendStore()
+	return _stores[backend]
@@ -0,0 +1,100 @@
+import hashlib
+import io
+
+from PIL import Image, UnidentifiedImageError
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler, StopUpload
+
+MAX_IMAGE_BYTES = getattr(settings, 'MAX_IMAGE_BYTES', 20 * 1024 * 1024)
+MAX_IMAGE_PIXELS = getattr(settings, 'MAX_IMAGE_PIXELS', 50000000)
+# Pillow's own decompression bomb check, set once for every image this process opens
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+HEADER_BYTES = 256 * 1024
+
+
+def file_digest(file):
+	'''
+		The sha256 of a file, read chunk by chunk. Uploads that went through LimitedImageUploadHandler already have it
+	:return:
+	'''
+	digest = getattr(file, 'sha256', None)
+	if digest is None:
+		hasher = hashlib.sha256()
+		for chunk in file.chunks():
+			hasher.update(chunk)
+		digest = hasher.hexdigest()
+	return digest
+
+
+def check_image_header(header):
+	'''
+		Reads the dimensions from the first bytes of an image without decoding it and raises when they are
+		over MAX_IMAGE_PIXELS. Returns False while the header is still incomplete
+	:return:
+	'''
+	try:
+		with Image.open(io.BytesIO(header)) as image:
+			width, height = image.size
+	except Image.DecompressionBombError:
+		# Pillow refuses to open images over twice its limit, before their size is known here
+		raise ValueError(f'The image is over the limit, images cannot be more than {MAX_IMAGE_PIXELS} pixels')
+	except (UnidentifiedImageError, OSError, SyntaxError):
+		return False
+	if width * height > MAX_IMAGE_PIXELS:
+		raise ValueError(f'The image is {width}x{height}, images cannot be more than {MAX_IMAGE_PIXELS} pixels')
+	return True
+
+
+class LimitedImageUploadHandler(TemporaryFileUploadHandler):
+	'''
+		This upload handler streams the `image` field to a temporary file chunk by chunk, so an upload never sits
+		in memory. It stops the upload as soon as it is over MAX_IMAGE_BYTES or as soon as its header declares
+		more than MAX_IMAGE_PIXELS, before anything is decoded. The reason is left on request.upload_error.
+		The sha256 of the upload is computed on the way and set on the file as `sha256`
+	'''
+
+	def new_file(self, field_name, *args, **kwargs):
+		super().new_file(field_name, *args, **kwargs)
+		self.received = 0
+		self.header = b''
+		self.header_checked = False
+		self.hasher = hashlib.sha256()
+
+	def receive_data_chunk(self, raw_data, start):
+		self.received += len(raw_data)
+		if self.received > MAX_IMAGE_BYTES:
+			self.reject(f'Images cannot be more than {MAX_IMAGE_BYTES // (1024 * 1024)}MB')
+		if not self.header_checked:
+			self.header += raw_data
+			try:
+				self.header_checked = check_image_header(self.header) or len(self.header) >= HEADER_BYTES
+			except ValueError as e:
+				self.reject(str(e))
+		self.hasher.update(raw_data)
+		return super().receive_data_chunk(raw_data, start)
+
+	def file_complete(self, file_size):
+		file = super().file_complete(file_size)
+		file.sha256 = self.hasher.hexdigest()
+		return file
+
+	def reject(self, message):
+		self.request.upload_error = message
+		self.file.close()
+		raise StopUpload(connection_reset=False)
+
+
+class ImageUploadMixin:
+	'''
+		This mixin makes a view stream its uploads through LimitedImageUploadHandler
+	'''
+
+	def initialize_request(self, request, *args, **kwargs):
+		request.upload_handlers = [LimitedImageUploadHandler(request)]
+		return super().initialize_request(request, *args, **kwargs)
+
+	def get_image(self, request):
+		image = request.FILES.get('image')
+		if getattr(request, 'upload_error', None):
+			raise Exception(request.upload_error)
+		return image
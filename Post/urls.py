@@ -1,5 +1,6 @@
 # accounts/urls.py
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.urls import path
 # RESTFRAMEWORK imports
@@ -7,6 +8,7 @@ from rest_framework.routers import DefaultRouter
 
 # View and other imports
 from .views import *
+from Utilities.async_views import as_async_view
 
 app_name = 'Post'
 
@@ -16,8 +18,16 @@ router.register(r'post', ReadListDeletePost , basename="post")
 urlpatterns = [
 	path('post/create/', CreatePost.as_view({"post" : "create"}), name="create_post"),
 	path('post/<int:pk>/edit/', EditPost.as_view({"patch": "partial_update"}), name="edit_post"),
-	path('post/feeds/refresh/', RefreshPosts.as_view(), name="refresh_posts")
+	path('post/feeds/refresh/', RefreshPosts.as_view(), name="refresh_posts"),
+	path('post/search/', SearchPosts.as_view(), name="search_posts"),
+	path('post/stream/', StreamNotServed.as_view(), name="stream_posts"),
+	path('post/tags/<str:tag>/', IndexedPosts.as_view(index='tags'), name="tag_posts"),
+	path('post/mentions/<int:id>/', IndexedPosts.as_view(index='mentions'), name="mention_posts"),
+	path('trends/', Trends.as_view(), name="trends")
 
 ]
+
+if settings.ASYNC_VIEWS:
+	urlpatterns.append(path('post/', as_async_view(ReadListDeletePost, {'get': 'async_list'}), name="post-list"))
 urlpatterns += router.urls
 
@@ -1,4 +1,4 @@
-from django.core.cache import cache
+from django.db import transaction
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import mixins, status, viewsets
 # Create your views here.
@@ -6,50 +6,90 @@ from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
-from Post.models import Post
+from Account.models import User
+from Post.cache import cached_feed_keys, feed_cache_key, render_posts, feed_version_scopes
+from Post.events import post_created, post_edited, post_deleted
+from Post.feeds import following_keys, rebuild_timeline
+from Post.models import Post, PostTag, PostMention
+from Post.search import search_keys
+from Post.trends import get_trend_store
 from Post.serializer import PostSerializer, AddPostSerializer
-from Utilities.api_response import api_exception, APISuccess, choice_query, image_upload, APIFailure, CACHE_TTL
+from Post.uploads import ImageUploadMixin
+from Utilities.api_response import api_exception, APISuccess, choice_query, image_upload, APIFailure, cursor_query, \
+	page_size_query, search_query
+from Utilities.async_views import run_in_thread
+from Utilities.cache import invalidate, single_flight
+from Utilities.conditional import bump_versions, conditional_response, async_conditional_response
+from Utilities.pagination import KeysetPagination, queryset_keys
+from Utilities.replicas import ReplicaReadsMixin
 
 
-class ReadListDeletePost(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+class StreamNotServed(APIView):
+	'''
+		This view answers /post/stream/ under WSGI, which cannot hold the stream open. The path is served by the
+		ASGI application of the Procfile's `stream` process, see CloneTwitter/asgi.py
+	'''
+	permission_classes = ()
+	http_method_names = ('get',)
+
+	def get(self, request, *args, **kwargs):
+		return APIFailure(message='The post stream is served by the stream process, not this one', status=404)
+
+
+class ReadListDeletePost(ReplicaReadsMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
 	'''
 		This viewset allows a user to retrieve a list of posts, retrieve a single post and delete a post
 	'''
 	permission_classes = (IsAuthenticated, )
-	queryset = Post.objects.all()
+	queryset = PostSerializer.setup_eager_loading(Post.objects.all())
 	serializer_class = PostSerializer
+	pagination_class = KeysetPagination
+
+	def get_choice(self):
+		choice = str(self.request.query_params.get('choice', 'all')).lower()
+		if choice not in ('mine', 'followers', 'following', 'all'):
+			raise Exception('Please Enter a valid choice')
+		return choice
 
 	def get_queryset(self):
-		choice = self.request.query_params.get('choice', 'all')
-		choice = str(choice).lower()
+		choice = self.get_choice()
+		queryset = PostSerializer.setup_eager_loading(Post.objects.all())
 		if choice == 'mine':
-			queryset = cache.get(f'mine_posts_{self.request.user.id}', None)
-			if queryset is None:
-				queryset = Post.objects.filter(poster=self.request.user)
-				cache.set(f'mine_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
+			return queryset.filter(poster=self.request.user)
 		elif choice == 'followers':
-			queryset = cache.get(f'followers_posts_{self.request.user.id}', None)
-			if queryset is None:
-				queryset = Post.objects.filter(poster__in=self.request.user.followers.all())
-				cache.set(f'followers_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
+			return queryset.filter(poster_id__in=User.follower_ids(self.request.user.id))
 		elif choice == 'following':
-			queryset = cache.get(f'following_posts_{self.request.user.id}', None)
-			if queryset is None:
-				queryset = Post.objects.filter(poster__in=self.request.user.following())
-				cache.set(f'following_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
-		elif choice == 'all':
-			queryset = cache.get(f'all_posts_{self.request.user.id}', None)
-			if queryset is None:
-				queryset = Post.objects.all()
-				cache.set(f'all_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
-		else:
-			return APIFailure(message="Please Enter a valid choice", status=status.HTTP_400_BAD_REQUEST)
+			return queryset.filter(poster_id__in=User.following_ids(self.request.user.id))
 		return queryset
 
-	@swagger_auto_schema(manual_parameters=[choice_query])
+	def get_feed_keys(self, position, limit):
+		choice = self.get_choice()
+		if choice == 'following':
+			return following_keys(self.request.user, position, limit)
+		return cached_feed_keys(feed_cache_key(choice, self.request.user.id), self.get_queryset(), position, limit)
+
+	@swagger_auto_schema(manual_parameters=[choice_query, cursor_query, page_size_query])
 	@api_exception
 	def list(self, request, *args, **kwargs):
-		return mixins.ListModelMixin.list(self, request, *args, **kwargs)
+		def render():
+			keys = self.paginator.paginate_keys(self.get_feed_keys, request)
+			return self.get_paginated_response(render_posts([post_id for _, post_id in keys], request))
+		return conditional_response(request, 'feed', feed_version_scopes(self.get_choice(), request.user.id), render)
+
+	@api_exception
+	async def async_list(self, request, *args, **kwargs):
+		'''
+			The list of the ASGI deployment, a feed's page is looked up in one thread hop once its versions are read
+		:return:
+		'''
+		choice = self.get_choice()
+
+		def fetch():
+			# The page's posts are read right after its keys, one thread hop does both
+			keys = self.paginator.paginate_keys(self.get_feed_keys, request)
+			return render_posts([post_id for _, post_id in keys], request)
+		return await async_conditional_response(request, 'feed', lambda: feed_version_scopes(choice, request.user.id),
+												lambda: run_in_thread(fetch), self.get_paginated_response)
 
 	@api_exception
 	def retrieve(self, request, *args, **kwargs):
@@ -58,13 +98,17 @@ class ReadListDeletePost(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixin
 	@api_exception
 	def destroy(self, request, *args, **kwargs):
 		instance = self.get_object()
-		if instance.poster != request.user:
+		if instance.poster_id != request.user.id:
 			return APIFailure(message='You are not the author of this post')
-		instance.delete()
+		post_id, poster_id = instance.id, instance.poster_id
+		with transaction.atomic():
+			instance.delete()
+			User.adjust_counters(poster_id, no_of_posts=-1)
+		post_deleted(post_id, poster_id)
 		return APISuccess(message='Post has been deleted successfully', status=status.HTTP_204_NO_CONTENT)
 
 
-class CreatePost(mixins.CreateModelMixin, viewsets.GenericViewSet):
+class CreatePost(ImageUploadMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
 	'''
 		This view allows a user to create a post
 	'''
@@ -78,19 +122,20 @@ class CreatePost(mixins.CreateModelMixin, viewsets.GenericViewSet):
 	def create(self, request, *args, **kwargs):
 		serializer = self.serializer_class(data=request.data)
 		serializer.context['user'] = request.user
-		serializer.context['image'] = request.FILES['image']
+		serializer.context['image'] = self.get_image(request)
 		serializer.is_valid(raise_exception=True)
 		post = serializer.save()
+		post_created(post)
 		data = PostSerializer(post).data
 		return APISuccess(message='You have just added a post', data=data)
 
 
-class EditPost(mixins.UpdateModelMixin, viewsets.GenericViewSet):
+class EditPost(ImageUploadMixin, mixins.UpdateModelMixin, viewsets.GenericViewSet):
 	'''
 		This view allows a user to edit his/her own post
 	'''
 	permission_classes = (IsAuthenticated,)
-	queryset = Post.objects.all()
+	queryset = PostSerializer.setup_eager_loading(Post.objects.all())
 	serializer_class = AddPostSerializer
 	http_method_names = ('patch', )
 	parser_classes = (MultiPartParser,)
@@ -100,26 +145,81 @@ class EditPost(mixins.UpdateModelMixin, viewsets.GenericViewSet):
 	def partial_update(self, request, *args, **kwargs):
 		serializer = self.serializer_class(data=request.data, instance=self.get_object(), partial=True)
 		serializer.context['user'] = request.user
+		serializer.context['image'] = self.get_image(request)
 		serializer.is_valid(raise_exception=True)
 		post = serializer.save()
+		post_edited(post)
 		data = PostSerializer(post).data
 		return APISuccess(message='You have just edited the post', data=data)
 
 
+class SearchPosts(ReplicaReadsMixin, APIView):
+	'''
+		This view pages through the posts matching a search, best match first
+	'''
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('get',)
+
+	@swagger_auto_schema(manual_parameters=[search_query, cursor_query, page_size_query])
+	@api_exception
+	def get(self, request, *args, **kwargs):
+		query = request.query_params.get('q', '').strip()
+		if not query:
+			raise Exception('Please enter a search query')
+		paginator = KeysetPagination()
+		keys = paginator.paginate_keys(lambda position, limit: search_keys(query, position, limit), request)
+		return paginator.get_paginated_response(render_posts([post_id for _, post_id in keys], request))
+
+
+class IndexedPosts(ReplicaReadsMixin, APIView):
+	'''
+		This view pages through the posts with a hashtag or the posts mentioning a user, newest first.
+		It reads the keys from the index table alone and renders them like the other feeds
+	'''
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('get',)
+	index = 'tags'
+
+	def get_index(self, **kwargs):
+		if self.index == 'tags':
+			return PostTag.objects.filter(tag=kwargs['tag'].lower())
+		if not User.objects.filter(id=kwargs['id']).exists():
+			raise Exception(f'No User exists with this ID "{kwargs["id"]}"')
+		return PostMention.objects.filter(user_id=kwargs['id'])
+
+	@swagger_auto_schema(manual_parameters=[cursor_query, page_size_query])
+	@api_exception
+	def get(self, request, *args, **kwargs):
+		index = self.get_index(**kwargs)
+		paginator = KeysetPagination()
+		keys = paginator.paginate_keys(lambda position, limit: queryset_keys(index, position, limit, 'post_id'), request)
+		return paginator.get_paginated_response(render_posts([post_id for _, post_id in keys], request))
+
+
+class Trends(APIView):
+	'''
+		This view returns the hashtags and terms posted about the most lately, with their decayed post counts
+	'''
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ('get',)
+
+	@api_exception
+	def get(self, request, *args, **kwargs):
+		data = [dict(name=term, score=round(score, 3)) for term, score in get_trend_store().top()]
+		return APISuccess(message='trends retrieved', data=data)
+
+
 class RefreshPosts(APIView):
 	'''
-		This view allows a user to refresh the post feeds to update the cache
+		This view allows a user to force a rebuild of his/her post feeds.
+		Feeds are kept up to date when posts and follows change, so this is only needed to repair them
 	'''
 	http_method_names = ('get',)
 	permission_classes = (IsAuthenticated,)
 
 	def get(self, request, *args, **kwargs):
-		queryset = Post.objects.filter(poster=self.request.user)
-		cache.set(f'mine_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
-		queryset = Post.objects.filter(poster__in=self.request.user.followers.all())
-		cache.set(f'followers_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
-		queryset = Post.objects.filter(poster__in=self.request.user.following())
-		cache.set(f'following_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
-		queryset = Post.objects.all()
-		cache.set(f'all_posts_{self.request.user.id}', queryset, timeout=CACHE_TTL)
+		invalidate([feed_cache_key('mine', request.user.id), feed_cache_key('followers', request.user.id)])
+		# A refresh already running for this user rebuilds the timeline for this one too
+		single_flight(feed_cache_key('following', request.user.id), lambda: rebuild_timeline(request.user))
+		bump_versions([feed_cache_key(choice, request.user.id) for choice in ('mine', 'followers', 'following')])
 		return APISuccess(message='Posts feeds have been refreshed successfully')
\ No newline at end of file
@@ -1,3 +1,5 @@
+import asyncio
+
 from django.conf import settings
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from drf_yasg import openapi
@@ -5,16 +7,36 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
 
+from Utilities.metrics import api_errors
+
 image_upload = openapi.Parameter(name="image", in_=openapi.IN_FORM, type=openapi.TYPE_FILE, required=False,
 								 description="Supported images- ('jpg, png, jpeg, webp')")
 choice_query = openapi.Parameter('choice', openapi.IN_QUERY,
 								 description="options are : all, mine, followers, following",
 								 type=openapi.TYPE_STRING)
+cursor_query = openapi.Parameter('cursor', openapi.IN_QUERY, description="The cursor returned as `next` by the previous page",
+								 type=openapi.TYPE_STRING)
+page_size_query = openapi.Parameter('page_size', openapi.IN_QUERY, description="The number of results per page",
+									type=openapi.TYPE_INTEGER)
+expand_query = openapi.Parameter('expand', openapi.IN_QUERY,
+								 description="Comma separated lists to include in the user details: followers, following",
+								 type=openapi.TYPE_STRING)
+search_query = openapi.Parameter('q', openapi.IN_QUERY, description="The words to search posts for", required=True,
+								 type=openapi.TYPE_STRING)
 user_id = openapi.Parameter(name='id', in_=openapi.IN_PATH, type=openapi.TYPE_NUMBER, required=True,
 							description="This is the user's ID")
 
 CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
 
+
+def get_expand(request):
+	'''
+		The names passed in the `expand` query parameter, e.g ?expand=followers,following
+	:return:
+	'''
+	return [name.strip() for name in request.query_params.get('expand', '').split(',') if name.strip()]
+
+
 class APISuccess:
 	def __new__(cls, message='Success', data=None, status=HTTP_200_OK):
 		if data is None:
@@ -28,10 +50,26 @@ class APIFailure:
 
 
 def api_exception(func):
+	'''
+		Turns the exceptions a view raises into 400 responses with their message, counting them by view and class
+	:return:
+	'''
+	if asyncio.iscoroutinefunction(func):
+		async def inner(self, request, *args, **kwargs):
+			try:
+				return await func(self, request, *args, **kwargs)
+			except Exception as e:
+				api_errors.inc(view=type(self).__name__, exception=type(e).__name__)
+				error_msg = e.__str__().split('\n')[0]
+				return APIFailure(message=error_msg, status=status.HTTP_400_BAD_REQUEST)
+
+		return inner
+
 	def inner(self, request, *args, **kwargs):
 		try:
 			return func(self, request, *args, **kwargs)
 		except Exception as e:
+			api_errors.inc(view=type(self).__name__, exception=type(e).__name__)
 			error_msg = e.__str__().split('\n')[0]
 			return APIFailure(message=error_msg, status=status.HTTP_400_BAD_REQUEST)
 
@@ -0,0 +1,202 @@
+import math
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from Utilities.metrics import Counter, count_lookups, key_family
+from Utilities.replicas import primary_reads
+
+# The longest a recompute may hold its lock, a crashed one frees it after this
+STAMPEDE_LOCK_TIMEOUT = getattr(settings, 'STAMPEDE_LOCK_TIMEOUT', 10)
+# How long a request with nothing to serve waits for another one's recompute before computing itself
+STAMPEDE_WAIT = getattr(settings, 'STAMPEDE_WAIT', 2)
+# How long an expired value is kept to be served while it is recomputed
+STAMPEDE_STALE = getattr(settings, 'STAMPEDE_STALE', 60)
+# Higher values refresh earlier, 1 is the usual choice
+STAMPEDE_BETA = getattr(settings, 'STAMPEDE_BETA', 1.0)
+# How long a key's generation is kept after it was invalidated, far longer than any compute takes
+GENERATION_TIMEOUT = 60 * 60
+
+recomputes = Counter('cache_recomputes', 'Cached values recomputed or coalesced, by key family and outcome: '
+										 'computed, early (refreshed before expiring), stale (served while another '
+										 'request recomputed), waited (got another request\'s result), timeout '
+										 '(computed after waiting in vain) and invalidated (not stored because the key '
+										 'was invalidated while it was computed)', ('family', 'result'))
+
+
+def lock_key(key):
+	return f'lock:{key}'
+
+
+def generation_key(key):
+	return f'generation:{key}'
+
+
+def invalidate(keys):
+	'''
+		Drops the cached values of these keys. Their generation changes first, so a value that was being computed
+		meanwhile, possibly from data older than the change, is not stored, see store
+	:return:
+	'''
+	cache.set_many({generation_key(key): uuid.uuid4().hex for key in keys}, timeout=GENERATION_TIMEOUT)
+	cache.delete_many(keys)
+
+
+def store_many(keys, compute, timeout=DEFAULT_TIMEOUT):
+	'''
+		Computes the values of these keys with `compute()`, which returns them by key, and caches them as they
+		are. Like store, the values of keys invalidated while they were computed are returned but not kept
+	:return:
+	'''
+	before = cache.get_many([generation_key(key) for key in keys])
+
+	def invalidated(candidates):
+		after = cache.get_many([generation_key(key) for key in candidates])
+		return [key for key in candidates if after.get(generation_key(key)) != before.get(generation_key(key))]
+
+	# The values are served to every request, they are read from the primary
+	with primary_reads():
+		values = compute()
+	dropped = invalidated(list(values))
+	kept = {key: value for key, value in values.items() if key not in dropped}
+	if kept:
+		cache.set_many(kept, timeout=timeout)
+		late = invalidated(list(kept))
+		if late:
+			cache.delete_many(late)
+			dropped += late
+	for key in dropped:
+		recomputes.inc(family=key_family(key), result='invalidated')
+	return values
+
+
+def acquire(key):
+	'''
+		Takes the recompute lock of a key, returns its token or None when another request holds it
+	:return:
+	'''
+	token = uuid.uuid4().hex
+	return token if cache.add(lock_key(key), token, timeout=STAMPEDE_LOCK_TIMEOUT) else None
+
+
+def release(key, token):
+	# A lock that outlived STAMPEDE_LOCK_TIMEOUT may have been taken by another request since, it is theirs
+	if cache.get(lock_key(key)) == token:
+		cache.delete(lock_key(key))
+
+
+def wait_for_release(key):
+	'''
+		Waits up to STAMPEDE_WAIT seconds for the recompute lock of a key to be released, polling more slowly as
+		time goes by. Returns whether it was
+	:return:
+	'''
+	deadline = time.monotonic() + STAMPEDE_WAIT
+	interval = 0.005
+	while time.monotonic() < deadline:
+		time.sleep(interval)
+		if cache.get(lock_key(key)) is None:
+			return True
+		interval = min(interval * 2, 0.05)
+	return False
+
+
+def single_flight(key, compute):
+	'''
+		Runs compute() unless another request is already running it for this key, in which case it waits for that
+		one to finish instead. Returns whether compute() ran here
+	:return:
+	'''
+	token = acquire(key)
+	if token is None:
+		if wait_for_release(key):
+			recomputes.inc(family=key_family(key), result='waited')
+			return False
+		recomputes.inc(family=key_family(key), result='timeout')
+		with primary_reads():
+			compute()
+		return True
+	try:
+		with primary_reads():
+			compute()
+	finally:
+		release(key, token)
+	recomputes.inc(family=key_family(key), result='computed')
+	return True
+
+
+def is_due(entry, now):
+	'''
+		Whether a cached entry should be recomputed: once it has expired, or a little before, with a chance that
+		grows as its expiry nears and with how long it took to compute, so that the requests of a busy key do not all
+		find it expired at once
+	:return:
+	'''
+	if entry['expires'] is None:
+		return False
+	return now - entry['delta'] * STAMPEDE_BETA * math.log(1 - random.random()) >= entry['expires']
+
+
+def store(key, compute, timeout):
+	'''
+		Computes and caches the value of a key, unless the key was invalidated meanwhile. The generation is checked
+		again after writing since an invalidation can land between the check and the write, the value is then dropped
+	:return:
+	'''
+	generation = cache.get(generation_key(key))
+	started = time.time()
+	# The value is served to every request, it is read from the primary
+	with primary_reads():
+		value = compute()
+	now = time.time()
+	if timeout is DEFAULT_TIMEOUT:
+		timeout = cache.default_timeout
+	if cache.get(generation_key(key)) != generation:
+		recomputes.inc(family=key_family(key), result='invalidated')
+		return value
+	entry = {'value': value, 'expires': now + timeout if timeout is not None else None, 'delta': now - started}
+	cache.set(key, entry, timeout=timeout + STAMPEDE_STALE if timeout is not None else None)
+	if cache.get(generation_key(key)) != generation:
+		cache.delete(key)
+		recomputes.inc(family=key_family(key), result='invalidated')
+	return value
+
+
+def get_or_compute(key, compute, timeout=DEFAULT_TIMEOUT):
+	'''
+		Returns the cached value of a key, computing and caching it for `timeout` seconds when it is missing.
+		Only one request at a time recomputes a key: while it does, others are served the expired value for up to
+		STAMPEDE_STALE seconds, or wait for its result when there is none, as after the key was deleted.
+		Keys must be dropped with invalidate(), a plain delete racing a recompute can be overwritten by its result
+	:return:
+	'''
+	entry = cache.get(key)
+	if not isinstance(entry, dict) or 'expires' not in entry:
+		entry = None
+	count_lookups([key], [key] if entry is not None else [])
+	now = time.time()
+	if entry is not None and not is_due(entry, now):
+		return entry['value']
+	token = acquire(key)
+	if token is None:
+		if entry is not None:
+			recomputes.inc(family=key_family(key), result='stale')
+			return entry['value']
+		if wait_for_release(key):
+			entry = cache.get(key)
+			if isinstance(entry, dict) and 'expires' in entry:
+				recomputes.inc(family=key_family(key), result='waited')
+				return entry['value']
+		recomputes.inc(family=key_family(key), result='timeout')
+		return store(key, compute, timeout)
+	try:
+		value = store(key, compute, timeout)
+	finally:
+		release(key, token)
+	early = entry is not None and entry['expires'] is not None and now < entry['expires']
+	recomputes.inc(family=key_family(key), result='early' if early else 'computed')
+	return value
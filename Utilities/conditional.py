@@ -0,0 +1,91 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from Utilities.async_views import run_in_thread
+from Utilities.metrics import Counter, count_lookups
+from Utilities.replicas import primary_if_changed
+
+conditional_responses = Counter('conditional_responses', 'Responses to conditional GETs by whether the body was sent',
+								('endpoint', 'result'))
+
+
+def version_key(scope):
+	return f'version_{scope}'
+
+
+def bump_versions(scopes):
+	'''
+		Marks the content of these scopes as changed. A version is the time of the change in nanoseconds
+	:return:
+	'''
+	now = time.time_ns()
+	cache.set_many({version_key(scope): now for scope in scopes}, timeout=None)
+
+
+def get_versions(scopes):
+	'''
+		Returns the version of each scope, a scope without one starts at the current time
+	:return:
+	'''
+	keys = [version_key(scope) for scope in scopes]
+	versions = cache.get_many(keys)
+	count_lookups(keys, versions)
+	for key in keys:
+		if key not in versions:
+			cache.add(key, time.time_ns(), timeout=None)
+			versions[key] = cache.get(key)
+	return [versions[key] for key in keys]
+
+
+def entity_tag(request, versions):
+	'''
+		The ETag of a response built from content at these versions. The tag also covers the user and the full
+		path, so each page and user has its own. No Last-Modified is sent: it only has a resolution of a second, and
+		two changes within one second would answer an If-Modified-Since with a 304 that misses the second
+	:return:
+	'''
+	parts = [str(request.user.id), request.get_full_path()] + [str(version) for version in versions]
+	return '"{}"'.format(hashlib.md5('|'.join(parts).encode()).hexdigest())
+
+
+def tag_response(response, endpoint, result, etag):
+	conditional_responses.inc(endpoint=endpoint, result=result)
+	if result == 'full' and response.status_code != 200:
+		return response
+	response['ETag'] = etag
+	patch_cache_control(response, private=True, no_cache=True)
+	return response
+
+
+def conditional_response(request, endpoint, scopes, render):
+	'''
+		Answers a GET whose content only changes with the versions of `scopes`. A request that already has the
+		current version gets a 304 from the versions alone, otherwise `render()` builds the response
+	:return:
+	'''
+	versions = get_versions(scopes)
+	etag = entity_tag(request, versions)
+	response = get_conditional_response(request, etag=etag)
+	if response is not None:
+		return tag_response(response, endpoint, 'not_modified', etag)
+	primary_if_changed(versions)
+	return tag_response(render(), endpoint, 'full', etag)
+
+
+async def async_conditional_response(request, endpoint, get_scopes, fetch, render):
+	'''
+		The async counterpart of conditional_response. `get_scopes()` runs in the thread pool, `fetch()` is a coroutine
+		loading the content and `render(content)` builds the response from it. The content is fetched once the
+		versions are read, a body read before them could miss a write their tag covers
+	:return:
+	'''
+	versions = await run_in_thread(lambda: get_versions(get_scopes()))
+	etag = entity_tag(request, versions)
+	response = get_conditional_response(request, etag=etag)
+	if response is not None:
+		return tag_response(response, endpoint, 'not_modified', etag)
+	primary_if_changed(versions)
+	return tag_response(render(await fetch()), endpoint, 'full', etag)
@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+
+class FastSerializer:
+	'''
+		A read-only serializer compiled once from a DRF ModelSerializer, for hot read paths.
+		It reads `.values_list()` rows and builds plain dicts with the same keys, order and values as the
+		DRF serializer, without its per-object field lookups. Nested serializers are read through their relation's
+		columns, e.g poster__username. Method fields get a __slots__ record carrying the model fields named for them in
+		the serializer's `method_sources`, or all its concrete fields.
+		Fields it cannot compile raise TypeError, use the DRF serializer for those
+	'''
+
+	def __init__(self, serializer_class, context=None):
+		self.template = serializer_class(context=context or {})
+		self.columns = []
+		self.build = self.compile(self.template, '')
+
+	def column(self, name):
+		if name not in self.columns:
+			self.columns.append(name)
+		return self.columns.index(name)
+
+	def compile(self, serializer, prefix):
+		'''
+			Returns a function that builds the dict of one row for this serializer, registering the columns it reads
+		:return:
+		'''
+		model = serializer.Meta.model
+		steps = []
+		for name, field in serializer.fields.items():
+			if isinstance(field, serializers.BaseSerializer):
+				if getattr(field, 'many', False):
+					raise TypeError(f'{name} is a list, it cannot be compiled')
+				null_check = self.column(f'{prefix}{field.source}__pk')
+				steps.append((name, null_check, self.compile(field, f'{prefix}{field.source}__'), True))
+			elif isinstance(field, serializers.SerializerMethodField):
+				method = getattr(serializer, field.method_name)
+				sources = getattr(serializer, 'method_sources', {}).get(name)
+				steps.append((name, None, self.compile_method(model, method, prefix, sources), True))
+			elif isinstance(field, serializers.DateTimeField) and self.compiles_datetime(field):
+				steps.append((name, self.column(f'{prefix}{field.source}'), self.to_iso_8601, False))
+			elif isinstance(field, serializers.FileField):
+				steps.append((name, self.column(f'{prefix}{field.source}'), self.compile_file(model, field), False))
+			elif isinstance(field, serializers.Field) and '.' not in field.source and field.source != '*':
+				to_representation = {serializers.IntegerField: int, serializers.CharField: str}.get(
+					type(field), field.to_representation)
+				steps.append((name, self.column(f'{prefix}{field.source}'), to_representation, False))
+			else:
+				raise TypeError(f'{name} ({type(field).__name__}) cannot be compiled')
+
+		def build(row):
+			data = {}
+			for name, index, to_representation, whole_row in steps:
+				if whole_row:
+					data[name] = None if index is not None and row[index] is None else to_representation(row)
+				else:
+					value = row[index]
+					data[name] = None if value is None else to_representation(value)
+			return data
+		return build
+
+	def compile_method(self, model, method, prefix, sources=None):
+		'''
+			Method fields are called with a record that has the given model fields, or all concrete ones, as attributes
+		:return:
+		'''
+		names = list(sources or [field.attname for field in model._meta.concrete_fields])
+		indexes = [self.column(f'{prefix}{name}') for name in names]
+		record_class = type(f'{model.__name__}Record', (), {'__slots__': names})
+
+		def call(row):
+			record = record_class()
+			for name, index in zip(names, indexes):
+				setattr(record, name, row[index])
+			return method(record)
+		return call
+
+	@staticmethod
+	def compiles_datetime(field):
+		'''
+			Datetimes are compiled in the default case, ISO 8601 output of aware values in the current timezone
+		:return:
+		'''
+		output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+		return settings.USE_TZ and output_format is not None and output_format.lower() == ISO_8601 and \
+			not hasattr(field, 'timezone')
+
+	def to_iso_8601(self, value):
+		value = value.astimezone(self.timezone).isoformat()
+		return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+	def compile_file(self, model, field):
+		'''
+			Rows hold a file's name rather than a FieldFile, its url comes from the model field's storage
+		:return:
+		'''
+		storage = model._meta.get_field(field.source).storage
+		request = self.template.context.get('request')
+		use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+
+		def url(name):
+			if not name:
+				return None
+			if not use_url:
+				return name
+			return request.build_absolute_uri(storage.url(name)) if request is not None else storage.url(name)
+		return url
+
+	def rows(self, rows):
+		self.timezone = timezone.get_current_timezone()
+		return [self.build(row) for row in rows]
+
+	def queryset(self, queryset):
+		'''
+			Serializes a queryset with one query for just the columns this serializer reads
+		:return:
+		'''
+		return self.rows(queryset.values_list(*self.columns))
+
+
+_compiled = {}
+
+
+def get_fast_serializer(serializer_class):
+	'''
+		Returns the FastSerializer of a serializer class, compiled on first use without a request in its context
+	:return:
+	'''
+	if serializer_class not in _compiled:
+		_compiled[serializer_class] = FastSerializer(serializer_class)
+	return _compiled[serializer_class]
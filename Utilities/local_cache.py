@@ -0,0 +1,340 @@
+import json
+import os
+import pickle
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+
+from Utilities.metrics import Counter, Gauge, collectors, key_family, process_name
+
+# The most memory the local tier of a process may use, in bytes of pickled values
+LOCAL_CACHE_MAX_BYTES = getattr(settings, 'LOCAL_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+# Larger values are only cached remotely
+LOCAL_CACHE_MAX_ENTRY_BYTES = getattr(settings, 'LOCAL_CACHE_MAX_ENTRY_BYTES', 256 * 1024)
+# The longest a value is kept locally, it bounds how stale it can get if an invalidation is missed
+LOCAL_CACHE_TTL = getattr(settings, 'LOCAL_CACHE_TTL', 5)
+# The prefixes of the keys cached locally, small and hot values that are invalidated by deleting them
+LOCAL_CACHE_KEYS = tuple(getattr(settings, 'LOCAL_CACHE_KEYS', ('basic_user_', 'post_', 'all_posts_')))
+MISSING = object()
+# What a local tier and its bookkeeping cost per entry besides the pickled value, roughly
+ENTRY_OVERHEAD = 200
+
+local_lookups = Counter('local_cache_lookups', 'Lookups in the in-process cache tier by key family and result',
+						('family', 'result'))
+local_evictions = Counter('local_cache_evictions', 'Values dropped from the in-process cache tier to make room or '
+												   'because they expired', ('reason',))
+local_bytes = Gauge('local_cache_bytes', 'Memory used by the in-process cache tier of each process', ('process',))
+local_entries = Gauge('local_cache_entries', 'Values held by the in-process cache tier of each process', ('process',))
+
+
+class LocalTier:
+	'''
+		A bounded, thread safe LRU of pickled values that expire after at most `ttl` seconds. Values are kept
+		pickled so that callers never share them and their size is known, the least recently used are evicted when
+		the total passes `max_bytes`
+	'''
+
+	def __init__(self, max_bytes=None, max_entry_bytes=None, ttl=None):
+		self.max_bytes = LOCAL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+		self.max_entry_bytes = LOCAL_CACHE_MAX_ENTRY_BYTES if max_entry_bytes is None else max_entry_bytes
+		self.ttl = LOCAL_CACHE_TTL if ttl is None else ttl
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.entries = OrderedDict()
+			self.bytes = 0
+			self.hits = self.misses = 0
+
+	def get(self, key):
+		'''
+			Returns (True, value) for a live entry and (False, None) otherwise
+		:return:
+		'''
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and entry[0] <= time.monotonic():
+				self.drop(key)
+				local_evictions.inc(reason='expired')
+				entry = None
+			if entry is None:
+				self.misses += 1
+				return False, None
+			self.entries.move_to_end(key)
+			self.hits += 1
+		return True, pickle.loads(entry[1])
+
+	def set(self, key, value, timeout=None):
+		'''
+			Keeps a value for LOCAL_CACHE_TTL seconds, or `timeout` when it is shorter
+		:return:
+		'''
+		ttl = self.ttl if timeout is None else min(self.ttl, timeout)
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		if ttl <= 0 or len(data) > self.max_entry_bytes:
+			self.delete([key])
+			return
+		evicted = 0
+		with self.lock:
+			self.drop(key)
+			self.entries[key] = (time.monotonic() + ttl, data)
+			self.bytes += len(data) + len(key) + ENTRY_OVERHEAD
+			while self.bytes > self.max_bytes:
+				self.drop(next(iter(self.entries)))
+				evicted += 1
+		if evicted:
+			local_evictions.inc(evicted, reason='size')
+
+	def delete(self, keys):
+		with self.lock:
+			for key in keys:
+				self.drop(key)
+
+	def drop(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.bytes -= len(entry[1]) + len(key) + ENTRY_OVERHEAD
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes, 'hits': self.hits,
+					'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else None}
+
+
+class RedisInvalidationBus:
+	'''
+		This bus carries the keys deleted by any process over redis pub/sub, so that every process drops its local
+		copy. Each process listens on a daemon thread that resubscribes after a lost connection, and clears its local
+		tiers then since it may have missed invalidations meanwhile
+	'''
+	channel = 'cache:invalidate'
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+		self.tiers = weakref.WeakSet()
+		self.listener_pid = None
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def publish(self, keys):
+		self.client.publish(self.channel, json.dumps(keys))
+
+	def subscribe(self, tier):
+		self.tiers.add(tier)
+		# A forked worker does not inherit the thread
+		if self.listener_pid != os.getpid():
+			self.listener_pid = os.getpid()
+			threading.Thread(target=self.listen, name='cache-invalidation', daemon=True).start()
+
+	def listen(self):
+		while True:
+			try:
+				pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+				pubsub.subscribe(self.channel)
+				self.deliver(None)
+				for message in pubsub.listen():
+					self.deliver(json.loads(message['data']))
+			except Exception:
+				time.sleep(1)
+
+	def deliver(self, keys):
+		'''
+			Drops these keys from every local tier of this process, or everything when keys is None
+		:return:
+		'''
+		for tier in list(self.tiers):
+			tier.clear() if keys is None else tier.delete(keys)
+
+
+class LocalInvalidationBus(RedisInvalidationBus):
+	'''
+		This is an in-process stand-in for the redis invalidation bus, used by tests and single process runs
+	'''
+
+	def publish(self, keys):
+		self.deliver(keys)
+
+	def subscribe(self, tier):
+		self.tiers.add(tier)
+
+
+_buses = {}
+
+
+def get_invalidation_bus():
+	'''
+		Returns the invalidation bus selected by settings.CACHE_INVALIDATION_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'CACHE_INVALIDATION_BACKEND', 'redis')
+	if backend not in _buses:
+		_buses[backend] = LocalInvalidationBus() if backend == 'local' else RedisInvalidationBus()
+	return _buses[backend]
+
+
+# The local tier of each two tier cache, by location. Django creates a cache backend per thread, the tier is shared
+# by the threads of a process
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+def get_local_tier(location):
+	with _tiers_lock:
+		if location not in _tiers:
+			_tiers[location] = LocalTier()
+			get_invalidation_bus().subscribe(_tiers[location])
+		return _tiers[location]
+
+
+def report_local_tiers():
+	stats = [tier.stats() for tier in list(_tiers.values())]
+	if stats:
+		local_bytes.set(sum(stat['bytes'] for stat in stats), process=process_name())
+		local_entries.set(sum(stat['entries'] for stat in stats), process=process_name())
+
+
+collectors.append(report_local_tiers)
+
+
+class TwoTierCache(BaseCache):
+	'''
+		A cache backend that keeps the values of LOCAL_CACHE_KEYS in a per-process LocalTier in front of the cache
+		configured in OPTIONS['REMOTE'], a CACHES style dict such as the django_redis one. Other keys, like versions
+		and locks, always go to the remote cache.
+		Deleting a key publishes it on the invalidation bus and every process drops its copy, so a delete is seen
+		by the process that made it at once and by the others as soon as they get the message, and at the latest
+		LOCAL_CACHE_TTL seconds later. Local families must be invalidated by deleting their keys: a set is only seen
+		by other processes once their copy expires
+	'''
+
+	def __init__(self, location, params):
+		super().__init__(params)
+		remote = dict(params['OPTIONS']['REMOTE'])
+		backend = import_string(remote.pop('BACKEND'))
+		self.remote = backend(remote.pop('LOCATION', ''), remote)
+		self.local = get_local_tier(location)
+		self.bus = get_invalidation_bus()
+
+	def __getattr__(self, name):
+		# Backend specific API like django_redis's `client`, which get_redis_connection() uses
+		if name == 'remote':
+			raise AttributeError(name)
+		return getattr(self.remote, name)
+
+	@staticmethod
+	def is_local(key):
+		return key.startswith(LOCAL_CACHE_KEYS)
+
+	def local_key(self, key, version=None):
+		return self.remote.make_key(key, version=version)
+
+	def local_timeout(self, timeout):
+		return self.remote.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+	def get(self, key, default=None, version=None):
+		if not self.is_local(key):
+			return self.remote.get(key, default, version=version)
+		found, value = self.local.get(self.local_key(key, version))
+		local_lookups.inc(family=key_family(key), result='hit' if found else 'miss')
+		if found:
+			return value
+		value = self.remote.get(key, MISSING, version=version)
+		if value is MISSING:
+			return default
+		self.local.set(self.local_key(key, version), value)
+		return value
+
+	def get_many(self, keys, version=None):
+		values, remote_keys, tallies = {}, [], {}
+		for key in keys:
+			if not self.is_local(key):
+				remote_keys.append(key)
+				continue
+			found, value = self.local.get(self.local_key(key, version))
+			tally = (key_family(key), 'hit' if found else 'miss')
+			tallies[tally] = tallies.get(tally, 0) + 1
+			if found:
+				values[key] = value
+			else:
+				remote_keys.append(key)
+		for (family, result), count in tallies.items():
+			local_lookups.inc(count, family=family, result=result)
+		if remote_keys:
+			found = self.remote.get_many(remote_keys, version=version)
+			for key, value in found.items():
+				if self.is_local(key):
+					self.local.set(self.local_key(key, version), value)
+			values.update(found)
+		return values
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		result = self.remote.set(key, value, timeout=timeout, version=version)
+		if self.is_local(key):
+			self.local.set(self.local_key(key, version), value, self.local_timeout(timeout))
+		return result
+
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+		failed = self.remote.set_many(data, timeout=timeout, version=version)
+		for key, value in data.items():
+			if self.is_local(key) and key not in (failed or ()):
+				self.local.set(self.local_key(key, version), value, self.local_timeout(timeout))
+		return failed
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		added = self.remote.add(key, value, timeout=timeout, version=version)
+		if added and self.is_local(key):
+			self.local.set(self.local_key(key, version), value, self.local_timeout(timeout))
+		return added
+
+	def delete(self, key, version=None):
+		deleted = self.remote.delete(key, version=version)
+		self.invalidate([key], version)
+		return deleted
+
+	def delete_many(self, keys, version=None):
+		self.remote.delete_many(keys, version=version)
+		self.invalidate(keys, version)
+
+	def invalidate(self, keys, version=None):
+		'''
+			Drops these keys from the local tier of every process, after the remote cache has dropped them so that
+			no process can copy the old value back in
+		:return:
+		'''
+		keys = [self.local_key(key, version) for key in keys if self.is_local(key)]
+		if keys:
+			self.local.delete(keys)
+			self.bus.publish(keys)
+
+	def clear(self):
+		self.remote.clear()
+		self.local.clear()
+		self.bus.publish(None)
+
+	def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+		return self.remote.touch(key, timeout=timeout, version=version)
+
+	def has_key(self, key, version=None):
+		return self.remote.has_key(key, version=version)
+
+	def incr(self, key, delta=1, version=None):
+		return self.remote.incr(key, delta, version=version)
+
+	def decr(self, key, delta=1, version=None):
+		return self.remote.decr(key, delta, version=version)
+
+	def close(self, **kwargs):
+		self.remote.close(**kwargs)
+
+	def stats(self):
+		return self.local.stats()
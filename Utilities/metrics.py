@@ -0,0 +1,358 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+# Gauges a process has not reported for this long are dropped, the process has likely exited
+GAUGE_MAX_AGE = getattr(settings, 'GAUGE_MAX_AGE', max(60, METRICS_FLUSH_INTERVAL * 6))
+# Prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Guards the pending deltas of every metric, recording is a few dict updates under it
+_lock = threading.Lock()
+
+
+class Metric:
+	'''
+		A metric aggregated in-process: recording only adds to this process's pending deltas, which are flushed to
+		the metric store at most every METRICS_FLUSH_INTERVAL seconds, so every process adds to the same totals
+		without a round trip per event. `labels` are the names of its labels, e.g ('result',)
+	'''
+	registry = []
+	kind = None
+
+	def __init__(self, name, description, labels=()):
+		self.name = name
+		self.description = description
+		self.labels = tuple(labels)
+		self.pending = {}
+		Metric.registry.append(self)
+
+	def add(self, sample, amount, labels):
+		key = (sample,) + tuple(str(labels[label]) for label in self.labels)
+		with _lock:
+			self.pending[key] = self.pending.get(key, 0) + amount
+
+	def samples(self):
+		'''
+			Returns the totals of every process as ({label: value}, sample, total) triples, this process's pending
+			deltas included
+		:return:
+		'''
+		flush_metrics()
+		return [(dict(zip(self.labels, key[1:])), key[0], total)
+				for key, total in sorted(get_metric_store().read(self).items())]
+
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def inc(self, amount=1, **labels):
+		self.add('total', amount, labels)
+
+	def values(self):
+		'''
+			Returns the value of every combination of label values recorded so far, as (labels, value) pairs
+		:return:
+		'''
+		return [(labels, value) for labels, _, value in self.samples()]
+
+
+class Histogram(Metric):
+	'''
+		A histogram of observed values, e.g latencies. Each observation adds one to the first bucket it fits in,
+		the cumulative counts Prometheus expects are summed up when the metric is read
+	'''
+	kind = 'histogram'
+
+	def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+		super().__init__(name, description, labels)
+		self.buckets = tuple(buckets)
+		self.bucket_samples = [f'bucket:{bound}' for bound in self.buckets] + ['bucket:+Inf']
+
+	def observe(self, value, **labels):
+		key = tuple(str(labels[label]) for label in self.labels)
+		bucket = (self.bucket_samples[bisect_left(self.buckets, value)],) + key
+		total, count = ('sum',) + key, ('count',) + key
+		with _lock:
+			# Flushing swaps the pending dict, it is read under the lock
+			pending = self.pending
+			pending[bucket] = pending.get(bucket, 0) + 1
+			pending[total] = pending.get(total, 0) + value
+			pending[count] = pending.get(count, 0) + 1
+
+
+class Gauge(Metric):
+	'''
+		A value each process reports for itself, e.g its memory use, with a label telling the processes apart.
+		A report replaces the process's previous one. Gauges are reported by the functions in `collectors`, which run
+		before every flush
+	'''
+	kind = 'gauge'
+
+	def set(self, value, **labels):
+		key = ('value',) + tuple(str(labels[label]) for label in self.labels)
+		with _lock:
+			self.pending[key] = value
+
+
+# Functions that report gauges, called before the pending deltas are flushed
+collectors = []
+
+
+def process_name():
+	return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class RedisMetricStore:
+	'''
+		This store keeps the totals of each metric in a redis hash, every process adds its deltas with HINCRBYFLOAT
+		so totals are summed over all the workers and hosts that share the redis
+	'''
+	key_prefix = 'metrics'
+
+	def __init__(self, alias='default'):
+		self.alias = alias
+
+	@property
+	def client(self):
+		from django_redis import get_redis_connection
+		return get_redis_connection(self.alias)
+
+	def key(self, metric):
+		return f'{self.key_prefix}:{metric.name}'
+
+	def add(self, deltas):
+		pipe = self.client.pipeline(transaction=False)
+		now = time.time()
+		for metric, pending in deltas:
+			for key, amount in pending.items():
+				if metric.kind == 'gauge':
+					pipe.hset(self.key(metric), json.dumps(key), json.dumps([amount, now]))
+				else:
+					pipe.hincrbyfloat(self.key(metric), json.dumps(key), amount)
+		pipe.execute()
+
+	def read(self, metric):
+		fields = self.client.hgetall(self.key(metric))
+		if metric.kind != 'gauge':
+			return {tuple(json.loads(field)): float(total) for field, total in fields.items()}
+		values, expired = {}, []
+		for field, report in fields.items():
+			value, reported = json.loads(report)
+			if reported < time.time() - GAUGE_MAX_AGE:
+				expired.append(field)
+			else:
+				values[tuple(json.loads(field))] = value
+		if expired:
+			self.client.hdel(self.key(metric), *expired)
+		return values
+
+
+class LocalMetricStore:
+	'''
+		This is an in-process stand-in for the redis metric store, used by tests and single process runs
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with _lock:
+			for metric in Metric.registry:
+				metric.pending.clear()
+		self.totals = {}
+
+	def add(self, deltas):
+		with self.lock:
+			for metric, pending in deltas:
+				totals = self.totals.setdefault(metric.name, {})
+				for key, amount in pending.items():
+					totals[key] = amount if metric.kind == 'gauge' else totals.get(key, 0) + amount
+
+	def read(self, metric):
+		with self.lock:
+			return dict(self.totals.get(metric.name, {}))
+
+
+_stores = {}
+_next_flush = 0
+
+
+def get_metric_store():
+	'''
+		Returns the metric store selected by settings.METRICS_BACKEND ('redis' or 'local')
+	:return:
+	'''
+	backend = getattr(settings, 'METRICS_BACKEND', 'redis')
+	if backend not in _stores:
+		_stores[backend] = LocalMetricStore() if backend == 'local' else RedisMetricStore()
+	return _stores[backend]
+
+
+def flush_metrics():
+	'''
+		Moves the pending deltas of every metric to the metric store. It runs in the request path, so a store that
+		cannot be reached is logged rather than raised and its deltas are kept for the next flush
+	:return:
+	'''
+	global _next_flush
+	for collect in collectors:
+		try:
+			collect()
+		except Exception:
+			logger.exception('Could not collect metrics with %r', collect)
+	with _lock:
+		deltas = [(metric, metric.pending) for metric in Metric.registry if metric.pending]
+		for metric, _ in deltas:
+			metric.pending = {}
+		_next_flush = time.monotonic() + METRICS_FLUSH_INTERVAL
+	if not deltas:
+		return
+	try:
+		get_metric_store().add(deltas)
+	except Exception:
+		with _lock:
+			for metric, pending in deltas:
+				for key, amount in pending.items():
+					if metric.kind == 'gauge':
+						# A newer report wins
+						metric.pending.setdefault(key, amount)
+					else:
+						metric.pending[key] = metric.pending.get(key, 0) + amount
+		logger.exception('Could not flush metrics to the metric store')
+
+
+def flush_due():
+	return time.monotonic() >= _next_flush
+
+
+def format_value(value):
+	return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+		'\n', '\\n')) for name, value in labels.items()) + '}'
+
+
+def exposition():
+	'''
+		Every metric in the Prometheus text format, summed over all processes
+	:return:
+	'''
+	lines = []
+	for metric in Metric.registry:
+		name = f'{metric.name}_total' if metric.kind == 'counter' else metric.name
+		lines += [f'# HELP {name} {metric.description}', f'# TYPE {name} {metric.kind}']
+		samples = metric.samples()
+		if metric.kind in ('counter', 'gauge'):
+			lines += [f'{name}{format_labels(labels)} {format_value(value)}' for labels, _, value in samples]
+			continue
+		series = {}
+		for labels, sample, value in samples:
+			series.setdefault(tuple(labels.items()), {})[sample] = value
+		for labels, values in series.items():
+			cumulative = 0
+			for bound in [str(bound) for bound in metric.buckets] + ['+Inf']:
+				cumulative += values.get(f'bucket:{bound}', 0)
+				lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {format_value(cumulative)}')
+			lines.append(f'{name}_sum{format_labels(dict(labels))} {format_value(values.get("sum", 0))}')
+			lines.append(f'{name}_count{format_labels(dict(labels))} {format_value(values.get("count", 0))}')
+	return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+	'''
+		The Prometheus scrape endpoint. When settings.METRICS_TOKEN is set, scrapers must send it as a bearer token
+	:return:
+	'''
+	token = getattr(settings, 'METRICS_TOKEN', None)
+	if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+		return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+	return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Time spent answering requests, by view',
+							 ('view', 'method', 'status'))
+db_queries = Counter('db_queries', 'Database queries run by requests, by view', ('view',))
+db_query_seconds = Counter('db_query_seconds', 'Time requests spent in database queries, by view', ('view',))
+cache_lookups = Counter('cache_lookups', 'Cache lookups by key family and result', ('family', 'result'))
+api_errors = Counter('api_errors', 'Exceptions turned into 400 responses by api_exception, by view and class',
+					 ('view', 'exception'))
+
+
+def key_family(key):
+	'''
+		The family of a cache key, the key without the ID it ends with, e.g 'mine_posts_' for 'mine_posts_12'
+		and 'all_posts_' for 'all_posts_shared'
+	:return:
+	'''
+	family = key.rstrip('0123456789')
+	return family if family.endswith('_') or '_' not in family else family[:family.rfind('_') + 1]
+
+
+def count_lookups(keys, found):
+	'''
+		Counts a cache read of `keys`, of which those in `found` were hits
+	:return:
+	'''
+	tallies = {}
+	for key in keys:
+		tally = ('total', key_family(key), 'hit' if key in found else 'miss')
+		tallies[tally] = tallies.get(tally, 0) + 1
+	with _lock:
+		pending = cache_lookups.pending
+		for tally, count in tallies.items():
+			pending[tally] = pending.get(tally, 0) + count
+
+
+class RequestStats:
+	'''
+		The database work of one request, queries may run on other threads of the request's context
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.queries = 0
+		self.seconds = 0.0
+
+
+current_request = ContextVar('current_request', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+	stats = current_request.get()
+	if stats is None:
+		return execute(sql, params, many, context)
+	started = time.perf_counter()
+	try:
+		return execute(sql, params, many, context)
+	finally:
+		elapsed = time.perf_counter() - started
+		with stats.lock:
+			stats.queries += 1
+			stats.seconds += elapsed
+
+
+def install_query_counter(connection, **kwargs):
+	'''
+		Adds count_query to a database connection's execute wrappers, once. It goes first so that wrappers pushed and
+		popped around it by connection.execute_wrapper() stay last
+	:return:
+	'''
+	if count_query not in connection.execute_wrappers:
+		connection.execute_wrappers.insert(0, count_query)
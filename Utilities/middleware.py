@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from Utilities.metrics import current_request, RequestStats, install_query_counter, request_duration, db_queries, \
+	db_query_seconds, flush_due, flush_metrics
+from Utilities.replicas import current_routing, RoutingState, pin_to_primary, replicas
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+	'''
+		WhiteNoise's middleware made async capable. WhiteNoise only runs sync, and as the first middleware it makes an
+		ASGI server adapt the whole middleware chain and view to sync and back on every request. Looking a static file
+		up is a dict lookup, so this serves it on the event loop and awaits the rest of the chain
+	:return:
+	'''
+	sync_capable = True
+	async_capable = True
+
+	def __init__(self, get_response=None, *args, **kwargs):
+		super().__init__(get_response, *args, **kwargs)
+		if asyncio.iscoroutinefunction(get_response):
+			# Django tells an async middleware instance by this marker
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		return super().__call__(request)
+
+	async def __acall__(self, request):
+		response = self.process_request(request)
+		if response is None:
+			response = await self.get_response(request)
+		return response
+
+
+class MetricsMiddleware:
+	'''
+		This middleware records the latency of every request and the database queries it ran, labelled by the
+		name of the view that answered it, in the in-process metrics that /metrics exposes. Queries are counted by
+		a wrapper on every connection, which also sees the queries async views run in the thread pool
+	'''
+	sync_capable = True
+	async_capable = True
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		connection_created.connect(install_query_counter)
+		for connection in connections.all():
+			install_query_counter(connection)
+		if asyncio.iscoroutinefunction(get_response):
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		stats, token, started = self.start()
+		try:
+			response = self.get_response(request)
+		finally:
+			current_request.reset(token)
+		self.record(request, response, stats, started)
+		if flush_due():
+			flush_metrics()
+		return response
+
+	async def __acall__(self, request):
+		from Utilities.async_views import run_in_thread
+		stats, token, started = self.start()
+		try:
+			response = await self.get_response(request)
+		finally:
+			current_request.reset(token)
+		self.record(request, response, stats, started)
+		if flush_due():
+			await run_in_thread(flush_metrics)
+		return response
+
+	@staticmethod
+	def start():
+		stats = RequestStats()
+		return stats, current_request.set(stats), time.perf_counter()
+
+	@staticmethod
+	def record(request, response, stats, started):
+		match = getattr(request, 'resolver_match', None)
+		view = match.view_name if match is not None else 'unmatched'
+		request_duration.observe(time.perf_counter() - started, view=view, method=request.method,
+								 status=response.status_code)
+		if stats.queries:
+			db_queries.inc(stats.queries, view=view)
+			db_query_seconds.inc(stats.seconds, view=view)
+
+
+class ReplicaMiddleware:
+	'''
+		This middleware gives every request the routing state ReplicaRouter reads. When a request by a signed in user
+		wrote to the database, the user's reads stick to the primary for REPLICA_STICKY_SECONDS afterwards
+	'''
+	sync_capable = True
+	async_capable = True
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		if asyncio.iscoroutinefunction(get_response):
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		state = RoutingState()
+		token = current_routing.set(state)
+		try:
+			response = self.get_response(request)
+		finally:
+			current_routing.reset(token)
+		user_id = self.writer(request, state)
+		if user_id is not None:
+			pin_to_primary(user_id)
+		return response
+
+	async def __acall__(self, request):
+		from Utilities.async_views import run_in_thread
+		state = RoutingState()
+		token = current_routing.set(state)
+		try:
+			response = await self.get_response(request)
+		finally:
+			current_routing.reset(token)
+		user_id = self.writer(request, state)
+		if user_id is not None:
+			await run_in_thread(pin_to_primary, user_id)
+		return response
+
+	@staticmethod
+	def writer(request, state):
+		'''
+			The ID of the user whose request wrote, DRF sets the user on the request once it authenticated them
+		:return:
+		'''
+		user = getattr(request, 'user', None)
+		if state.wrote and replicas() and user is not None and user.is_authenticated:
+			return user.id
+		return None
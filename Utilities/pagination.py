@@ -0,0 +1,105 @@
+import base64
+import datetime
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_microseconds(date):
+	return (date - EPOCH) // MICROSECOND
+
+
+def from_microseconds(microseconds):
+	return EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+def keyset_filter(queryset, position, id_field='id'):
+	'''
+		Orders a queryset newest first on (date_created, id_field) and keeps only the rows after the given position
+	:return:
+	'''
+	queryset = queryset.order_by('-date_created', f'-{id_field}')
+	if position is not None:
+		date_created = from_microseconds(position[0])
+		queryset = queryset.filter(Q(date_created__lt=date_created) |
+								   Q(date_created=date_created, **{f'{id_field}__lt': position[1]}))
+	return queryset
+
+
+def queryset_keys(queryset, position, limit, id_field='id'):
+	'''
+		Returns the (microseconds, id) keys of the next `limit` rows of a queryset after the given position.
+		`id_field` names the column holding the ID, e.g post_id for the rows of an index table
+	:return:
+	'''
+	rows = keyset_filter(queryset, position, id_field).values_list('date_created', id_field)[:limit]
+	return [(to_microseconds(date_created), row_id) for date_created, row_id in rows]
+
+
+class KeysetPagination(BasePagination):
+	'''
+		This paginator pages over descending keys with an opaque cursor, so every page costs one index range scan
+		no matter how deep it is. Keys are tuples of key_length integers, posts use (date_created in microseconds, id)
+	'''
+	key_length = 2
+	page_size = getattr(settings, 'PAGE_SIZE', 20)
+	max_page_size = getattr(settings, 'MAX_PAGE_SIZE', 100)
+	cursor_query_param = 'cursor'
+	page_size_query_param = 'page_size'
+
+	def encode_cursor(self, position):
+		return base64.urlsafe_b64encode(':'.join(str(part) for part in position).encode()).decode()
+
+	def decode_cursor(self, request):
+		cursor = request.query_params.get(self.cursor_query_param)
+		if not cursor:
+			return None
+		try:
+			position = tuple(int(part) for part in base64.urlsafe_b64decode(cursor.encode()).decode().split(':'))
+		except (TypeError, ValueError, UnicodeDecodeError):
+			raise Exception('Invalid cursor')
+		if len(position) != self.key_length:
+			raise Exception('Invalid cursor')
+		return position
+
+	def get_page_size(self, request):
+		try:
+			page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+		except ValueError:
+			page_size = self.page_size
+		return max(1, min(page_size, self.max_page_size))
+
+	def paginate_keys(self, fetch, request):
+		'''
+			Pages over a key source. fetch(position, limit) returns up to `limit` keys after position, largest first
+		:return:
+		'''
+		self.request = request
+		page_size = self.get_page_size(request)
+		keys = fetch(self.decode_cursor(request), page_size + 1)
+		self.next_position = keys[page_size - 1] if len(keys) > page_size else None
+		return keys[:page_size]
+
+	def paginate_queryset(self, queryset, request, view=None):
+		keys = self.paginate_keys(lambda position, limit: queryset_keys(queryset, position, limit), request)
+		rows = queryset.in_bulk([row_id for _, row_id in keys])
+		return [rows[row_id] for _, row_id in keys if row_id in rows]
+
+	def get_next_link(self):
+		if self.next_position is None:
+			return None
+		url = self.request.build_absolute_uri()
+		return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+	def get_paginated_response(self, data):
+		return Response(OrderedDict([
+			('next', self.get_next_link()),
+			('results', data)
+		]))
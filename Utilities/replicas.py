@@ -0,0 +1,121 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+
+
+class RoutingState:
+	'''
+		The database routing of one request: the replica its reads go to, if any, and whether it has written
+	'''
+
+	def __init__(self):
+		self.replica = None
+		self.wrote = False
+
+
+current_routing = ContextVar('current_routing', default=None)
+# Set while reading values that are shared with other requests, such as cache fills
+primary_only = ContextVar('primary_only', default=False)
+
+
+def replicas():
+	return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def pin_key(user_id):
+	return f'replica_pin_{user_id}'
+
+
+def pin_to_primary(user_id):
+	'''
+		Sends the reads of a user who just wrote to the primary for REPLICA_STICKY_SECONDS, so that they see their
+		writes before the replicas catch up
+	:return:
+	'''
+	cache.set(pin_key(user_id), 1, timeout=getattr(settings, 'REPLICA_STICKY_SECONDS', 10))
+
+
+def is_pinned(user_id):
+	return cache.get(pin_key(user_id)) is not None
+
+
+def primary_if_changed(versions):
+	'''
+		Sends the rest of a request's reads to the primary when content it depends on changed in the last
+		REPLICA_STICKY_SECONDS. A replica may not have the change yet, and the response is tagged with the versions
+		that include it. `versions` are the times of the changes in nanoseconds, as bump_versions records them.
+		Returns whether the request was reading from a replica
+	:return:
+	'''
+	state = current_routing.get()
+	if state is None or state.replica is None:
+		return False
+	if time.time_ns() - max(versions) >= getattr(settings, 'REPLICA_STICKY_SECONDS', 10) * 1000000000:
+		return False
+	state.replica = None
+	return True
+
+
+@contextmanager
+def primary_reads():
+	'''
+		Reads from the primary inside the block. Values cached for every request are read from the primary, a lagging
+		replica's value would otherwise be served well after the replica caught up
+	:return:
+	'''
+	token = primary_only.set(True)
+	try:
+		yield
+	finally:
+		primary_only.reset(token)
+
+
+class ReplicaRouter:
+	'''
+		This router sends the reads of a request to the replica ReplicaReadsMixin picked for it, and everything else
+		to the default database, the primary. A request that writes reads from the primary from then on
+	'''
+
+	def db_for_read(self, model, **hints):
+		state = current_routing.get()
+		if state is None or primary_only.get():
+			return None
+		return state.replica
+
+	def db_for_write(self, model, **hints):
+		state = current_routing.get()
+		if state is not None:
+			state.wrote = True
+			state.replica = None
+		return None
+
+	def allow_relation(self, obj1, obj2, **hints):
+		databases = {'default', *replicas()}
+		if obj1._state.db in databases and obj2._state.db in databases:
+			return True
+		return None
+
+	def allow_migrate(self, db, app_label, model_name=None, **hints):
+		# Replicas copy the primary's schema
+		return False if db in replicas() else None
+
+
+class ReplicaReadsMixin:
+	'''
+		Lets the GET requests of a view read from one of settings.DATABASE_REPLICAS, picked once authentication has
+		told who the user is, unless the user wrote in the last REPLICA_STICKY_SECONDS
+	'''
+
+	def initial(self, request, *args, **kwargs):
+		super().initial(request, *args, **kwargs)
+		state = current_routing.get()
+		if state is None or state.wrote or not replicas() or request.method not in SAFE_METHODS:
+			return
+		if request.user.is_authenticated and is_pinned(request.user.id):
+			return
+		state.replica = random.choice(replicas())